@@ -1,33 +1,138 @@
-from langchain_groq import ChatGroq
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_groq import ChatGroq
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain_mistralai import ChatMistralAI
+import threading
+
 from dotenv import load_dotenv
 load_dotenv()
 
+# Context window and output budget (tokens) per model
+MODEL_BUDGETS = {
+    'llama-3.1-70b-versatile': {'context_window': 131072, 'max_output': 8000},
+    'llama3-70b-8192': {'context_window': 8192, 'max_output': 2048},
+    'llama3-8b-8192': {'context_window': 8192, 'max_output': 2048},
+    'llama-3.1-8b-instant': {'context_window': 131072, 'max_output': 8000},
+    'mixtral-8x7b-32768-groq': {'context_window': 32768, 'max_output': 4096},
+    'gemma-7b-it': {'context_window': 8192, 'max_output': 2048},
+    'gemma2-9b-it': {'context_window': 8192, 'max_output': 2048},
+    'gemini-pro': {'context_window': 32760, 'max_output': 2048},
+    'gemini-1.5-pro': {'context_window': 2097152, 'max_output': 8192},
+    'gemini-1.5-flash': {'context_window': 1048576, 'max_output': 8192},
+    'gpt-4o': {'context_window': 128000, 'max_output': 4096},
+    'gpt-4o-mini': {'context_window': 128000, 'max_output': 16384},
+    'gpt-4-turbo': {'context_window': 128000, 'max_output': 4096},
+    'gpt-4': {'context_window': 8192, 'max_output': 2048},
+    'gpt-3.5-turbo': {'context_window': 16385, 'max_output': 4096},
+    'chatgpt-4o-latest': {'context_window': 128000, 'max_output': 16384},
+    'claude-3-opus-20240229': {'context_window': 200000, 'max_output': 4096},
+    'claude-3-sonnet-20240229': {'context_window': 200000, 'max_output': 4096},
+    'claude-3-haiku-20240307': {'context_window': 200000, 'max_output': 4096},
+    'mistral-large-2402': {'context_window': 32000, 'max_output': 4096},
+    'mistral-large-2407': {'context_window': 128000, 'max_output': 4096},
+}
+DEFAULT_BUDGET = {'context_window': 8192, 'max_output': 1024}
+
+MODEL_PROVIDERS = {
+    'llama3-8b-8192': 'groq',
+    'llama3-70b-8192': 'groq',
+    'llama-3.1-70b-versatile': 'groq',
+    'llama-3.1-8b-instant': 'groq',
+    'mixtral-8x7b-32768-groq': 'groq',
+    'gemma-7b-it': 'groq',
+    'gemma2-9b-it': 'groq',
+    'gemini-pro': 'google',
+    'gemini-1.5-pro': 'google',
+    'gemini-1.5-flash': 'google',
+    'gpt-4o': 'openai',
+    'gpt-4o-mini': 'openai',
+    'gpt-4-turbo': 'openai',
+    'gpt-4': 'openai',
+    'gpt-3.5-turbo': 'openai',
+    'chatgpt-4o-latest': 'openai',
+    'claude-3-opus-20240229': 'anthropic',
+    'claude-3-sonnet-20240229': 'anthropic',
+    'claude-3-haiku-20240307': 'anthropic',
+    'mistral-large-2402': 'mistralai',
+    'mistral-large-2407': 'mistralai',
+}
+
+# Tokens kept free in every chunk request for the instructions and paper summary
+PROMPT_RESERVE_TOKENS = 2000
+# A chunk is at most this many times the output budget, so long-context models
+# still produce explanations detailed enough for the text they cover
+MAX_CHUNK_TO_OUTPUT_RATIO = 4
+MIN_CHUNK_TOKENS = 500
+
+
 class LLMSelector:
-    @staticmethod
-    def get_llm(api_provider, model_name):
+    # (api_provider, model_name) -> chat model shared by every run in the process
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    @classmethod
+    def get_llm(cls, api_provider, model_name):
         '''
         input: 
             api_provider: str
             model_name: str
         ouput: 
-            ChatModel
+            ChatModel, created on first use and then reused so its HTTP
+            connection pool survives across runs
         '''
+        key = (api_provider, model_name)
+        with cls._clients_lock:
+            llm = cls._clients.get(key)
+            if llm is None:
+                llm = cls.create_llm(api_provider, model_name)
+                cls._clients[key] = llm
+            return llm
+
+    @staticmethod
+    def create_llm(api_provider, model_name):
+        # Provider SDKs take seconds to import, so only the one in use is loaded
+        max_output = LLMSelector.get_budget(model_name)['max_output']
+        # Retries are handled by the generator's RetryPolicy, with backoff shared across calls
         if api_provider == "google":
-            return ChatGoogleGenerativeAI(model=model_name)
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            return ChatGoogleGenerativeAI(model=model_name, max_output_tokens=max_output, max_retries=0)
         elif api_provider == "groq":
+            from langchain_groq import ChatGroq
             if model_name == "mixtral-8x7b-32768-groq":
                 model_name = "mixtral-8x7b-32768"
-            return ChatGroq(model=model_name)
+            return ChatGroq(model=model_name, max_tokens=max_output, max_retries=0)
         elif api_provider == "openai":
-            return ChatOpenAI(model=model_name)
+            from langchain_openai import ChatOpenAI
+            return ChatOpenAI(model=model_name, max_tokens=max_output, max_retries=0)
         elif api_provider == "anthropic":
-            return ChatAnthropic(model_name=model_name)
+            from langchain_anthropic import ChatAnthropic
+            # Opts in to prompt caching, used for the cache_control hints on shared prompt prefixes
+            return ChatAnthropic(model_name=model_name, max_tokens=max_output, max_retries=0,
+                                 default_headers={'anthropic-beta': 'prompt-caching-2024-07-31'})
         elif api_provider == "mistralai":
-            return ChatMistralAI(model_name=model_name)
+            from langchain_mistralai import ChatMistralAI
+            return ChatMistralAI(model_name=model_name, max_tokens=max_output, max_retries=0)
+        elif api_provider == "fake":
+            # Local deterministic model used by the benchmark and offline runs
+            from fakeLLM import FakeChatModel
+            return FakeChatModel(model_name=model_name)
         else:
-            raise ValueError(f"Unsupported API provider: {api_provider} and model: {model_name}")
\ No newline at end of file
+            raise ValueError(f"Unsupported API provider: {api_provider} and model: {model_name}")
+
+    @staticmethod
+    def get_budget(model_name):
+        return MODEL_BUDGETS.get(model_name, DEFAULT_BUDGET)
+
+    @staticmethod
+    def get_chunk_budget(model_name, tpm=None):
+        '''
+        input:
+            model_name: str
+            tpm: int, tokens-per-minute limit the requests must also fit in
+        output:
+            (chunk_tokens, overlap_tokens)
+        '''
+        budget = LLMSelector.get_budget(model_name)
+        chunk_tokens = min(budget['context_window'] - budget['max_output'] - PROMPT_RESERVE_TOKENS,
+                           budget['max_output'] * MAX_CHUNK_TO_OUTPUT_RATIO)
+        if tpm:
+            # Leave half of the per-minute quota for the summary, prompt and output
+            chunk_tokens = min(chunk_tokens, tpm // 2)
+        chunk_tokens = max(chunk_tokens, MIN_CHUNK_TOKENS)
+        return chunk_tokens, min(chunk_tokens // 10, 500)
\ No newline at end of file
@@ -1,10 +1,59 @@
-import asyncio
+import math
+import os
 import time
 import streamlit as st
 
-from LLMSelect import LLMSelector
-from asyncExplainer import AsyncExplanationGenerator
+from LLMSelect import MODEL_PROVIDERS
+from bundle import BundleLibrary, ResultBundle
+from checkpoint import CheckpointStore
+from jobs import JobQueue
+from llmCache import LLMCache
+from paperIndex import PaperIndex
+from planner import BATCH_MODE, EXECUTION_MODES, RunPlanner
 from preprocessor import PaperPreprocessor
+from providerBatch import BATCH_CLIENTS
+from rateLimiter import DEFAULT_LIMITS
+
+# Chunks shown per page of a paper in the library
+LIBRARY_PAGE_CHUNKS = 10
+
+@st.cache_resource
+def get_llm_cache():
+    return LLMCache()
+
+
+@st.cache_resource
+def get_library():
+    return BundleLibrary()
+
+
+@st.cache_resource(max_entries=8)
+def open_bundle(path, modified):
+    # Keyed on the modification time so a re-saved paper is reopened
+    return ResultBundle(path)
+
+
+@st.cache_data(show_spinner="Reading the paper...")
+def extract_paper_text(pdf_bytes):
+    return PaperPreprocessor.extract_text_from_bytes(pdf_bytes)
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def plan_runs(content_hash, api_provider, model_name, options, _paper_text):
+    # Keyed on the PDF's hash and the options; the text itself is not hashed on every rerun
+    return RunPlanner(api_provider, model_name, options, options["rate_limits"]).plans(_paper_text)
+
+
+def format_cost(cost):
+    return "unknown" if cost is None else f"${cost:.4f}"
+
+
+@st.cache_resource
+def get_job_queue():
+    # One worker pool and job table for every session served by this process
+    return JobQueue(max_workers=int(os.getenv('EXPLAINER_WORKERS', '2')), checkpoints=CheckpointStore(),
+                    paper_index=PaperIndex(), library=get_library())
+
 
 class StreamlitApp:
     def __init__(self):
@@ -185,29 +234,7 @@ class StreamlitApp:
             ]
         
             model_name = st.selectbox('Choose Model', model_lst)
-            name_to_api_provider = {
-                'llama3-8b-8192': 'groq',
-                'llama3-70b-8192': 'groq',
-                'llama-3.1-70b-versatile': 'groq',
-                'llama-3.1-8b-instant': 'groq',
-                'mixtral-8x7b-32768-groq': 'groq',
-                'gemma-7b-it': 'groq',
-                'gemma2-9b-it': 'groq',
-                'gemini-pro': 'google',
-                'gemini-1.5-pro': 'google',
-                'gemini-1.5-flash': 'google',
-                'gpt-4o': 'openai',
-                'gpt-4o-mini': 'openai',
-                'gpt-4-turbo': 'openai',
-                'gpt-4': 'openai',
-                'gpt-3.5-turbo': 'openai',
-                'chatgpt-4o-latest': 'openai',
-                'claude-3-opus-20240229': 'anthropic',
-                'claude-3-sonnet-20240229': 'anthropic',
-                'claude-3-haiku-20240307': 'anthropic',
-                'mistral-large-2402': 'mistralai',
-                'mistral-large-2407': 'mistralai'
-            }
+            name_to_api_provider = MODEL_PROVIDERS
             
             st.subheader("Explanation Options")
             options = {
@@ -215,23 +242,69 @@ class StreamlitApp:
                 "include_examples": st.checkbox("Include Examples", value=False),
                 "explain_prereq": st.checkbox("Explain Prerequisites", value=False),
                 "explain_math": st.checkbox("Explain Mathematical Concepts", value=False),
-                "find_similar_papers": st.checkbox("Find Similar Papers", value=False, disabled=True)
+                "find_similar_papers": st.checkbox("Find Similar Papers", value=False,
+                                                   help="Searches the papers processed so far, without any request")
             }
             
             if options["find_similar_papers"]:
-                options["include_paper_summary"] = st.checkbox("Include Summary of Similar Papers", value=False, disabled=True)
+                options["include_paper_summary"] = st.checkbox("Include Summary of Similar Papers", value=False,
+                                                               help="One extra request that summarizes the matches")
             else:
                 options["include_paper_summary"] = False
-                st.info("'Find Similar Papers' feature is currently unavailable")
             
             with st.expander("Additional Options"):
-                execution_mode = st.radio("Execution Mode", ["Async", "Non-Async"])
-                
-                if execution_mode == "Non-Async":
-                    options["sleep_between"] = st.checkbox("Include Sleeps", value=False)
-                else:
-                    options["sleep_between"] = False
-                
+                execution_modes = EXECUTION_MODES + ([BATCH_MODE] if name_to_api_provider[model_name] in BATCH_CLIENTS else [])
+                execution_mode = st.radio("Execution Mode", execution_modes,
+                                          help="Batch API sends the explanation requests as a provider batch job: about half "
+                                               "the price, but results can take up to 24 hours.")
+
+                st.caption("Rate limits for this run, 0 = unlimited (requests of other runs on this model count towards them)")
+                default_limits = DEFAULT_LIMITS.get(name_to_api_provider[model_name], {})
+                options["rate_limits"] = {
+                    "rpm": st.number_input("Requests per minute", min_value=0, value=default_limits.get("rpm") or 0),
+                    "tpm": st.number_input("Tokens per minute", min_value=0, value=default_limits.get("tpm") or 0, step=1000),
+                    "max_concurrency": st.number_input("Max concurrent requests", min_value=0, value=default_limits.get("max_concurrency") or 0),
+                }
+
+                options["fused"] = st.checkbox("Fused Requests", value=False,
+                                               help="Ask for all selected sections in one request per chunk. "
+                                                    "Falls back to one request per section if the response can't be parsed.")
+
+                options["stream_tokens"] = st.checkbox("Stream Tokens", value=False,
+                                                       help="Show explanations token by token while they are generated (not used with Fused Requests).")
+
+                options["skip_chunks"] = st.checkbox("Skip Unneeded Requests", value=True,
+                                                     help="Don't request explanations for reference lists, or math explanations "
+                                                          "for chunks without any math.")
+
+                options["prefix_prompts"] = st.checkbox("Cache-Friendly Prompts", value=False,
+                                                        help="Put the instructions and paper summary first, identically in every "
+                                                             "request, so providers that cache prompt prefixes (Anthropic, OpenAI) "
+                                                             "bill them at the cached rate.")
+
+                options["speculative"] = st.checkbox("Speculative Explanations", value=False,
+                                                     help="Start explaining chunks right away from the paper's abstract and "
+                                                          "introduction while the summary is written.")
+                options["speculative_rerun"] = st.checkbox("Re-run With Final Summary", value=False, disabled=not options["speculative"],
+                                                           help="Request the sections explained from the abstract and introduction "
+                                                                "again once the summary is ready (more requests).")
+
+                options["use_cache"] = st.checkbox("Use Response Cache", value=True,
+                                                   help="Reuse stored responses for identical requests (same model, prompt and text).")
+
+                fallback_models = st.multiselect("Fallback Models", [name for name in model_lst if name != model_name],
+                                                 help="Equivalent models, in order, that take over a request when the chosen model errors.")
+                options["fallbacks"] = [(name_to_api_provider[name], name) for name in fallback_models]
+                hedge_percent = st.slider("Hedged Requests (%)", 0, 50, 0, disabled=not fallback_models,
+                                          help="Also send up to this share of requests to the first fallback when the "
+                                               "chosen model is slower than usual, and keep whichever answer arrives first "
+                                               "(Async mode, not with Stream Tokens).")
+                options["hedge_budget"] = hedge_percent / 100
+
+                options["token_budget"] = st.number_input("Token Budget per Paper", min_value=0, value=0, step=10000,
+                                                          help="Cap on input + output tokens for one paper (0 = unlimited). "
+                                                               "Requests that could exceed it are not sent and their sections are marked as failed.")
+
                 summarization_method = st.selectbox("Summarization Method", ["map_reduce", "refine", "stuff"])
             
             return uploaded_file, model_name, name_to_api_provider[model_name], options, execution_mode, summarization_method
@@ -241,155 +314,223 @@ class StreamlitApp:
         st.write("Upload a research paper PDF and get an explanation tailored to your needs.")
 
         if uploaded_file:
+            self.display_plan(uploaded_file, model_name, api_provider, options, execution_mode, summarization_method)
             if st.button('Process Paper'):
-                if execution_mode == "Async":
-                    asyncio.run(self.process_paper_async(uploaded_file, model_name, api_provider, options, summarization_method))
-                else:
-                    self.process_paper_sync(uploaded_file, model_name, api_provider, options, summarization_method)
+                job = self.submit_job(uploaded_file, model_name, api_provider, options, execution_mode, summarization_method)
+                st.session_state['job_id'] = job.id
+
+            # Processing runs in the job queue, so reruns (widget interactions, other
+            # sessions) only re-attach to the job instead of losing its work
+            job = get_job_queue().get(st.session_state.get('job_id'))
+            if job is not None and job.file_name == uploaded_file.name:
+                self.display_job(job)
         elif not uploaded_file:
             st.info('Please upload a PDF file in the sidebar to begin.')
 
-    async def process_paper_async(self, uploaded_file, model_name, api_provider, options, summarization_method):
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-
-        status_text.text("Extracting text from PDF...")
-        paper_text = PaperPreprocessor.extract_text_from_pdf(uploaded_file)
-
-        status_text.text(f"Initializing {model_name} model from {api_provider}...")
-        llm = LLMSelector.get_llm(api_provider, model_name)
-        generator = AsyncExplanationGenerator(llm)
-
-        progress_bar.progress(10)
-        status_text.text("Summarizing the paper...")
-        summary = generator.summarize_paper(paper_text, summarization_method)
-        paper_chunks = generator.text_splitter.split_text(paper_text)
-
-        progress_bar.progress(30)
-        status_text.text("Generating explanations...")
-        
-        tasks = [
-            generator.generate_main_explanation_async(summary, paper_chunks, difficulty=options['difficulty']),
-            generator.generate_examples_async(summary, paper_chunks) if options['include_examples'] else None,
-            generator.explain_prerequisites_async(summary, paper_chunks) if options["explain_prereq"] else None,
-            generator.explain_math_async(summary, paper_chunks) if options["explain_math"] else None,
-            generator.find_similar_papers_async(summary, options["include_paper_summary"]) if options["find_similar_papers"] else None
-        ]
-        results = await asyncio.gather(*[task for task in tasks if task is not None])
-
-        explanations = {
-            'Prerequisites': results[2] if options["explain_prereq"] else None,
-            'Main Explanation': results[0],
-            'Examples': results[1] if options['include_examples'] else None,
-            'Mathematical Concepts': results[3] if options["explain_math"] else None,
-            'Similar Papers': results[4] if options["find_similar_papers"] else None
-        }
-        explanations = {k: v for k, v in explanations.items() if v is not None}
-
-        progress_bar.progress(90)
-        status_text.text("Combining explanations...")
-        final_explanation = generator.combine_explanations(summary, explanations, paper_chunks)
-
-        progress_bar.progress(100)
-        status_text.text("Displaying results...")
-        self.display_results(summary, final_explanation)
-        status_text.text('Process Completed!')
-
-    def process_paper_sync(self, uploaded_file, model_name, api_provider, options, summarization_method):
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-
-        status_text.text("Extracting text from PDF...")
-        paper_text = PaperPreprocessor.extract_text_from_pdf(uploaded_file)
-
-        status_text.text(f"Initializing {model_name} model from {api_provider}...")
-        llm = LLMSelector.get_llm(api_provider, model_name)
-        generator = AsyncExplanationGenerator(llm)
-
-        progress_bar.progress(10)
-        status_text.text("Summarizing the paper...")
-        summary = generator.summarize_paper(paper_text, summarization_method)
-
-        if options["sleep_between"]:
-            status_text.text("Sleeping for 60 seconds...")
-            time.sleep(60)
-
-        paper_chunks = generator.text_splitter.split_text(paper_text)
-
-        progress_bar.progress(30)
-        status_text.text("Generating explanations...")
-        explanations = {}
-        
-        explanations['Main Explanation'] = generator.generate_main_explanation_sync(summary, paper_chunks, difficulty=options['difficulty'])
-
-        if options["sleep_between"]:
-            status_text.text("Sleeping for 60 seconds...")
-            time.sleep(60)
-
-        progress_bar.progress(50)
-        
-        if options['include_examples']:
-            explanations['Examples'] = generator.generate_examples_sync(summary, paper_chunks)
-            if options["sleep_between"]:
-                status_text.text("Sleeping for 60 seconds...")
-                time.sleep(60)
-
-        progress_bar.progress(60)
-        
-        if options["explain_prereq"]:
-            explanations['Prerequisites'] = generator.explain_prerequisites_sync(summary, paper_chunks)
-            if options["sleep_between"]:
-                status_text.text("Sleeping for 60 seconds...")
-                time.sleep(60)
-        progress_bar.progress(70)
-        
-        if options["explain_math"]:
-            explanations['Mathematical Concepts'] = generator.explain_math_sync(summary, paper_chunks)
-            if options["sleep_between"]:
-                status_text.text("Sleeping for 60 seconds...")
-                time.sleep(60)
-        progress_bar.progress(80)
-        
-        if options["find_similar_papers"]:
-            explanations['Similar Papers'] = generator.find_similar_papers_sync(summary, options["include_paper_summary"])
-            if options["sleep_between"]:
-                status_text.text("Sleeping for 60 seconds...")
-                time.sleep(60)
-
-        progress_bar.progress(90)
-        status_text.text("Combining explanations...")
-        final_explanation = generator.combine_explanations(summary, explanations, paper_chunks)
-
-        progress_bar.progress(100)
-        status_text.text("Displaying results...")
-        self.display_results(summary, final_explanation)
-        status_text.text('Process Completed!')
-
-    def display_results(self, summary, final_explanation):
-        st.success('Paper processed successfully!')
-        
+    def display_plan(self, uploaded_file, model_name, api_provider, options, execution_mode, summarization_method):
+        pdf_bytes = uploaded_file.getvalue()
+        try:
+            paper_text = extract_paper_text(pdf_bytes)
+        except Exception:
+            # Unreadable PDFs are reported when the paper is processed
+            return
+        plans = plan_runs(PaperPreprocessor.content_hash(pdf_bytes), api_provider, model_name, options, paper_text)
+        selected = next(plan for plan in plans if plan['execution_mode'] == execution_mode
+                        and plan['summarization_method'] == summarization_method)
+        with st.expander(f"Estimated Cost: {selected['requests']} requests, "
+                         f"{selected['input_tokens'] + selected['output_tokens']:,} tokens, ~{selected['wall_time']:.0f}s, {format_cost(selected['cost'])}"):
+            rows = "".join(f"| {plan['execution_mode']} | {plan['summarization_method']} | {plan['requests']} | {plan['input_tokens']:,} | "
+                           f"{plan['output_tokens']:,} | {plan['wall_time']:.0f}s | "
+                           f"{format_cost(plan['cost'])} |\n"
+                           for plan in plans)
+            st.markdown("| Execution mode | Summarization | Requests | Input tokens | Output tokens | Time | Cost |\n"
+                        "|---|---|---|---|---|---|---|\n" + rows)
+            st.caption(f"{selected['chunks']} chunks. Estimates assume typical response lengths and the rate limits set in "
+                       "Additional Options; cached responses and retries are not counted.")
+        if options["token_budget"] and selected['input_tokens'] + selected['output_tokens'] > options["token_budget"]:
+            st.warning("The estimated tokens exceed the token budget, so some sections will not be explained.")
+
+    def submit_job(self, uploaded_file, model_name, api_provider, options, execution_mode, summarization_method):
+        cache = get_llm_cache() if options["use_cache"] else None
+        return get_job_queue().submit(uploaded_file.getvalue(), uploaded_file.name, api_provider, model_name, options,
+                                      summarization_method, execution_mode, cache)
+
+    def display_job(self, job):
+        if job.active:
+            st.experimental_fragment(run_every=1.0)(self.poll_job)(job.id)
+        else:
+            self.render_job(job)
+
+    def poll_job(self, job_id):
+        job = get_job_queue().get(job_id)
+        if not job.active:
+            # Rerun the whole page once so the finished job is shown without polling
+            st.rerun()
+        self.render_job(job)
+
+    def render_job(self, job):
+        st.progress(job.progress)
+        st.text(job.message)
+        if job.status == 'failed':
+            st.error(f"Processing failed: {job.error}")
+
+        result = job.result
+        if result is None:
+            return
+        self.display_summary(result.summary, result.metadata.get('provisional_summary', False))
+        sections = result.metadata.get('sections', [])
+        speculative = result.metadata.get('speculative', False)
+        for chunk in result.chunks:
+            previews = {section: text for (index, section), text in list(job.previews.items()) if index == chunk.index}
+            if previews:
+                chunk = chunk.copy()
+                for section, text in previews.items():
+                    chunk.set(section, text + " ▌")
+            elif not chunk.is_settled(sections):
+                continue
+            self.display_chunk(chunk, speculative)
+
+        if job.status == 'done':
+            self.finish(job)
+
+    def finish(self, job):
+        result = job.result
+        if result.similar_papers is not None:
+            self.display_similar_papers(result.similar_papers)
+        failed = result.failed_sections()
+        if failed:
+            st.warning(f"{len(failed)} section(s) could not be generated. The rest of the paper was kept; "
+                       "retry only the failed sections below.")
+            if st.button("Retry Failed Sections", key="retry_failed"):
+                get_job_queue().retry_failed(job.id)
+                st.rerun()
+        else:
+            st.success('Paper processed successfully!')
+        self.display_downloads(result)
+        cache = job.pipeline.generator.cache
+        if cache is not None:
+            self.display_cache_stats(cache)
+        self.display_run_stats(job.telemetry)
+
+    def display_downloads(self, result):
+        columns = st.columns(3)
+        columns[0].download_button("Download Markdown", result.to_markdown(), file_name="explanation.md", mime="text/markdown")
+        columns[1].download_button("Download HTML", result.to_html(), file_name="explanation.html", mime="text/html")
+        columns[2].download_button("Download JSON", result.to_json(), file_name="explanation.json", mime="application/json")
+
+    def display_summary(self, summary, provisional=False):
         st.markdown("## Paper Summary")
+        if provisional:
+            st.caption("The summary is still being written. Meanwhile chunks are explained from the abstract and introduction below.")
         st.markdown(f'<div class="paper-summary">{summary}</div>', unsafe_allow_html=True)
-        
-        chunks = final_explanation.split("## Chunk")
-        for i, chunk in enumerate(chunks[1:], 1):
-            st.markdown(f'<h2 class="chunk-header">Chunk {i}</h2>', unsafe_allow_html=True)
-            
-            sections = chunk.split("###")
-            chunk_content = sections[0].strip()
-            if chunk_content:
-                st.markdown(f'<div class="chunk-text">{chunk_content}</div>', unsafe_allow_html=True)
-            
-            for section in sections[1:]:
-                section_parts = section.split("\n", 1)
-                if len(section_parts) == 2:
-                    section_title, section_content = section_parts
-                    st.markdown(f'<h3>{section_title.strip()}</h3>', unsafe_allow_html=True)
-                    st.markdown(f'<div class="explanation-text">{section_content.strip()}</div>', unsafe_allow_html=True)
-                    st.markdown('<div class="section-separator"></div>', unsafe_allow_html=True)
 
+    def display_chunk(self, chunk, speculative=False):
+        st.markdown(f'<h2 class="chunk-header">Chunk {chunk.index + 1}</h2>', unsafe_allow_html=True)
+        st.markdown(f'<div class="chunk-text">{chunk.new_text.strip()}</div>', unsafe_allow_html=True)
+        if chunk.provisional:
+            st.caption(f"Explained from the abstract and introduction (provisional context): {', '.join(chunk.provisional)}")
+        elif speculative and any(chunk.sections()):
+            st.caption("Explained from the paper summary")
+
+        for _, title, content in chunk.sections():
+            st.markdown(f'<h3>{title}</h3>', unsafe_allow_html=True)
+            st.markdown(f'<div class="explanation-text">{content.strip()}</div>', unsafe_allow_html=True)
+            st.markdown('<div class="section-separator"></div>', unsafe_allow_html=True)
+
+        if chunk.skipped and not any(chunk.sections()) and not chunk.errors:
+            st.caption("Not explained: this chunk looks like a reference list.")
+
+        for section, error in chunk.errors.items():
+            st.warning(f"{section} failed: {error}")
+
+    def display_similar_papers(self, similar_papers):
+        st.markdown("## Similar Papers")
+        st.markdown(similar_papers)
+
+    def display_cache_stats(self, cache):
+        stats = cache.stats()
+        st.caption(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, "
+                   f"{stats['entries']} entries ({stats['bytes'] / 1e6:.1f} MB)")
+
+    def display_run_stats(self, telemetry):
+        with st.expander("Run Stats"):
+            rows = telemetry.summary()
+            live_calls = sum(row['calls'] - row['cache_hits'] for row in rows)
+            columns = st.columns(6)
+            columns[0].metric("LLM calls", live_calls)
+            columns[1].metric("Cache hits", sum(row['cache_hits'] for row in rows))
+            columns[2].metric("Skipped calls", sum(telemetry.skipped.values()))
+            columns[3].metric("Input tokens", sum(row['input_tokens'] for row in rows))
+            columns[4].metric("Cached input tokens", sum(row['cache_read_tokens'] for row in rows),
+                              help="Prompt tokens the provider served from its prefix cache")
+            columns[5].metric("Output tokens", sum(row['output_tokens'] for row in rows))
+
+            stages = "".join(f"| {stage} | {seconds:.2f} |\n" for stage, seconds in telemetry.stages.items())
+            st.markdown("| Stage | Seconds |\n|---|---|\n" + stages)
+
+            calls = "".join(f"| {row['provider']} | {row['model']} | {row['section']} | {row['calls']} | {row['cache_hits']} | "
+                            f"{row['errors']} | {row['mean_latency']:.2f}s | {row['p95_latency']:.2f}s | {row['total_queue_wait']:.2f}s | "
+                            f"{row['input_tokens']} | {row['output_tokens']} |\n" for row in rows)
+            st.markdown("| Provider | Model | Section | Calls | Cache hits | Errors | Mean latency | p95 latency | Queue wait "
+                        "| Input tokens | Output tokens |\n|---|---|---|---|---|---|---|---|---|---|---|\n" + calls)
+
+            routing = telemetry.routing_events()
+            if routing:
+                events = "".join(f"| {row['event']} | {row['provider']} | {row['model']} | {row['count']} |\n" for row in routing)
+                st.markdown("| Routing event | Provider | Model | Count |\n|---|---|---|---|\n" + events)
+
+            columns = st.columns(2)
+            columns[0].download_button("Download Stats (JSON)", telemetry.to_json(), file_name="run_stats.json",
+                                       mime="application/json")
+            columns[1].download_button("Download Stats (Prometheus)", telemetry.to_prometheus(), file_name="run_stats.prom",
+                                       mime="text/plain")
+
+    def library_view(self):
+        st.title('Library')
+        entries = get_library().list()
+        if not entries:
+            st.info('Explained papers are saved here once they have been processed.')
+            return
+        labels = {entry['bundle_id']: f"{entry['title'] or entry['bundle_id']} · {entry['model_name']}, {entry['difficulty']} · "
+                                      f"{entry['chunks']} chunks · {time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created']))}"
+                  for entry in entries}
+        bundle_id = st.selectbox("Explained Paper", list(labels), format_func=labels.get, key="library_bundle")
+        path = get_library().path(bundle_id)
+        try:
+            bundle = open_bundle(path, os.path.getmtime(path))
+        except (OSError, ValueError) as e:
+            st.error(f"Could not open the saved paper: {e}")
+            return
+
+        # Only the chunks on the current page are read from the bundle
+        pages = max(1, math.ceil(len(bundle) / LIBRARY_PAGE_CHUNKS))
+        page = st.number_input("Page", min_value=1, max_value=pages, value=1, key=f"library_page_{bundle_id}") if pages > 1 else 1
+        start = (page - 1) * LIBRARY_PAGE_CHUNKS
+        stop = min(len(bundle), start + LIBRARY_PAGE_CHUNKS)
+        st.caption(f"Chunks {start + 1}-{stop} of {len(bundle)}")
+        try:
+            summary = bundle.summary if page == 1 else None
+            chunks = bundle.chunks(start, stop)
+            similar_papers = bundle.similar_papers if page == pages else None
+        except (OSError, ValueError) as e:
+            st.error(f"Could not read the saved paper: {e}")
+            return
+
+        if summary is not None:
+            self.display_summary(summary)
+        speculative = bundle.metadata.get('speculative', False)
+        for chunk in chunks:
+            self.display_chunk(chunk, speculative)
+        if similar_papers is not None:
+            self.display_similar_papers(similar_papers)
+        failed = bundle.failed_sections()
+        if failed:
+            st.warning(f"{len(failed)} section(s) of this paper could not be generated.")
 
     def run(self):
+        if st.sidebar.radio("View", ["Explain a Paper", "Library"], horizontal=True) == "Library":
+            self.library_view()
+            return
         uploaded_file, model_name, api_provider, options, execution_mode, summarization_method = self.sidebar_content()
         self.main_content(uploaded_file, model_name, api_provider, options, execution_mode, summarization_method)
 
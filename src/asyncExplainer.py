@@ -1,181 +1,623 @@
 import asyncio
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.docstore.document import Document
-from langchain.chains.summarize.chain import load_summarize_chain
-from langchain.prompts import PromptTemplate
+import re
+import time
+from langchain.chains.summarize import map_reduce_prompt, refine_prompts, stuff_prompt
+from langchain.prompts import ChatPromptTemplate, PromptTemplate
+
+from LLMSelect import LLMSelector
+from budget import TokenBudget
+from chunkClassifier import ChunkClassifier
+from preprocessor import PaperPreprocessor, count_tokens
+from rateLimiter import RateLimiter, estimate_tokens
+from results import ChunkResult, PaperResult
+from retry import RetryPolicy
+from router import LLMRouter, Route
+from telemetry import Telemetry
+
+MAIN_EXPLANATION_PROMPT = PromptTemplate(
+    input_variables=['summary', 'chunk', 'difficulty'],
+    template="Given the following summary of a research paper:\n\n{summary}\n\n"
+             "Explain the following part of the paper for a {difficulty} level reader:\n\n{chunk}\n\n"
+             "Provide a clear and concise explanation of the main ideas, methodology, and findings in this part, "
+             "considering how it fits into the overall paper."
+)
+
+EXAMPLES_PROMPT = PromptTemplate(
+    input_variables=["summary", "chunk"],
+    template="Given the following summary of a research paper:\n\n{summary}\n\n"
+             "Based on this part of the paper:\n\n{chunk}\n\n"
+             "Provide concrete examples that illustrate the main concepts or findings in this section."
+)
+
+PREREQUISITES_PROMPT = PromptTemplate(
+    input_variables=["summary", "chunk"],
+    template="Given the following summary of a research paper:\n\n{summary}\n\n"
+             "For this part of the paper:\n\n{chunk}\n\n"
+             "Identify and explain the key prerequisites needed to understand this section."
+)
+
+MATH_PROMPT = PromptTemplate(
+    input_variables=["summary", "chunk"],
+    template="Given the following summary of a research paper:\n\n{summary}\n\n"
+             "For this part of the paper:\n\n{chunk}\n\n"
+             "Explain in detail the key mathematical concepts and equations in this section."
+             "If no mathematical concept or equations are there return an empty string, don't make up anything up"
+)
+
+SECTION_PROMPTS = {
+    'Main Explanation': MAIN_EXPLANATION_PROMPT,
+    'Examples': EXAMPLES_PROMPT,
+    'Prerequisites': PREREQUISITES_PROMPT,
+    'Mathematical Concepts': MATH_PROMPT,
+}
+
+SIMILAR_PAPERS_PROMPT = PromptTemplate(
+    input_variables=["summary", "search_results"],
+    template="Given this summary of a research paper:\n\n{summary}\n\n"
+             "And the following matching passages from other papers in the library:\n\n{search_results}\n\n"
+             "Provide a brief summary of each of these papers and how it relates to this one."
+)
+# Papers returned by the local index
+SIMILAR_PAPERS = 3
+
+# Section -> (response tag, instruction) used by the fused one-call-per-chunk mode
+FUSED_SECTIONS = {
+    'Prerequisites': ('prerequisites', "Identify and explain the key prerequisites needed to understand this section."),
+    'Main Explanation': ('explanation', "Provide a clear and concise explanation for a {difficulty} level reader of the main ideas, "
+                                        "methodology, and findings in this part, considering how it fits into the overall paper."),
+    'Examples': ('examples', "Provide concrete examples that illustrate the main concepts or findings in this section."),
+    'Mathematical Concepts': ('math', "Explain in detail the key mathematical concepts and equations in this section. "
+                                      "If there are none, leave the tag empty, don't make anything up."),
+}
+
+
+def build_fused_prompt(sections):
+    tasks = "\n".join(f"<{FUSED_SECTIONS[section][0]}>: {FUSED_SECTIONS[section][1]}" for section in sections)
+    return PromptTemplate(
+        input_variables=['summary', 'chunk', 'difficulty'],
+        template="Given the following summary of a research paper:\n\n{summary}\n\n"
+                 "For this part of the paper:\n\n{chunk}\n\n"
+                 "Complete each of the following tasks. Wrap each answer in its own tag, e.g. <tag>answer</tag>, "
+                 "and write nothing outside the tags.\n\n" + tasks
+    )
+
+
+# Prefix layout: the instructions and summary form a system message that is identical
+# for every chunk and section request, so providers can cache it as a prompt prefix
+PREFIX_SYSTEM_TEMPLATE = ("You help readers understand a research paper, one part at a time. For each part you are given, "
+                          "complete the task that follows it, considering how the part fits into the overall paper.\n\n"
+                          "Summary of the paper:\n\n{summary}")
+
+SECTION_TASKS = {
+    'Main Explanation': "Explain this part of the paper for a {difficulty} level reader. Provide a clear and concise explanation "
+                        "of the main ideas, methodology, and findings in this part.",
+    'Examples': "Provide concrete examples that illustrate the main concepts or findings in this section.",
+    'Prerequisites': "Identify and explain the key prerequisites needed to understand this section.",
+    'Mathematical Concepts': "Explain in detail the key mathematical concepts and equations in this section. "
+                             "If no mathematical concept or equations are there return an empty string, don't make anything up",
+}
+
+
+def build_prefix_prompt(task):
+    return ChatPromptTemplate.from_messages([
+        ('system', PREFIX_SYSTEM_TEMPLATE),
+        ('human', "Part of the paper:\n\n{chunk}\n\n" + task),
+    ])
+
+
+PREFIX_SECTION_PROMPTS = {section: build_prefix_prompt(task) for section, task in SECTION_TASKS.items()}
+
+
+def build_prefix_fused_prompt(sections):
+    tasks = "\n".join(f"<{FUSED_SECTIONS[section][0]}>: {FUSED_SECTIONS[section][1]}" for section in sections)
+    return build_prefix_prompt("Complete each of the following tasks. Wrap each answer in its own tag, e.g. <tag>answer</tag>, "
+                               "and write nothing outside the tags.\n\n" + tasks)
+
+
+def mark_overlap(text, overlap):
+    '''
+    Chunk text for prompts, with the leading `overlap` characters that were
+    already explained with the previous chunk marked as context only.
+    '''
+    if not overlap:
+        return text
+    return (f"[Already covered in the previous part, given only as context; don't explain it again:]\n{text[:overlap]}\n\n"
+            f"[New text to explain:]\n{text[overlap:]}")
+
+
+def parse_fused_response(text, sections):
+    '''
+    Returns the sections found in a fused response. Sections whose tags are
+    missing or unterminated (e.g. truncated output) are left out.
+    '''
+    parsed = {}
+    for section in sections:
+        tag = FUSED_SECTIONS[section][0]
+        match = re.search(rf'<{tag}>(.*?)</{tag}>', text, re.S)
+        if match is not None:
+            parsed[section] = match.group(1).strip()
+    return parsed
+
+
+async def iter_async(texts):
+    '''
+    Iterates an iterable or an async iterable.
+    '''
+    if hasattr(texts, '__aiter__'):
+        async for text in texts:
+            yield text
+    else:
+        for text in texts:
+            yield text
+
 
 class AsyncExplanationGenerator:
-    def __init__(self, llm):
+    def __init__(self, llm, rate_limiter=None, cache=None, api_provider=None, model_name=None, telemetry=None,
+                 retry_policy=None, router=None, token_budget=None, prefix_prompts=False, paper_index=None):
         self.llm = llm
-        self.search = 'search'  # PLACEHOLDER (FUTURE FEATURES)
-        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=4000, chunk_overlap=400)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.cache = cache
+        self.telemetry = telemetry or Telemetry()
+        # Without fallbacks every request goes to the one (provider, model) route
+        self.router = router or LLMRouter([Route(api_provider, model_name, llm, self.rate_limiter)])
+        self.router.telemetry = self.telemetry
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.token_budget = token_budget or TokenBudget()
+        self.router.token_budget = self.token_budget
+        self.prefix_prompts = prefix_prompts
+        self.api_provider = api_provider
+        self.model_name = model_name
+        # Local index of processed papers, searched for similar papers
+        self.paper_index = paper_index
+        # Chunks are sized in tokens from the model's context/output budget
+        self.text_splitter = PaperPreprocessor.get_text_splitter(model_name, self.rate_limiter.tpm)
+        # Partial summaries are collapsed until they fit in one request of the same size
+        self.summary_token_max = LLMSelector.get_chunk_budget(model_name, self.rate_limiter.tpm)[0]
+
+    def _cache_key(self, *parts, route=None):
+        '''
+        Cache key of a request to the primary model, or to `route`: responses
+        are stored under the model that actually answered, so a fallback's
+        answer is never replayed as the primary model's.
+        '''
+        if self.cache is None:
+            return None
+        if route is not None:
+            return self.cache.key(route.api_provider, route.model_name, *parts)
+        return self.cache.key(self.api_provider, self.model_name, *parts)
+
+    def _cache_get(self, key):
+        return None if key is None else self.cache.get(key)
+
+    def _cache_set(self, key, value):
+        if key is not None:
+            self.cache.set(key, value)
+
+    def section_prompt(self, section):
+        return PREFIX_SECTION_PROMPTS[section] if self.prefix_prompts else SECTION_PROMPTS[section]
+
+    def fused_prompt(self, sections):
+        return build_prefix_fused_prompt(sections) if self.prefix_prompts else build_fused_prompt(sections)
+
+    @staticmethod
+    def _group_by_tokens(texts, token_max):
+        groups, current, current_tokens = [], [], 0
+        for text in texts:
+            tokens = count_tokens(text)
+            if current and current_tokens + tokens > token_max:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(text)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    async def summarize_paper_async(self, paper_text, summarization_method='map_reduce', max_concurrency=8, texts=None):
+        '''
+        texts are the paper's chunks when the caller has already split it. Any
+        iterable or async iterable works: map_reduce and refine only pull the
+        next chunk when a request slot frees up, so it can be a stream, with
+        paper_text None (which also skips the summary cache).
+        '''
+        key = None if paper_text is None else self._cache_key('summary', summarization_method, paper_text)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        if texts is None:
+            texts = self.text_splitter.split_text(paper_text)
+        if summarization_method == 'stuff':
+            if paper_text is None:
+                raise ValueError("The stuff summarization method needs the whole paper text")
+            summary = await self._ainvoke(stuff_prompt.PROMPT, {'text': paper_text}, section='Summary (stuff)')
+        elif summarization_method == 'refine':
+            summary = None
+            async for text in iter_async(texts):
+                if summary is None:
+                    summary = await self._ainvoke(refine_prompts.PROMPT, {'text': text}, section='Summary (refine)')
+                else:
+                    summary = await self._ainvoke(refine_prompts.REFINE_PROMPT, {'existing_answer': summary, 'text': text}, section='Summary (refine)')
+            if summary is None:
+                raise ValueError("The paper has no extractable text to summarize")
+        elif summarization_method == 'map_reduce':
+            semaphore = asyncio.Semaphore(max_concurrency)
 
-    def summarize_paper(self, paper_text, summarization_method='map_reduce'):
-        docs = [Document(page_content=text) for text in self.text_splitter.split_text(paper_text)]
-        chain = load_summarize_chain(llm=self.llm, chain_type=summarization_method)
-        return chain.invoke(docs)['output_text']
+            async def summarize(text, section):
+                async with semaphore:
+                    return await self._ainvoke(map_reduce_prompt.PROMPT, {'text': text}, section=section)
 
+            async def summarize_acquired(text):
+                try:
+                    return await self._ainvoke(map_reduce_prompt.PROMPT, {'text': text}, section='Summary (map)')
+                finally:
+                    semaphore.release()
 
-    async def process_chunk_async(self, summary, chunk, prompt_template, difficulty=None):
+            tasks = []
+            try:
+                async for text in iter_async(texts):
+                    await semaphore.acquire()
+                    tasks.append(asyncio.ensure_future(summarize_acquired(text)))
+                summaries = await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+            if not summaries:
+                raise ValueError("The paper has no extractable text to summarize")
+            # Collapse partial summaries in groups until they fit in a single reduce call
+            while sum(count_tokens(s) for s in summaries) > self.summary_token_max:
+                groups = self._group_by_tokens(summaries, self.summary_token_max)
+                if len(groups) == len(summaries):
+                    break
+                summaries = await asyncio.gather(*[summarize("\n\n".join(group), 'Summary (reduce)') for group in groups])
+            summary = await summarize("\n\n".join(summaries), 'Summary (reduce)')
+        else:
+            raise ValueError(f"Unsupported summarization method: {summarization_method}")
+
+        self._cache_set(key, summary)
+        return summary
+
+    def summarize_paper(self, paper_text, summarization_method='map_reduce', texts=None):
+        key = None if paper_text is None else self._cache_key('summary', summarization_method, paper_text)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        if texts is None:
+            texts = self.text_splitter.split_text(paper_text)
+        if summarization_method == 'stuff':
+            if paper_text is None:
+                raise ValueError("The stuff summarization method needs the whole paper text")
+            summary = self._invoke(stuff_prompt.PROMPT, {'text': paper_text}, section='Summary (stuff)')
+        elif summarization_method == 'refine':
+            summary = None
+            for text in texts:
+                if summary is None:
+                    summary = self._invoke(refine_prompts.PROMPT, {'text': text}, section='Summary (refine)')
+                else:
+                    summary = self._invoke(refine_prompts.REFINE_PROMPT, {'existing_answer': summary, 'text': text}, section='Summary (refine)')
+            if summary is None:
+                raise ValueError("The paper has no extractable text to summarize")
+        elif summarization_method == 'map_reduce':
+            summaries = [self._invoke(map_reduce_prompt.PROMPT, {'text': text}, section='Summary (map)') for text in texts]
+            if not summaries:
+                raise ValueError("The paper has no extractable text to summarize")
+            while sum(count_tokens(s) for s in summaries) > self.summary_token_max:
+                groups = self._group_by_tokens(summaries, self.summary_token_max)
+                if len(groups) == len(summaries):
+                    break
+                summaries = [self._invoke(map_reduce_prompt.PROMPT, {'text': "\n\n".join(group)}, section='Summary (reduce)') for group in groups]
+            summary = self._invoke(map_reduce_prompt.PROMPT, {'text': "\n\n".join(summaries)}, section='Summary (reduce)')
+        else:
+            raise ValueError(f"Unsupported summarization method: {summarization_method}")
+
+        self._cache_set(key, summary)
+        return summary
+
+    @staticmethod
+    def _usage(prompt_text, message):
+        usage = getattr(message, 'usage_metadata', None) or {}
+        return usage.get('input_tokens', estimate_tokens(prompt_text)), usage.get('output_tokens', estimate_tokens(message.content))
+
+    @staticmethod
+    def _cache_read_tokens(message):
+        details = (getattr(message, 'usage_metadata', None) or {}).get('input_token_details') or {}
+        if 'cache_read' in details:
+            return details['cache_read'] or 0
+        metadata = getattr(message, 'response_metadata', None) or {}
+        # Anthropic reports cache reads in its usage block, OpenAI under prompt_tokens_details
+        usage = metadata.get('usage') or {}
+        if 'cache_read_input_tokens' in usage:
+            return usage['cache_read_input_tokens'] or 0
+        token_usage = metadata.get('token_usage') or {}
+        return (token_usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+
+    def _record_call(self, section, prompt_text, message=None, queue_wait=0.0, latency=0.0, retries=0, error=None,
+                     route=None):
+        route = route or self.router.primary
+        fields = {'latency': latency, 'queue_wait': queue_wait, 'retries': retries}
+        if error is not None:
+            fields['error'] = f"{type(error).__name__}: {error}"
+        else:
+            fields['input_tokens'], fields['output_tokens'] = self._usage(prompt_text, message)
+            fields['cache_read_tokens'] = self._cache_read_tokens(message)
+        self.telemetry.record_call(route.api_provider, route.model_name, section, **fields)
+
+    def _reservation(self, prompt_text):
+        # Settled with the actual usage once the response arrives
+        return estimate_tokens(prompt_text) + self.token_budget.output_estimate(LLMSelector.get_budget(self.model_name)['max_output'])
+
+    async def _ainvoke(self, prompt_template, input_dict, on_token=None, section=None):
+        prompt = prompt_template.format_prompt(**input_dict)
+        prompt_text = prompt.to_string()
+        key = self._cache_key(prompt_text)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self.telemetry.record_call(self.api_provider, self.model_name, section, cache_hit=True)
+            return cached
+
+        reserved = self._reservation(prompt_text)
+        await self.token_budget.reserve(reserved)
+        attempt, first_try, used, output_tokens = 0, time.perf_counter(), 0, None
+        try:
+            while True:
+                try:
+                    route, message, queue_wait, latency = await self.router.ainvoke(prompt, reserved, on_token, section)
+                    break
+                except Exception as e:
+                    if not self.retry_policy.should_retry(e, attempt):
+                        self._record_call(section, prompt_text, latency=time.perf_counter() - first_try, retries=attempt, error=e)
+                        raise
+                    await asyncio.sleep(self.retry_policy.delay(attempt, e))
+                    attempt += 1
+            input_tokens, output_tokens = self._usage(prompt_text, message)
+            used = input_tokens + output_tokens
+        finally:
+            self.token_budget.settle(reserved, used, output_tokens)
+        self._record_call(section, prompt_text, message, queue_wait, latency, attempt, route=route)
+        self._cache_set(self._cache_key(prompt_text, route=route), message.content)
+        return message.content
+
+    def _invoke(self, prompt_template, input_dict, on_token=None, section=None):
+        prompt = prompt_template.format_prompt(**input_dict)
+        prompt_text = prompt.to_string()
+        key = self._cache_key(prompt_text)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self.telemetry.record_call(self.api_provider, self.model_name, section, cache_hit=True)
+            return cached
+
+        reserved = self._reservation(prompt_text)
+        self.token_budget.reserve_sync(reserved)
+        attempt, first_try, used, output_tokens = 0, time.perf_counter(), 0, None
+        try:
+            while True:
+                try:
+                    route, message, queue_wait, latency = self.router.invoke(prompt, reserved, on_token)
+                    break
+                except Exception as e:
+                    if not self.retry_policy.should_retry(e, attempt):
+                        self._record_call(section, prompt_text, latency=time.perf_counter() - first_try, retries=attempt, error=e)
+                        raise
+                    time.sleep(self.retry_policy.delay(attempt, e))
+                    attempt += 1
+            input_tokens, output_tokens = self._usage(prompt_text, message)
+            used = input_tokens + output_tokens
+        finally:
+            self.token_budget.settle(reserved, used, output_tokens)
+        self._record_call(section, prompt_text, message, queue_wait, latency, attempt, route=route)
+        self._cache_set(self._cache_key(prompt_text, route=route), message.content)
+        return message.content
+
+    async def process_chunk_async(self, summary, chunk, prompt_template, difficulty=None, on_token=None, section=None):
         input_dict = {'summary': summary, 'chunk': chunk}
         if difficulty is not None:
             input_dict['difficulty'] = difficulty
+        return await self._ainvoke(prompt_template, input_dict, on_token, section)
 
-        chain = prompt_template | self.llm
-        return (await chain.ainvoke(input_dict)).content
-
-    def process_chunk_sync(self, summary, chunk, prompt_template, difficulty=None):
+    def process_chunk_sync(self, summary, chunk, prompt_template, difficulty=None, on_token=None, section=None):
         input_dict = {'summary': summary, 'chunk': chunk}
         if difficulty is not None:
             input_dict['difficulty'] = difficulty
-
-        chain = prompt_template | self.llm
-        return chain.invoke(input_dict).content
+        return self._invoke(prompt_template, input_dict, on_token, section)
 
     async def generate_main_explanation_async(self, summary, paper_chunks, difficulty):
-        prompt = PromptTemplate(
-            input_variables=['summary', 'chunk', 'difficulty'],
-            template="Given the following summary of a research paper:\n\n{summary}\n\n"
-                     "Explain the following part of the paper for a {difficulty} level reader:\n\n{chunk}\n\n"
-                     "Provide a clear and concise explanation of the main ideas, methodology, and findings in this part, "
-                     "considering how it fits into the overall paper."
-        )
-        tasks = [self.process_chunk_async(summary, chunk, prompt, difficulty) for chunk in paper_chunks]
+        prompt = self.section_prompt('Main Explanation')
+        tasks = [self.process_chunk_async(summary, chunk, prompt, difficulty, section='Main Explanation') for chunk in paper_chunks]
         return await asyncio.gather(*tasks)
 
     def generate_main_explanation_sync(self, summary, paper_chunks, difficulty):
-        prompt = PromptTemplate(
-            input_variables=['summary', 'chunk', 'difficulty'],
-            template="Given the following summary of a research paper:\n\n{summary}\n\n"
-                     "Explain the following part of the paper for a {difficulty} level reader:\n\n{chunk}\n\n"
-                     "Provide a clear and concise explanation of the main ideas, methodology, and findings in this part, "
-                     "considering how it fits into the overall paper."
-        )
-        return [self.process_chunk_sync(summary, chunk, prompt, difficulty) for chunk in paper_chunks]
+        prompt = self.section_prompt('Main Explanation')
+        return [self.process_chunk_sync(summary, chunk, prompt, difficulty, section='Main Explanation') for chunk in paper_chunks]
 
     async def generate_examples_async(self, summary, paper_chunks):
-        prompt = PromptTemplate(
-            input_variables=["summary", "chunk"],
-            template="Given the following summary of a research paper:\n\n{summary}\n\n"
-                     "Based on this part of the paper:\n\n{chunk}\n\n"
-                     "Provide concrete examples that illustrate the main concepts or findings in this section."
-        )
-        tasks = [self.process_chunk_async(summary, chunk, prompt) for chunk in paper_chunks]
+        prompt = self.section_prompt('Examples')
+        tasks = [self.process_chunk_async(summary, chunk, prompt, section='Examples') for chunk in paper_chunks]
         return await asyncio.gather(*tasks)
 
     def generate_examples_sync(self, summary, paper_chunks):
-        prompt = PromptTemplate(
-            input_variables=["summary", "chunk"],
-            template="Given the following summary of a research paper:\n\n{summary}\n\n"
-                     "Based on this part of the paper:\n\n{chunk}\n\n"
-                     "Provide concrete examples that illustrate the main concepts or findings in this section."
-        )
-        return [self.process_chunk_sync(summary, chunk, prompt) for chunk in paper_chunks]
+        prompt = self.section_prompt('Examples')
+        return [self.process_chunk_sync(summary, chunk, prompt, section='Examples') for chunk in paper_chunks]
 
     async def explain_prerequisites_async(self, summary, paper_chunks):
-        prompt = PromptTemplate(
-            input_variables=["summary", "chunk"],
-            template="Given the following summary of a research paper:\n\n{summary}\n\n"
-                     "For this part of the paper:\n\n{chunk}\n\n"
-                     "Identify and explain the key prerequisites needed to understand this section."
-        )
-        tasks = [self.process_chunk_async(summary, chunk, prompt) for chunk in paper_chunks]
+        prompt = self.section_prompt('Prerequisites')
+        tasks = [self.process_chunk_async(summary, chunk, prompt, section='Prerequisites') for chunk in paper_chunks]
         return await asyncio.gather(*tasks)
 
     def explain_prerequisites_sync(self, summary, paper_chunks):
-        prompt = PromptTemplate(
-            input_variables=["summary", "chunk"],
-            template="Given the following summary of a research paper:\n\n{summary}\n\n"
-                     "For this part of the paper:\n\n{chunk}\n\n"
-                     "Identify and explain the key prerequisites needed to understand this section."
-        )
-        return [self.process_chunk_sync(summary, chunk, prompt) for chunk in paper_chunks]
-
-    async def explain_math_async(self, summary, paper_chunks):
-        prompt = PromptTemplate(
-            input_variables=["summary", "chunk"],
-            template="Given the following summary of a research paper:\n\n{summary}\n\n"
-                     "For this part of the paper:\n\n{chunk}\n\n"
-                     "Explain in detail the key mathematical concepts and equations in this section."
-                     "If no mathematical concept or equations are there return an empty string, don't make up anything up"
-        )
-        tasks = [self.process_chunk_async(summary, chunk, prompt) for chunk in paper_chunks]
-        return await asyncio.gather(*tasks)
+        prompt = self.section_prompt('Prerequisites')
+        return [self.process_chunk_sync(summary, chunk, prompt, section='Prerequisites') for chunk in paper_chunks]
 
-    def explain_math_sync(self, summary, paper_chunks):
-        prompt = PromptTemplate(
-            input_variables=["summary", "chunk"],
-            template="Given the following summary of a research paper:\n\n{summary}\n\n"
-                     "For this part of the paper:\n\n{chunk}\n\n"
-                     "Explain in detail the key mathematical concepts and equations in this section."
-                     "If no mathematical concept or equations are there return an empty string, don't make up anything up"
-        )
-        return [self.process_chunk_sync(summary, chunk, prompt) for chunk in paper_chunks]
-
-    async def generate_search_query(self, summary):
-        prompt = PromptTemplate(
-            input_variables=["summary"],
-            template="Based on the following summary of a research paper, suggest keywords for finding similar papers:\n\n{summary}\n\nKeywords:"
-        )
-        websearch_prompt = PromptTemplate(
-            input_variables=['keywords'],
-            template="Based on {keywords} make an web search optimized query for searching similar research papers on site:arxiv.org OR site:scholar.google.com"
-        )
-        chain = prompt | self.llm | websearch_prompt | self.llm
-        keywords = await chain.ainvoke({'summary': summary})
-        return keywords.content
-
-    async def find_similar_papers_async(self, summary, include_summary=False):
-        search_query = await self.generate_search_query(summary)
-        search_results = await self.search.arun(search_query)
-
-        if include_summary:
-            prompt = PromptTemplate(
-                input_variables=["summary", "search_results"],
-                template="Given this summary of a research paper:\n\n{summary}\n\n"
-                         "And based on the following search results, provide a brief summary of 2-3 similar research papers:\n\n{search_results}"
-            )
-            chain = prompt | self.llm
-            return (await chain.ainvoke({'summary': summary, 'search_results': search_results})).content
-
-        return search_results
-
-    def find_similar_papers_sync(self, summary, include_summary=False):
-        search_query = self.generate_search_query(summary)
-        search_results = self.search.run(search_query)
-
-        if include_summary:
-            prompt = PromptTemplate(
-                input_variables=["summary", "search_results"],
-                template="Given this summary of a research paper:\n\n{summary}\n\n"
-                         "And based on the following search results, provide a brief summary of 2-3 similar research papers:\n\n{search_results}"
-            )
-            chain = prompt | self.llm
-            return chain.invoke({'summary': summary, 'search_results': search_results}).content
-
-        return search_results
+    async def explain_math_async(self, summary, paper_chunks, skip_chunks=True):
+        '''
+        With skip_chunks (the pipeline's option of the same name), chunks
+        without math get "" instead of a request.
+        '''
+        prompt = self.section_prompt('Mathematical Concepts')
 
-    def combine_explanations(self, summary, explanations, paper_chunks):
-        combined_text = f"# Paper Summary\n\n{summary}\n\n"
+        async def explain(chunk):
+            # The prompt asks for an empty answer on chunks without math, so don't ask
+            if skip_chunks and not ChunkClassifier.has_math(chunk):
+                self.telemetry.record_skip('Mathematical Concepts')
+                return ""
+            return await self.process_chunk_async(summary, chunk, prompt, section='Mathematical Concepts')
 
-        for i, chunk in enumerate(paper_chunks):
-            combined_text += f"\n\n## Chunk {i+1}\n\n"
-            combined_text += f"{chunk}\n\n"
+        return await asyncio.gather(*[explain(chunk) for chunk in paper_chunks])
+
+    def explain_math_sync(self, summary, paper_chunks, skip_chunks=True):
+        prompt = self.section_prompt('Mathematical Concepts')
+        explanations = []
+        for chunk in paper_chunks:
+            if skip_chunks and not ChunkClassifier.has_math(chunk):
+                self.telemetry.record_skip('Mathematical Concepts')
+                explanations.append("")
+            else:
+                explanations.append(self.process_chunk_sync(summary, chunk, prompt, section='Mathematical Concepts'))
+        return explanations
+
+    async def process_chunk_fused_async(self, summary, chunk, sections, difficulty):
+        response = await self.process_chunk_async(summary, chunk, self.fused_prompt(sections), difficulty, section='Fused')
+        parsed = parse_fused_response(response, sections)
+
+        missing = [section for section in sections if section not in parsed]
+        results = await asyncio.gather(*[self.process_chunk_async(summary, chunk, self.section_prompt(section), difficulty, section=section)
+                                         for section in missing])
+        parsed.update(zip(missing, results))
+        return parsed
+
+    def process_chunk_fused_sync(self, summary, chunk, sections, difficulty):
+        response = self.process_chunk_sync(summary, chunk, self.fused_prompt(sections), difficulty, section='Fused')
+        parsed = parse_fused_response(response, sections)
+
+        for section in sections:
+            if section not in parsed:
+                parsed[section] = self.process_chunk_sync(summary, chunk, self.section_prompt(section), difficulty, section=section)
+        return parsed
+
+    async def generate_fused_async(self, summary, paper_chunks, sections, difficulty):
+        tasks = [self.process_chunk_fused_async(summary, chunk, sections, difficulty) for chunk in paper_chunks]
+        results = await asyncio.gather(*tasks)
+        return {section: [result[section] for result in results] for section in sections}
+
+    def generate_fused_sync(self, summary, paper_chunks, sections, difficulty):
+        results = [self.process_chunk_fused_sync(summary, chunk, sections, difficulty) for chunk in paper_chunks]
+        return {section: [result[section] for result in results] for section in sections}
+
+    @staticmethod
+    def _group_pending(pending):
+        # (chunk_index, section) pairs -> {chunk_index: [sections]}, in chunk order
+        grouped = {}
+        for index, section in sorted(pending, key=lambda pair: pair[0]):
+            grouped.setdefault(index, []).append(section)
+        return grouped
 
-            if "Prerequisites" in explanations:
-                combined_text += f"### Prerequisites\n\n{explanations['Prerequisites'][i]}\n\n"
+    async def iter_explanations_async(self, summary, paper_chunks, sections, difficulty, fused=False, on_token=None,
+                                      on_error=None, pending=None):
+        '''
+        Yields (chunk_index, {section: text}) as soon as each request finishes,
+        in completion order. With fused=True there is one event per chunk holding
+        all of its sections. on_token(chunk_index, section, partial_text) receives
+        token-level updates for non-fused requests.
+        With on_error(chunk_index, sections, error) a request that still fails
+        after retries is reported there and yields (chunk_index, {}) instead of
+        aborting the other requests. pending restricts the run to the given
+        (chunk_index, section) pairs; fused runs group them per chunk.
+        '''
+        async def guarded(index, failed_sections, request):
+            try:
+                return index, await request
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(index, failed_sections, e)
+                return index, {}
 
-            combined_text += f"### Explanation\n\n{explanations['Main Explanation'][i]}\n\n"
+        async def explain(index, section):
+            stream = None if on_token is None else (lambda partial: on_token(index, section, partial))
+            text = await self.process_chunk_async(summary, paper_chunks[index], self.section_prompt(section), difficulty, stream, section)
+            return {section: text}
 
-            if "Examples" in explanations:
-                combined_text += f"### Examples\n\n{explanations['Examples'][i]}\n\n"
+        if pending is None:
+            pending = [(index, section) for index in range(len(paper_chunks)) for section in sections]
+        if fused:
+            tasks = [guarded(index, chunk_sections, self.process_chunk_fused_async(summary, paper_chunks[index], chunk_sections, difficulty))
+                     for index, chunk_sections in self._group_pending(pending).items()]
+        else:
+            tasks = [guarded(index, [section], explain(index, section)) for index, section in pending]
 
-            if "Mathematical Concepts" in explanations:
-                math_content = explanations['Mathematical Concepts'][i]
-                if math_content.strip():  # Only include if there's actual content
-                    combined_text += f"### Mathematical Concepts\n\n{math_content}\n\n"
+        if self.prefix_prompts and len(tasks) > 1:
+            # Let the first request write the provider's prefix cache before the others read it
+            yield await tasks.pop(0)
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
 
-        if "Similar Papers" in explanations:
-            combined_text += f"# Similar Papers\n\n{explanations['Similar Papers']}\n\n"
+    def iter_explanations_sync(self, summary, paper_chunks, sections, difficulty, fused=False, on_token=None,
+                               on_error=None, pending=None):
+        if pending is None:
+            pending = [(index, section) for index in range(len(paper_chunks)) for section in sections]
+        if fused:
+            requests = list(self._group_pending(pending).items())
+        else:
+            requests = [(index, [section]) for index, section in pending]
+
+        for index, request_sections in requests:
+            chunk = paper_chunks[index]
+            try:
+                if fused:
+                    results = self.process_chunk_fused_sync(summary, chunk, request_sections, difficulty)
+                else:
+                    section = request_sections[0]
+                    stream = None if on_token is None else (lambda partial: on_token(index, section, partial))
+                    results = {section: self.process_chunk_sync(summary, chunk, self.section_prompt(section), difficulty, stream, section)}
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(index, request_sections, e)
+                results = {}
+            yield index, results
+
+    def similar_papers(self, summary, exclude=None, k=SIMILAR_PAPERS):
+        '''
+        Top-k papers from the local index that match the summary, excluding
+        the paper itself. No LLM request is made.
+        '''
+        if self.paper_index is None:
+            return []
+        return self.paper_index.search(summary, k=k, exclude=exclude)
+
+    @staticmethod
+    def format_similar_papers(hits):
+        if not hits:
+            return "No similar papers found among the papers processed so far."
+        return "\n".join(f"- **{hit['title'] or hit['paper_id'][:12]}** (score {hit['score']:.2f}): "
+                         f"{' '.join(hit['snippet'].split())}..." for hit in hits)
+
+    async def find_similar_papers_async(self, summary, include_summary=False, exclude=None):
+        hits = self.similar_papers(summary, exclude)
+        if include_summary and hits:
+            search_results = self.format_similar_papers(hits)
+            overview = await self._ainvoke(SIMILAR_PAPERS_PROMPT, {'summary': summary, 'search_results': search_results},
+                                           section='Similar Papers')
+            return f"{overview}\n\n{search_results}"
+        return self.format_similar_papers(hits)
+
+    def find_similar_papers_sync(self, summary, include_summary=False, exclude=None):
+        hits = self.similar_papers(summary, exclude)
+        if include_summary and hits:
+            search_results = self.format_similar_papers(hits)
+            overview = self._invoke(SIMILAR_PAPERS_PROMPT, {'summary': summary, 'search_results': search_results},
+                                    section='Similar Papers')
+            return f"{overview}\n\n{search_results}"
+        return self.format_similar_papers(hits)
+
+    def combine_explanations(self, summary, explanations, paper_chunks):
+        chunks = []
+        for i, chunk in enumerate(paper_chunks):
+            result = ChunkResult(i, chunk)
+            for section in SECTION_PROMPTS:
+                if section in explanations:
+                    result.set(section, explanations[section][i])
+            chunks.append(result)
 
-        return combined_text
\ No newline at end of file
+        return PaperResult(summary, chunks, similar_papers=explanations.get('Similar Papers'))
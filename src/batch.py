@@ -0,0 +1,369 @@
+'''
+Headless batch processing of many papers.
+
+Explains every PDF in a directory (or listed in a manifest, one path per
+line) and writes one JSON result per paper to the output directory. Papers
+run concurrently but all of their requests share one rate limiter, so
+throughput is bounded by the provider quota. Rerunning the same command
+skips papers that already have a complete result, re-requests only the
+failed sections of partial ones, and resumes papers that were interrupted
+mid-way from their checkpoints. With --batch-api (OpenAI and Anthropic
+models), the explanation requests of all papers are sent as provider batch
+jobs at about half the price; results can take hours.
+
+    python src/batch.py papers/ --model gpt-4o-mini --output-dir explained/
+    python src/batch.py reading_list.txt --model llama3-8b-8192 --examples --math
+    python src/batch.py papers/ --model gpt-4o-mini --batch-api
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from LLMSelect import MODEL_PROVIDERS, LLMSelector
+from bundle import BundleLibrary
+from checkpoint import CheckpointStore
+from llmCache import LLMCache
+from paperIndex import PaperIndex
+from pipeline import ExplanationPipeline, create_generator
+from planner import RunPlanner
+from preprocessor import PaperPreprocessor
+from providerBatch import BATCH_CLIENTS, POLL_INTERVAL, ProviderBatchRunner
+from results import PaperResult
+from streaming import ResultStreamWriter, StreamingPipeline, read_stream_ends
+from telemetry import Telemetry
+
+
+def collect_papers(source):
+    '''
+    PDF paths from a directory (searched recursively) or a manifest file with
+    one path per line; relative manifest paths are resolved against the
+    manifest's directory and lines starting with # are ignored.
+    '''
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            paths.extend(os.path.join(root, name) for name in files if name.lower().endswith('.pdf'))
+        return sorted(paths)
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base, line) for line in lines if line and not line.startswith('#')]
+
+
+def result_path(output_dir, pdf_path, digest):
+    # The content hash keeps papers with the same file name apart
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    return os.path.join(output_dir, f"{stem}-{digest[:12]}.json")
+
+
+def load_result(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return PaperResult.from_json(f.read())
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_result(path, result, markdown=False):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(result.to_json())
+    os.replace(tmp_path, path)
+    if markdown:
+        with open(os.path.splitext(path)[0] + '.md', 'w', encoding='utf-8') as f:
+            f.write(result.to_markdown())
+
+
+def parse_fallback(value):
+    # "model" with the provider inferred, or "provider:model"
+    provider, _, model = value.rpartition(':')
+    return provider or MODEL_PROVIDERS[model], model
+
+
+class BatchRunner:
+    '''
+    Runs ExplanationPipeline over many papers with at most `max_papers` in
+    flight. Every paper gets its own generator (and so its own retry budget)
+    but shares the LLM client, response cache, rate limiter and telemetry.
+    '''
+    def __init__(self, args):
+        self.args = args
+        self.api_provider = args.provider or MODEL_PROVIDERS[args.model]
+        self.llm = LLMSelector.get_llm(self.api_provider, args.model)
+        self.cache = None if args.no_cache else LLMCache()
+        self.checkpoints = None if args.no_checkpoints else CheckpointStore()
+        self.paper_index = None if args.no_index else PaperIndex()
+        self.library = BundleLibrary() if args.library else None
+        self.telemetry = Telemetry()
+        self.rate_limits = {'rpm': args.rpm, 'tpm': args.tpm, 'max_concurrency': args.max_concurrency}
+        self.fallbacks = [parse_fallback(value) for value in args.fallback]
+        self.options = {
+            'difficulty': args.difficulty,
+            'include_examples': args.examples,
+            'explain_prereq': args.prereq,
+            'explain_math': args.math,
+            'fused': args.fused,
+            'skip_chunks': not args.no_skip,
+            'prefix_prompts': args.prefix_prompts,
+            'speculative': args.speculative,
+            'speculative_rerun': args.speculative_rerun,
+            'find_similar_papers': args.similar,
+            'include_paper_summary': args.similar_summary,
+        }
+        self.counts = {'done': 0, 'skipped': 0, 'partial': 0, 'failed': 0}
+
+    def create_pipeline(self, pdf_path, digest):
+        generator = create_generator(self.api_provider, self.args.model, self.rate_limits, self.cache,
+                                     llm=self.llm, telemetry=self.telemetry, fallbacks=self.fallbacks,
+                                     hedge_budget=self.args.hedge_budget, token_budget=self.args.token_budget,
+                                     prefix_prompts=self.args.prefix_prompts, paper_index=self.paper_index)
+        metadata = {'file_name': os.path.basename(pdf_path), 'source_path': pdf_path, 'content_hash': digest}
+        if self.args.stream:
+            return StreamingPipeline(generator, self.options, self.args.summarization_method, metadata=metadata)
+        return ExplanationPipeline(generator, self.options, self.args.summarization_method, metadata=metadata,
+                                   checkpoints=self.checkpoints)
+
+    def save(self, path, result):
+        write_result(path, result, self.args.markdown)
+        if self.library is not None:
+            self.library.save(result)
+
+    def matches(self, metadata, pipeline):
+        return (metadata.get('model_name') == self.args.model and metadata.get('difficulty') == self.args.difficulty
+                and metadata.get('sections') == pipeline.sections)
+
+    async def process(self, pdf_path):
+        with open(pdf_path, 'rb') as f:
+            pdf_bytes = f.read()
+        digest = PaperPreprocessor.content_hash(pdf_bytes)
+        path = result_path(self.args.output_dir, pdf_path, digest)
+        pipeline = self.create_pipeline(pdf_path, digest)
+        if self.args.stream:
+            return await self.process_stream(pipeline, pdf_bytes, os.path.splitext(path)[0] + '.jsonl')
+
+        result = load_result(path)
+        if result is not None and not self.matches(result.metadata, pipeline):
+            # Written by a run with other settings; start over rather than mixing results
+            result = None
+        if result is not None and not result.failed_sections():
+            self.counts['skipped'] += 1
+            return 'skipped'
+
+        if result is not None:
+            await pipeline.retry_failed_async(result)
+        else:
+            with self.telemetry.stage('pdf_extraction'):
+                paper_text = await asyncio.to_thread(PaperPreprocessor.extract_text_from_bytes, pdf_bytes)
+            result = await pipeline.run_async(paper_text)
+
+        self.save(path, result)
+        status = 'partial' if result.failed_sections() else 'done'
+        self.counts[status] += 1
+        return status
+
+    async def process_stream(self, pipeline, pdf_bytes, path):
+        # A streamed result is only written once complete; one with failed sections is redone
+        # (its successful responses come from the response cache)
+        ends = read_stream_ends(path)
+        if ends is not None and self.matches(ends[0]['metadata'], pipeline) and not ends[1]['failed_sections']:
+            self.counts['skipped'] += 1
+            return 'skipped'
+
+        writer = ResultStreamWriter(path, os.path.splitext(path)[0] + '.md' if self.args.markdown else None)
+        try:
+            await pipeline.run_async(PaperPreprocessor.iter_pages(pdf_bytes), writer)
+        except BaseException:
+            writer.abort()
+            raise
+        status = 'partial' if writer.failed_sections else 'done'
+        self.counts[status] += 1
+        return status
+
+    def _failed(self, error):
+        self.counts['failed'] += 1
+        return f"failed ({type(error).__name__}: {error})"
+
+    async def run(self, paths):
+        if self.args.batch_api:
+            return await self.run_provider_batch(paths)
+        semaphore = asyncio.Semaphore(self.args.max_papers)
+        start = time.perf_counter()
+
+        async def run_one(number, pdf_path):
+            async with semaphore:
+                try:
+                    status = await self.process(pdf_path)
+                except Exception as e:
+                    status = self._failed(e)
+                print(f"[{number}/{len(paths)}] {pdf_path}: {status} ({time.perf_counter() - start:.0f}s)", file=sys.stderr)
+
+        await asyncio.gather(*[run_one(number, path) for number, path in enumerate(paths, 1)])
+        return self.counts
+
+    async def run_provider_batch(self, paths):
+        '''
+        Sends the explanation requests of every paper that needs them as
+        provider batch jobs. Failed sections of partial results are retried live.
+        '''
+        start = time.perf_counter()
+        papers, targets = [], []
+
+        def report(number, pdf_path, status):
+            print(f"[{number}/{len(paths)}] {pdf_path}: {status} ({time.perf_counter() - start:.0f}s)", file=sys.stderr)
+
+        for number, pdf_path in enumerate(paths, 1):
+            try:
+                with open(pdf_path, 'rb') as f:
+                    pdf_bytes = f.read()
+                digest = PaperPreprocessor.content_hash(pdf_bytes)
+                path = result_path(self.args.output_dir, pdf_path, digest)
+                pipeline = self.create_pipeline(pdf_path, digest)
+                result = load_result(path)
+                if result is not None and self.matches(result.metadata, pipeline):
+                    if not result.failed_sections():
+                        status = 'skipped'
+                    else:
+                        await pipeline.retry_failed_async(result)
+                        self.save(path, result)
+                        status = 'partial' if result.failed_sections() else 'done'
+                    self.counts[status] += 1
+                    report(number, pdf_path, status)
+                    continue
+                with self.telemetry.stage('pdf_extraction'):
+                    paper_text = await asyncio.to_thread(PaperPreprocessor.extract_text_from_bytes, pdf_bytes)
+            except Exception as e:
+                report(number, pdf_path, self._failed(e))
+                continue
+            papers.append((pipeline, paper_text))
+            targets.append((number, pdf_path, path))
+
+        runner = ProviderBatchRunner(poll_interval=self.args.poll_interval, max_papers=self.args.max_papers,
+                                     on_status=lambda message: print(message, file=sys.stderr))
+        outcomes = await runner.run_async(papers) if papers else []
+        for (number, pdf_path, path), outcome in zip(targets, outcomes):
+            if isinstance(outcome, BaseException):
+                status = self._failed(outcome)
+            else:
+                self.save(path, outcome)
+                status = 'partial' if outcome.failed_sections() else 'done'
+                self.counts[status] += 1
+            report(number, pdf_path, status)
+        return self.counts
+
+
+def print_plan(args, paths):
+    options = {
+        'difficulty': args.difficulty,
+        'include_examples': args.examples,
+        'explain_prereq': args.prereq,
+        'explain_math': args.math,
+        'fused': args.fused,
+        'skip_chunks': not args.no_skip,
+        'prefix_prompts': args.prefix_prompts,
+    }
+    rate_limits = {'rpm': args.rpm, 'tpm': args.tpm, 'max_concurrency': args.max_concurrency}
+    planner = RunPlanner(args.provider or MODEL_PROVIDERS[args.model], args.model, options, rate_limits)
+    totals = {'requests': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0}
+    for pdf_path in paths:
+        try:
+            with open(pdf_path, 'rb') as f:
+                paper_text = PaperPreprocessor.extract_text_from_bytes(f.read())
+        except Exception as e:
+            print(f"{pdf_path}: failed ({type(e).__name__}: {e})")
+            continue
+        plan = planner.plan(paper_text, args.summarization_method)
+        cost = "unknown cost" if plan['cost'] is None else f"${plan['cost']:.4f}"
+        print(f"{pdf_path}: {plan['requests']} requests, {plan['input_tokens']} input / {plan['output_tokens']} output tokens, "
+              f"~{plan['wall_time']:.0f}s, {cost}")
+        for name in ('requests', 'input_tokens', 'output_tokens'):
+            totals[name] += plan[name]
+        totals['cost'] = None if plan['cost'] is None or totals['cost'] is None else totals['cost'] + plan['cost']
+    cost = "unknown cost" if totals['cost'] is None else f"${totals['cost']:.4f}"
+    print(f"Total: {totals['requests']} requests, {totals['input_tokens']} input / {totals['output_tokens']} output tokens, {cost}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Explain a directory or manifest of research papers")
+    parser.add_argument('source', help="directory of PDFs or manifest file with one PDF path per line")
+    parser.add_argument('--output-dir', default='explained', help="one <name>-<hash>.json result per paper is written here")
+    parser.add_argument('--model', default='llama3-8b-8192')
+    parser.add_argument('--provider', help="API provider, inferred from the model name by default")
+    parser.add_argument('--fallback', action='append', default=[], metavar='[PROVIDER:]MODEL',
+                        help="equivalent model used when the primary one errors; repeat for more, in order")
+    parser.add_argument('--hedge-budget', type=float, default=0.0,
+                        help="share of requests that may also be sent to the first fallback when the primary is slow")
+    parser.add_argument('--difficulty', default='Graduate', choices=["High School", "Undergraduate", "Graduate", "Expert"])
+    parser.add_argument('--examples', action='store_true', help="include examples")
+    parser.add_argument('--prereq', action='store_true', help="explain prerequisites")
+    parser.add_argument('--math', action='store_true', help="explain mathematical concepts")
+    parser.add_argument('--fused', action='store_true', help="use fused one-call-per-chunk requests")
+    parser.add_argument('--no-skip', action='store_true', help="also explain reference lists and request math for chunks without math")
+    parser.add_argument('--prefix-prompts', action='store_true',
+                        help="put the instructions and summary first in every request so providers can cache them")
+    parser.add_argument('--speculative', action='store_true',
+                        help="explain chunks from the abstract and introduction while the summary is written")
+    parser.add_argument('--speculative-rerun', action='store_true',
+                        help="with --speculative, request those sections again once the summary is ready")
+    parser.add_argument('--summarization-method', default='map_reduce', choices=['map_reduce', 'refine', 'stuff'])
+    parser.add_argument('--max-papers', type=int, default=4, help="papers processed concurrently")
+    parser.add_argument('--rpm', type=int, help="requests per minute for all papers together (default: provider tier, 0 = unlimited)")
+    parser.add_argument('--tpm', type=int, help="tokens per minute for all papers together (default: provider tier, 0 = unlimited)")
+    parser.add_argument('--max-concurrency', type=int, help="concurrent requests for all papers together (default: provider tier, 0 = unlimited)")
+    parser.add_argument('--token-budget', type=int, help="hard cap on the tokens one paper may use; requests beyond it fail")
+    parser.add_argument('--plan', action='store_true', help="only estimate requests, tokens, time and cost, then exit")
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the response cache")
+    parser.add_argument('--no-checkpoints', action='store_true', help="don't checkpoint partial results to resume interrupted papers")
+    parser.add_argument('--similar', action='store_true',
+                        help="list similar papers from the local index of papers processed so far")
+    parser.add_argument('--similar-summary', action='store_true', help="with --similar, also summarize them (one request)")
+    parser.add_argument('--no-index', action='store_true', help="don't add papers to or search the local paper index")
+    parser.add_argument('--stream', action='store_true',
+                        help="bounded-memory mode for very long documents: results are written as <name>-<hash>.jsonl while "
+                             "chunks finish (no checkpoints or similar papers, map_reduce or refine only)")
+    parser.add_argument('--batch-api', action='store_true',
+                        help="send the explanation requests of all papers as provider batch jobs (OpenAI and Anthropic models): "
+                             "about half the price, results within 24 hours; failed requests are retried live")
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL, help="seconds between batch status checks")
+    parser.add_argument('--markdown', action='store_true', help="also write a Markdown rendering next to each result")
+    parser.add_argument('--library', action='store_true',
+                        help="also save each result to the app's library of explained papers (not with --stream)")
+    parser.add_argument('--stats', help="write run telemetry as JSON here")
+    args = parser.parse_args(argv)
+    if args.provider is None and args.model not in MODEL_PROVIDERS:
+        parser.error(f"unknown model {args.model}, pass --provider")
+    unknown = [value for value in args.fallback if ':' not in value and value not in MODEL_PROVIDERS]
+    if unknown:
+        parser.error(f"unknown fallback model {', '.join(unknown)}")
+    if args.stream and args.summarization_method == 'stuff':
+        parser.error("--stream needs --summarization-method map_reduce or refine")
+    if args.library and args.stream:
+        parser.error("--library can't be combined with --stream")
+    if args.batch_api and (args.stream or args.speculative):
+        parser.error("--batch-api can't be combined with --stream or --speculative")
+    if args.batch_api and (args.provider or MODEL_PROVIDERS[args.model]) not in BATCH_CLIENTS:
+        parser.error(f"--batch-api needs a model from {' or '.join(BATCH_CLIENTS)}")
+
+    paths = collect_papers(args.source)
+    if not paths:
+        print(f"No PDFs found in {args.source}", file=sys.stderr)
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.plan:
+        return print_plan(args, paths)
+
+    runner = BatchRunner(args)
+    counts = asyncio.run(runner.run(paths))
+    print(", ".join(f"{count} {status}" for status, count in counts.items()), file=sys.stderr)
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            f.write(runner.telemetry.to_json())
+    return 1 if counts['failed'] or counts['partial'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
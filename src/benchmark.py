@@ -0,0 +1,282 @@
+'''
+Offline benchmark for the explanation pipeline.
+
+Runs the async, sync and streaming pipelines headless against FakeChatModel over
+generated PDFs of different sizes and reports wall time, calls/sec, peak
+concurrency, peak memory and time to first chunk as JSON. No API keys or
+network access are needed.
+
+    python src/benchmark.py --pages 5 20 60 --output bench.json
+    python src/benchmark.py --pages 5 20 60 --baseline bench.json
+
+--startup also measures, in fresh interpreters, how long importing the
+pipeline takes and how long the first and a cached LLM client take to create.
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from LLMSelect import MODEL_PROVIDERS
+from asyncExplainer import AsyncExplanationGenerator
+from fakeLLM import FakeChatModel
+from pipeline import ExplanationPipeline
+from preprocessor import PageCache, PaperPreprocessor
+from rateLimiter import RateLimiter
+from streaming import ResultStreamWriter, StreamingPipeline
+
+WORDS = ("we propose a novel method for training deep networks with attention layers and evaluate it on "
+         "several benchmarks showing improved accuracy over strong baselines while reducing compute").split()
+MATH_LINES = ["L(theta) = sum_i log p(y_i | x_i; theta) + lambda ||theta||^2",
+              "where alpha in [0, 1] and sigma(x) = 1 / (1 + exp(-x))"]
+
+# Metrics where lower is better, compared against the baseline
+COMPARED_METRICS = ['wall_time', 'time_to_first_chunk', 'peak_memory_mb']
+STARTUP_METRICS = ['import_time', 'first_client_time']
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import jobs, pipeline
+imported = time.perf_counter()
+from LLMSelect import LLMSelector
+LLMSelector.get_llm(sys.argv[1], sys.argv[2])
+created = time.perf_counter()
+LLMSelector.get_llm(sys.argv[1], sys.argv[2])
+print(json.dumps({'import_time': imported - start, 'first_client_time': created - imported,
+                  'cached_client_time': time.perf_counter() - created}))
+'''
+# Clients only need a key to be constructed; nothing is sent
+DUMMY_API_KEYS = ('GROQ_API_KEY', 'GOOGLE_API_KEY', 'OPENAI_API_KEY', 'ANTHROPIC_API_KEY', 'MISTRAL_API_KEY')
+
+
+def make_pdf(page_texts):
+    '''
+    Minimal single-font PDF writer, enough for PyPDF2 to extract the text back.
+    '''
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(page_texts)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(page_texts)} >>")
+    font_id = 3 + 2 * len(page_texts)
+    for i, text in enumerate(page_texts):
+        lines = (line.replace("\\", "").replace("(", "").replace(")", "") for line in text.split("\n"))
+        stream = "BT /F1 10 Tf 40 800 Td 12 TL " + " ".join(f"({line}) '" for line in lines) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Contents {4 + 2 * i} 0 R "
+                       f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    parts, offsets, position = [], [], 0
+    header = "%PDF-1.4\n"
+    parts.append(header)
+    position += len(header)
+    for number, body in enumerate(objects, 1):
+        offsets.append(position)
+        entry = f"{number} 0 obj\n{body}\nendobj\n"
+        parts.append(entry)
+        position += len(entry)
+    parts.append(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n")
+    parts.extend(f"{offset:010d} 00000 n \n" for offset in offsets)
+    parts.append(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{position}\n%%EOF\n")
+    return "".join(parts).encode('latin-1')
+
+
+def generate_paper(pages, seed=0, lines_per_page=55):
+    rng = random.Random(seed * 100003 + pages)
+    page_texts = []
+    for page in range(pages):
+        lines = [f"Section {page + 1}"]
+        for line in range(lines_per_page):
+            if line % 15 == 14:
+                lines.append(rng.choice(MATH_LINES))
+            else:
+                lines.append(" ".join(rng.choice(WORDS) for _ in range(14)))
+        page_texts.append("\n".join(lines))
+    return make_pdf(page_texts)
+
+
+def run_once(pdf_bytes, pages, mode, args):
+    llm = FakeChatModel(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        output_tokens=args.output_tokens, seed=args.seed,
+                        # Fake summaries are far shorter than real ones, so count any repeated prefix
+                        prefix_caching=True, min_cache_tokens=0)
+    rate_limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm, max_concurrency=args.max_concurrency)
+    generator = AsyncExplanationGenerator(llm, rate_limiter=rate_limiter, api_provider='fake', model_name=args.model,
+                                          prefix_prompts=args.prefix_prompts)
+    options = {
+        'difficulty': 'Graduate',
+        'include_examples': True,
+        'explain_prereq': True,
+        'explain_math': True,
+        'fused': args.fused,
+    }
+    pipeline = ExplanationPipeline(generator, options, args.summarization_method)
+    PaperPreprocessor.page_cache = PageCache(tempfile.mkdtemp(prefix="bench-pages-"))
+
+    state = {'result': None, 'first_chunk': None}
+
+    def on_start(result):
+        state['result'] = result
+
+    def on_result(index, results):
+        if state['first_chunk'] is None and state['result'].chunks[index].has_sections(pipeline.sections):
+            state['first_chunk'] = time.perf_counter() - start
+
+    def on_chunk(chunk):
+        if state['first_chunk'] is None:
+            state['first_chunk'] = time.perf_counter() - start
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    run = {'pages': pages, 'mode': mode}
+    try:
+        if mode == 'stream':
+            # Pages are extracted while the summary is written, so there is no separate extraction time
+            writer = ResultStreamWriter(os.path.join(tempfile.mkdtemp(prefix="bench-stream-"), 'result.jsonl'))
+            streaming = StreamingPipeline(generator, options, args.summarization_method)
+            asyncio.run(streaming.run_async(PaperPreprocessor.iter_pages(pdf_bytes), writer, on_chunk=on_chunk))
+            run.update(chunks=writer.chunks, failed_sections=writer.failed_sections, skipped_calls=writer.skipped_sections)
+        else:
+            paper_text = PaperPreprocessor.extract_text_from_bytes(pdf_bytes)
+            run['extraction_time'] = time.perf_counter() - start
+            if mode == 'async':
+                result = asyncio.run(pipeline.run_async(paper_text, on_start=on_start, on_result=on_result))
+            else:
+                result = pipeline.run_sync(paper_text, on_start=on_start, on_result=on_result)
+            run['chunks'] = len(result.chunks)
+            run['failed_sections'] = len(result.failed_sections())
+            run['skipped_calls'] = len(result.skipped_sections())
+    except Exception as e:
+        run['error'] = f"{type(e).__name__}: {e}"
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = llm.stats()
+    rows = generator.telemetry.summary()
+    run.update({
+        'wall_time': wall_time,
+        'calls': stats['calls'],
+        'errors': stats['errors'],
+        'calls_per_sec': stats['calls'] / wall_time if wall_time else 0.0,
+        'peak_concurrency': stats['peak_concurrency'],
+        'peak_memory_mb': peak_memory / 1e6,
+        'time_to_first_chunk': state['first_chunk'],
+        'input_tokens': sum(row['input_tokens'] for row in rows),
+        'output_tokens': sum(row['output_tokens'] for row in rows),
+        'cache_read_tokens': sum(row['cache_read_tokens'] for row in rows),
+        'queue_wait': sum(row['total_queue_wait'] for row in rows),
+        'retries': sum(row['retries'] for row in rows),
+    })
+    return run
+
+
+def measure_startup(model_name, repeats=3):
+    env = dict(os.environ)
+    for name in DUMMY_API_KEYS:
+        env.setdefault(name, 'dummy')
+    api_provider = MODEL_PROVIDERS.get(model_name, 'fake')
+    samples = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, api_provider, model_name], env=env, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout
+        samples.append(json.loads(output))
+    startup = {'model': model_name, 'api_provider': api_provider}
+    startup.update({metric: statistics.median(sample[metric] for sample in samples) for metric in samples[0]})
+    return startup
+
+
+def compare(baseline, current, tolerance):
+    '''
+    Returns (report lines, regressions) for runs present in both reports.
+    '''
+    baseline_runs = {(run['pages'], run['mode']): run for run in baseline['runs']}
+    lines, regressions = [], []
+    for run in current['runs']:
+        base = baseline_runs.get((run['pages'], run['mode']))
+        if base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if not base.get(metric) or run.get(metric) is None:
+                continue
+            ratio = run[metric] / base[metric]
+            line = f"{run['mode']:>5} {run['pages']:>4}p {metric:<20} {base[metric]:10.3f} -> {run[metric]:10.3f} ({ratio:.2f}x)"
+            lines.append(line)
+            if ratio > 1 + tolerance:
+                regressions.append(line)
+
+    base, run = baseline.get('startup'), current.get('startup')
+    if base and run:
+        for metric in STARTUP_METRICS:
+            ratio = run[metric] / base[metric]
+            line = f"startup {metric:<20} {base[metric]:10.3f} -> {run[metric]:10.3f} ({ratio:.2f}x)"
+            lines.append(line)
+            if ratio > 1 + tolerance:
+                regressions.append(line)
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline throughput/latency benchmark with a fake LLM")
+    parser.add_argument('--pages', type=int, nargs='*', default=[5, 20, 60], help="corpus of generated PDFs, by page count")
+    parser.add_argument('--modes', nargs='+', default=['async', 'sync'], choices=['async', 'sync', 'stream'],
+                        help="stream runs the bounded-memory StreamingPipeline (async)")
+    parser.add_argument('--model', default='llama3-8b-8192', help="model whose chunk budget is used")
+    parser.add_argument('--summarization-method', default='map_reduce', choices=['map_reduce', 'refine', 'stuff'])
+    parser.add_argument('--fused', action='store_true', help="use fused one-call-per-chunk requests")
+    parser.add_argument('--prefix-prompts', action='store_true', help="use the prefix-cache-friendly prompt layout")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per fake call")
+    parser.add_argument('--jitter', type=float, default=0.02, help="+/- seconds of latency jitter")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls failing with a 429")
+    parser.add_argument('--output-tokens', type=int, default=200)
+    parser.add_argument('--rpm', type=int, default=0)
+    parser.add_argument('--tpm', type=int, default=0)
+    parser.add_argument('--max-concurrency', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--startup', action='store_true', help="also measure import and LLM client creation time")
+    parser.add_argument('--startup-model', default='gpt-4o-mini', help="model whose client creation is measured")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--baseline', help="JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed slowdown before a metric counts as a regression")
+    args = parser.parse_args(argv)
+
+    report = {'config': vars(args), 'runs': []}
+    if args.startup:
+        report['startup'] = measure_startup(args.startup_model)
+        print(f"startup: import {report['startup']['import_time']:.2f}s, first client {report['startup']['first_client_time']:.2f}s, "
+              f"cached client {report['startup']['cached_client_time'] * 1000:.2f}ms", file=sys.stderr)
+    for pages in args.pages:
+        pdf_bytes = generate_paper(pages, args.seed)
+        for mode in args.modes:
+            run = run_once(pdf_bytes, pages, mode, args)
+            report['runs'].append(run)
+            print(f"{mode:>5} {pages:>4} pages: {run['wall_time']:.2f}s, {run['calls']} calls, "
+                  f"{run['calls_per_sec']:.1f} calls/s, peak concurrency {run['peak_concurrency']}", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(baseline, report, args.tolerance)
+        print("\n".join(lines), file=sys.stderr)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
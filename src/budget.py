@@ -0,0 +1,110 @@
+import asyncio
+import threading
+
+# Output tokens a request is assumed to use until responses of the run have been seen
+DEFAULT_OUTPUT_ESTIMATE = 1000
+
+
+class TokenBudgetExceeded(Exception):
+    pass
+
+
+class TokenBudget:
+    '''
+    Cap on the tokens (input + output) one paper may use. Every request
+    reserves its prompt plus an estimate of its output before it is sent and
+    waits while requests in flight hold the rest of the budget. The
+    reservation is replaced by the reported usage once the response arrives,
+    and the estimate is the mean output of the responses seen so far
+    (capped by the model's output limit). Responses longer than their
+    estimate can take the total past the cap by that difference; no request
+    is started once it has been reached.
+    max_tokens None or 0 means unlimited.
+    '''
+    def __init__(self, max_tokens=None):
+        self.max_tokens = max_tokens or None
+        self.used = 0
+        self.reserved = 0
+        self._output_tokens = 0
+        self._responses = 0
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        # (loop, future) of async callers waiting for a reservation to settle
+        self._waiters = []
+
+    @property
+    def remaining(self):
+        if self.max_tokens is None:
+            return None
+        return max(0, self.max_tokens - self.used - self.reserved)
+
+    def output_estimate(self, max_output):
+        with self._lock:
+            estimate = self._output_tokens // self._responses + 1 if self._responses else DEFAULT_OUTPUT_ESTIMATE
+        return min(max_output, estimate)
+
+    def _try_reserve(self, tokens):
+        if self.max_tokens is None:
+            self.reserved += tokens
+            return True
+        if self.used + tokens > self.max_tokens:
+            raise TokenBudgetExceeded(f"request needs about {tokens} tokens but only {max(0, self.max_tokens - self.used)} "
+                                      f"of the {self.max_tokens} token budget are left")
+        if self.used + self.reserved + tokens > self.max_tokens:
+            return False
+        self.reserved += tokens
+        return True
+
+    def try_reserve(self, tokens):
+        '''
+        Reserves `tokens` and returns True, or returns False if the request has
+        to wait for requests in flight to settle first. Raises
+        TokenBudgetExceeded if it can't fit even once they have.
+        '''
+        with self._lock:
+            return self._try_reserve(tokens)
+
+    async def reserve(self, tokens):
+        '''
+        Reserves `tokens`, waiting until requests in flight have settled enough
+        of the budget. Raises TokenBudgetExceeded like try_reserve.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._try_reserve(tokens):
+                    return
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+            await future
+
+    def reserve_sync(self, tokens):
+        with self._released:
+            while not self._try_reserve(tokens):
+                self._released.wait()
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def settle(self, reserved, tokens, output_tokens=None):
+        '''
+        Releases a reservation and charges the tokens actually used (0 if the
+        request failed), of which output_tokens were output, and wakes the
+        requests waiting for budget.
+        '''
+        with self._released:
+            self.reserved -= reserved
+            self.used += tokens
+            if output_tokens is not None:
+                self._output_tokens += output_tokens
+                self._responses += 1
+            self._released.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:
+                # The waiter's event loop has been closed
+                pass
@@ -0,0 +1,279 @@
+'''
+Compact on-disk bundles of finished results, for reopening and browsing
+explained papers without reprocessing them.
+
+A bundle is one file holding the summary, similar papers, every chunk's
+text and offsets and each section's explanation as separately compressed
+blobs, followed by an index of where each blob is and a small uncompressed
+info record for listings:
+
+    MAGIC | blobs ... | info (JSON) | index (zlib JSON) | footer
+
+The footer gives the offsets of the info record and the index, so listing a
+bundle reads only its last few hundred bytes and opening one reads only the
+index; chunks are decompressed one at a time when they are shown. Chunk
+texts and explanations are compressed with the paper summary as a preset
+dictionary, since they share most of its vocabulary.
+'''
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+from llmCache import LLMCache
+from results import SECTION_FIELDS, ChunkResult, PaperResult
+
+MAGIC = b'RPXBNDL1'
+# info offset, info length, index offset, index length, magic
+FOOTER = struct.Struct('<QIQI8s')
+# zlib uses at most the last 32 KB of a preset dictionary
+MAX_DICTIONARY_BYTES = 32 * 1024
+COMPRESSION_LEVEL = 9
+
+
+def _dictionary(summary):
+    return (summary or '').encode('utf-8')[-MAX_DICTIONARY_BYTES:]
+
+
+class BundleWriter:
+    '''
+    Writes a bundle while the result is produced, with the interface of
+    ResultStreamWriter: start(summary, metadata), write(chunk) for each
+    chunk in order, then close(similar_papers). The file is written under a
+    unique temporary name and renamed by close(), so an existing path always
+    holds a complete bundle, and concurrent saves of the same paper don't
+    write to the same file (the last one to finish wins).
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.chunks = 0
+        self.failed_sections = 0
+        self.skipped_sections = 0
+        self._file = tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path) or '.', prefix=f"{os.path.basename(path)}.",
+                                                 suffix='.tmp', delete=False)
+        self._file.write(MAGIC)
+        self._index = None
+        self._dictionary = b''
+
+    def _blob(self, text, dictionary=b''):
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=dictionary) if dictionary else zlib.compressobj(COMPRESSION_LEVEL)
+        data = compressor.compress(text.encode('utf-8')) + compressor.flush()
+        offset = self._file.tell()
+        self._file.write(data)
+        return [offset, len(data)]
+
+    def start(self, summary, metadata):
+        self._dictionary = _dictionary(summary)
+        self._index = {'metadata': metadata, 'summary': self._blob(summary or ''), 'similar_papers': None, 'chunks': []}
+
+    def write(self, chunk):
+        entry = {
+            'index': chunk.index, 'start': chunk.start, 'overlap': chunk.overlap, 'errors': dict(chunk.errors),
+            'skipped': list(chunk.skipped), 'provisional': list(chunk.provisional),
+            'text': self._blob(chunk.text, self._dictionary),
+            'sections': {section: self._blob(value, self._dictionary)
+                         for section, value in ((section, chunk.get(section)) for section in SECTION_FIELDS) if value is not None},
+        }
+        self._index['chunks'].append(entry)
+        self.chunks += 1
+        self.failed_sections += len(chunk.errors)
+        self.skipped_sections += len(chunk.skipped)
+
+    def close(self, similar_papers=None):
+        '''
+        Finishes the bundle and returns its info record.
+        '''
+        if similar_papers is not None:
+            self._index['similar_papers'] = self._blob(similar_papers)
+        metadata = self._index['metadata']
+        info = {
+            'title': metadata.get('file_name'),
+            'paper_id': metadata.get('paper_id'),
+            'model_name': metadata.get('model_name'),
+            'difficulty': metadata.get('difficulty'),
+            'sections': metadata.get('sections'),
+            'summarization_method': metadata.get('summarization_method'),
+            'chunks': self.chunks,
+            'failed_sections': self.failed_sections,
+            'created': time.time(),
+        }
+        info_data = json.dumps(info, ensure_ascii=False).encode('utf-8')
+        info_offset = self._file.tell()
+        self._file.write(info_data)
+        index_data = zlib.compress(json.dumps(self._index, ensure_ascii=False).encode('utf-8'), COMPRESSION_LEVEL)
+        index_offset = self._file.tell()
+        self._file.write(index_data)
+        self._file.write(FOOTER.pack(info_offset, len(info_data), index_offset, len(index_data), MAGIC))
+        self._file.close()
+        os.replace(self._file.name, self.path)
+        return info
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._file.name)
+
+
+def write_bundle(path, result):
+    writer = BundleWriter(path)
+    try:
+        writer.start(result.summary, result.metadata)
+        for chunk in result.chunks:
+            writer.write(chunk)
+        return writer.close(result.similar_papers)
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def _read_footer(f):
+    try:
+        f.seek(-FOOTER.size, os.SEEK_END)
+        info_offset, info_length, index_offset, index_length, magic = FOOTER.unpack(f.read(FOOTER.size))
+    except (OSError, struct.error):
+        raise ValueError("Not a result bundle")
+    if magic != MAGIC:
+        raise ValueError("Not a result bundle")
+    return info_offset, info_length, index_offset, index_length
+
+
+def _decompress(data, dictionary=b''):
+    # Corrupt data is reported as ValueError, like the other ways a bundle can be unreadable
+    try:
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+    except zlib.error as e:
+        raise ValueError(f"Corrupt result bundle: {e}") from e
+
+
+def read_bundle_info(path):
+    '''
+    The info record of a bundle (title, model, chunk count, ...) without reading the rest.
+    '''
+    with open(path, 'rb') as f:
+        info_offset, info_length, _, _ = _read_footer(f)
+        f.seek(info_offset)
+        return json.loads(f.read(info_length))
+
+
+class ResultBundle:
+    '''
+    Read access to a bundle. Opening it reads only the info record and the
+    index (a few bytes per chunk); the summary is decompressed on first use
+    and chunks each time they are asked for, so a reader only holds the
+    chunks it is showing. A corrupt bundle raises ValueError, when it is
+    opened or when the damaged part is read.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            info_offset, info_length, index_offset, index_length = _read_footer(f)
+            f.seek(info_offset)
+            self.info = json.loads(f.read(info_length))
+            f.seek(index_offset)
+            self._index = json.loads(_decompress(f.read(index_length)))
+        self._summary = None
+
+    def __len__(self):
+        return len(self._index['chunks'])
+
+    @property
+    def metadata(self):
+        return self._index['metadata']
+
+    @staticmethod
+    def _read(f, blob, dictionary=b''):
+        f.seek(blob[0])
+        return _decompress(f.read(blob[1]), dictionary).decode('utf-8')
+
+    @property
+    def summary(self):
+        if self._summary is None:
+            with open(self.path, 'rb') as f:
+                self._summary = self._read(f, self._index['summary'])
+        return self._summary
+
+    @property
+    def similar_papers(self):
+        blob = self._index['similar_papers']
+        if blob is None:
+            return None
+        with open(self.path, 'rb') as f:
+            return self._read(f, blob)
+
+    def failed_sections(self):
+        return [(entry['index'], section) for entry in self._index['chunks'] for section in entry['errors']]
+
+    def chunks(self, start=0, stop=None, sections=None):
+        '''
+        ChunkResults for chunks start..stop, read from disk; with sections,
+        only those sections are decompressed.
+        '''
+        dictionary = _dictionary(self.summary)
+        chunks = []
+        with open(self.path, 'rb') as f:
+            for entry in self._index['chunks'][start:stop]:
+                chunk = ChunkResult(entry['index'], self._read(f, entry['text'], dictionary), start=entry['start'],
+                                    overlap=entry['overlap'], errors=dict(entry['errors']), skipped=list(entry['skipped']),
+                                    provisional=list(entry['provisional']))
+                for section, blob in entry['sections'].items():
+                    if sections is None or section in sections:
+                        setattr(chunk, SECTION_FIELDS[section], self._read(f, blob, dictionary))
+                chunks.append(chunk)
+        return chunks
+
+    def chunk(self, index, sections=None):
+        return self.chunks(index, index + 1, sections)[0]
+
+    def to_result(self):
+        return PaperResult(self.summary, self.chunks(), similar_papers=self.similar_papers, metadata=self.metadata)
+
+
+class BundleLibrary:
+    '''
+    Directory of bundles (EXPLAINER_CACHE_DIR/library by default), one per
+    paper and run settings: saving the same paper again with the same
+    model, difficulty, sections and summarization method replaces its bundle.
+    '''
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(os.getenv('EXPLAINER_CACHE_DIR', '.cache'), 'library')
+        self.directory = directory
+
+    @staticmethod
+    def bundle_id(metadata, summary=''):
+        return LLMCache.key(metadata.get('paper_id') or summary, metadata.get('model_name'), metadata.get('difficulty'),
+                            json.dumps(metadata.get('sections')), metadata.get('summarization_method'))[:16]
+
+    def path(self, bundle_id):
+        return os.path.join(self.directory, f"{bundle_id}.bundle")
+
+    def save(self, result):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(self.bundle_id(result.metadata, result.summary))
+        write_bundle(path, result)
+        return path
+
+    def list(self):
+        '''
+        Info records of every readable bundle, newest first, with their bundle_id.
+        '''
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith('.bundle'):
+                continue
+            try:
+                info = read_bundle_info(os.path.join(self.directory, name))
+            except (OSError, ValueError):
+                continue
+            info['bundle_id'] = name[:-len('.bundle')]
+            entries.append(info)
+        return sorted(entries, key=lambda info: info.get('created') or 0, reverse=True)
+
+    def open(self, bundle_id):
+        return ResultBundle(self.path(bundle_id))
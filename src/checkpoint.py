@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import threading
+import time
+
+from llmCache import LLMCache
+
+
+class CheckpointStore:
+    '''
+    Disk-backed store of the partial results of pipeline runs, so a run that
+    dies partway can be resumed. A run is identified by the paper text, model,
+    summarization method and difficulty; its summary and every completed
+    (chunk, section) result are written as soon as they arrive, flagged if
+    they were explained from a provisional context. Results are
+    keyed by the chunk's text rather than its position, so they are only
+    reused for chunks split exactly the same way. Runs not touched for `ttl`
+    seconds are purged.
+    '''
+    def __init__(self, path=None, ttl=7 * 24 * 3600):
+        if path is None:
+            path = os.path.join(os.getenv('EXPLAINER_CACHE_DIR', '.cache'), 'checkpoints.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS runs (run_key TEXT PRIMARY KEY, summary TEXT, updated REAL NOT NULL)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'run_key TEXT NOT NULL, chunk_key TEXT NOT NULL, section TEXT NOT NULL, value TEXT NOT NULL, '
+            'provisional INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (run_key, chunk_key, section))'
+        )
+        # Stores created before provisional results were checkpointed
+        if 'provisional' not in [row[1] for row in self._conn.execute('PRAGMA table_info(results)')]:
+            self._conn.execute('ALTER TABLE results ADD COLUMN provisional INTEGER NOT NULL DEFAULT 0')
+        self._conn.commit()
+        self.purge_expired()
+
+    @staticmethod
+    def run_key(paper_text, api_provider, model_name, summarization_method, difficulty):
+        return LLMCache.key('run', paper_text, api_provider, model_name, summarization_method, difficulty)
+
+    @staticmethod
+    def chunk_key(chunk_text):
+        return LLMCache.key(chunk_text)
+
+    def _touch(self, run_key):
+        self._conn.execute('INSERT INTO runs (run_key, updated) VALUES (?, ?) '
+                           'ON CONFLICT (run_key) DO UPDATE SET updated = excluded.updated', (run_key, time.time()))
+
+    def get_summary(self, run_key):
+        with self._lock:
+            row = self._conn.execute('SELECT summary FROM runs WHERE run_key = ?', (run_key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_summary(self, run_key, summary):
+        with self._lock:
+            self._touch(run_key)
+            self._conn.execute('UPDATE runs SET summary = ? WHERE run_key = ?', (summary, run_key))
+            self._conn.commit()
+
+    def get_results(self, run_key):
+        '''
+        output:
+            dict of (chunk_key, section) -> (stored text, whether it was
+            explained from a provisional context)
+        '''
+        with self._lock:
+            rows = self._conn.execute('SELECT chunk_key, section, value, provisional FROM results WHERE run_key = ?',
+                                      (run_key,)).fetchall()
+        return {(chunk_key, section): (value, bool(provisional)) for chunk_key, section, value, provisional in rows}
+
+    def set_result(self, run_key, chunk_key, section, value, provisional=False):
+        with self._lock:
+            self._touch(run_key)
+            self._conn.execute('INSERT OR REPLACE INTO results (run_key, chunk_key, section, value, provisional) VALUES (?, ?, ?, ?, ?)',
+                               (run_key, chunk_key, section, value, int(provisional)))
+            self._conn.commit()
+
+    def delete(self, run_key):
+        with self._lock:
+            self._conn.execute('DELETE FROM results WHERE run_key = ?', (run_key,))
+            self._conn.execute('DELETE FROM runs WHERE run_key = ?', (run_key,))
+            self._conn.commit()
+
+    def purge_expired(self):
+        if not self.ttl:
+            return
+        with self._lock:
+            expired = 'SELECT run_key FROM runs WHERE updated < ?'
+            cutoff = time.time() - self.ttl
+            self._conn.execute(f'DELETE FROM results WHERE run_key IN ({expired})', (cutoff,))
+            self._conn.execute('DELETE FROM runs WHERE updated < ?', (cutoff,))
+            self._conn.commit()
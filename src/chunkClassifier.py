@@ -0,0 +1,88 @@
+import re
+
+REFERENCES_HEADER = re.compile(r'^\s*(?:\d+\.?\s*)?(?:references|bibliography|works cited|literature cited)\s*$', re.I | re.M)
+APPENDIX_HEADER = re.compile(r'^\s*(?:[A-Z]?\.?\s*)?(?:appendix|appendices|supplementary material)\b', re.I | re.M)
+
+# "[12] ..." or "12. Smith, J." at the start of a line
+CITATION_START = re.compile(r'^\s*(?:\[\d{1,3}\]|\d{1,3}\.\s+[A-Z][\w\'-]+,?\s+[A-Z]\.)')
+CITATION_MARKERS = re.compile(r'et al\.|arXiv|\bdoi\b|\bIn Proc|\bProceedings\b|\bJournal\b|\bConference\b|\bvol\.|\bpp\.', re.I)
+YEAR = re.compile(r'\b(?:19|20)\d{2}[a-z]?\b')
+
+LATEX_MATH = re.compile(r'\\(?:frac|sum|prod|int|partial|nabla|alpha|beta|gamma|delta|epsilon|theta|lambda|mu|sigma|phi|omega|'
+                        r'mathbf|mathcal|mathbb|cdot|times|leq|geq|neq|approx|infty|sqrt|log|exp)(?![a-zA-Z])|\$[^$\n]+\$')
+UNICODE_MATH = re.compile('[∑∏∫∂∇≤≥≠≈≡∞±×÷√∈∉⊂⊆⊇∀∃∧∨¬→←↔⇒⇔αβγδεζηθκλμνξπρστφχψωΓΔΘΛΞΠΣΦΨΩ]')
+# Assignments/comparisons of single-letter symbols (x = ..., x_i <= ..., f(x) = ...), powers,
+# subscripts and numbered equations. Subscripts need a LaTeX brace or a one-letter base and
+# one-character index, so snake_case identifiers in code (max_len, x_train) don't count.
+EQUATION = re.compile(r'(?<![\w.])[a-zA-Z](?:_(?:\{[^}\n]*\}|[a-zA-Z0-9]))?\'?\s*(?:[<>]=?|=)(?![=<>])\s*[\w(\[\\-]'
+                      r'|\)\s*=(?!=)\s*[\w(\[\\-]'
+                      r'|\w\^[\w{(]'
+                      r'|\w_\{|(?<![\w\\])[a-zA-Z]_[a-zA-Z0-9](?!\w)'
+                      r'|\(\d{1,3}\)\s*$', re.M)
+
+# Fewer signals than this is treated as incidental (a stray "x = 5" in prose)
+MIN_MATH_SIGNALS = 3
+MIN_REFERENCE_LINES = 4
+REFERENCE_LINE_RATIO = 0.6
+# Wrapped entries leave continuation lines without markers, so be more lenient under a header
+REFERENCE_LINE_RATIO_WITH_HEADER = 0.3
+# More text than this before the references header means the chunk still ends a real section
+MAX_CHARS_BEFORE_HEADER = 300
+
+
+class ChunkClassifier:
+    '''
+    Cheap local heuristics deciding which explanation requests a chunk is
+    worth: reference lists need none, and chunks without math don't need the
+    Mathematical Concepts section.
+    '''
+    @staticmethod
+    def math_signals(text):
+        return len(LATEX_MATH.findall(text)) + len(UNICODE_MATH.findall(text)) + len(EQUATION.findall(text))
+
+    @staticmethod
+    def has_math(text):
+        return ChunkClassifier.math_signals(text) >= MIN_MATH_SIGNALS
+
+    @staticmethod
+    def is_reference_line(line):
+        return bool(CITATION_START.match(line) or (YEAR.search(line) and CITATION_MARKERS.search(line)))
+
+    @staticmethod
+    def is_references(text):
+        '''
+        True if the chunk is (almost) only a reference list. Chunks mixing
+        references with other content are kept, so nothing worth explaining
+        is skipped.
+        '''
+        header = REFERENCES_HEADER.search(text)
+        if header:
+            appendix = APPENDIX_HEADER.search(text, header.end())
+            if appendix or len(text[:header.start()].strip()) > MAX_CHARS_BEFORE_HEADER:
+                return False
+            text = text[header.end():]
+
+        lines = [line for line in text.splitlines() if line.strip()]
+        if len(lines) < MIN_REFERENCE_LINES:
+            return False
+        reference_lines = [ChunkClassifier.is_reference_line(line) for line in lines]
+        if header:
+            return sum(reference_lines) / len(lines) >= REFERENCE_LINE_RATIO_WITH_HEADER
+
+        other_text = "\n".join(line for line, is_reference in zip(lines, reference_lines) if not is_reference)
+        return sum(reference_lines) / len(lines) >= REFERENCE_LINE_RATIO and not ChunkClassifier.has_math(other_text)
+
+    @staticmethod
+    def skipped_sections(text, sections):
+        '''
+        input:
+            text: str, chunk text
+            sections: list of requested section names
+        output:
+            list of the sections not worth requesting for this chunk
+        '''
+        if ChunkClassifier.is_references(text):
+            return list(sections)
+        if 'Mathematical Concepts' in sections and not ChunkClassifier.has_math(text):
+            return ['Mathematical Concepts']
+        return []
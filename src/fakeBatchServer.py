@@ -0,0 +1,283 @@
+'''
+Local stand-in for the parts of the OpenAI and Anthropic HTTP APIs the
+explainer uses: chat completions and messages for live requests, and both
+batch APIs. Answers come from FakeChatModel, so they are repeatable and
+fused prompts get tagged answers. Batches end `delay` seconds after they are
+created, with `error_rate` of their requests errored; until then their
+request counts grow evenly. For offline runs of
+the Batch API mode:
+
+    python src/fakeBatchServer.py --port 8765 --delay 5 --error-rate 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=test \\
+        python src/batch.py papers/ --model gpt-4o-mini --batch-api --poll-interval 1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 ANTHROPIC_API_KEY=test \\
+        python src/batch.py papers/ --model claude-3-haiku-20240307 --batch-api --poll-interval 1
+
+Token streaming is not supported.
+'''
+import argparse
+import email.parser
+import hashlib
+import itertools
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from fakeLLM import FakeChatModel
+
+MESSAGE_TYPES = {'system': SystemMessage, 'user': HumanMessage, 'assistant': AIMessage}
+
+
+def _text(content):
+    # Anthropic content may be a list of blocks
+    if isinstance(content, str):
+        return content
+    return "".join(block.get('text', '') for block in content)
+
+
+def _timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+
+class FakeBatchServer:
+    '''
+    Threaded HTTP server holding uploaded files and batches in memory.
+    port 0 picks a free port; url is the server's root once started.
+    '''
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, error_rate=0.0, model=None):
+        self.delay = delay
+        self.error_rate = error_rate
+        self.model = model or FakeChatModel(latency=0.0, prefix_caching=True)
+        self.files = {}
+        self.batches = {}
+        self.requests = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-batch-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def _new_id(self, prefix):
+        return f"{prefix}_{next(self._ids)}"
+
+    def _answer(self, messages):
+        '''
+        (text, input_tokens, output_tokens, cache_read_tokens) for provider message dicts.
+        '''
+        message = self.model.invoke([MESSAGE_TYPES[m['role']](content=_text(m['content'])) for m in messages])
+        usage = message.usage_metadata
+        return message.content, usage['input_tokens'], usage['output_tokens'], usage['input_token_details']['cache_read']
+
+    def _fails(self, custom_id):
+        digest = hashlib.sha256(custom_id.encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.error_rate
+
+    def chat_completion(self, body):
+        text, input_tokens, output_tokens, cache_read = self._answer(body['messages'])
+        return {
+            'id': self._new_id('chatcmpl'), 'object': 'chat.completion', 'created': int(time.time()), 'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop', 'logprobs': None}],
+            'usage': {'prompt_tokens': input_tokens, 'completion_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens,
+                      'prompt_tokens_details': {'cached_tokens': cache_read}},
+        }
+
+    def message(self, body):
+        messages = list(body['messages'])
+        if body.get('system'):
+            messages.insert(0, {'role': 'system', 'content': body['system']})
+        text, input_tokens, output_tokens, cache_read = self._answer(messages)
+        return {
+            'id': self._new_id('msg'), 'type': 'message', 'role': 'assistant', 'model': body['model'],
+            'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn', 'stop_sequence': None,
+            'usage': {'input_tokens': input_tokens - cache_read, 'output_tokens': output_tokens,
+                      'cache_read_input_tokens': cache_read, 'cache_creation_input_tokens': 0},
+        }
+
+    def _process(self, batch_id):
+        '''
+        Answers a batch's requests once its delay has passed; returns the batch.
+        '''
+        with self._lock:
+            batch = self.batches[batch_id]
+            if batch['_ended']:
+                return batch
+            elapsed = time.time() - batch['_created']
+            if elapsed < self.delay:
+                total = len(self.requests[batch_id])
+                finished = int(total * elapsed / self.delay)
+                if 'processing_status' in batch:
+                    batch['request_counts'].update(processing=total - finished, succeeded=finished)
+                else:
+                    batch['request_counts']['completed'] = finished
+                return batch
+            batch['_ended'] = True
+        output, errors = [], []
+        for custom_id, kind, body in self.requests.pop(batch_id):
+            if batch['_cancelled'] or self._fails(custom_id):
+                errors.append((custom_id, kind))
+            elif kind == 'openai':
+                output.append({'id': self._new_id('batch_req'), 'custom_id': custom_id, 'error': None,
+                               'response': {'status_code': 200, 'request_id': self._new_id('req'), 'body': self.chat_completion(body)}})
+            else:
+                output.append({'custom_id': custom_id, 'result': {'type': 'succeeded', 'message': self.message(body)}})
+
+        now = time.time()
+        if 'processing_status' in batch:
+            canceled = [{'custom_id': custom_id, 'result': {'type': 'canceled'}} for custom_id, _ in errors if batch['_cancelled']]
+            errored = [] if batch['_cancelled'] else [
+                {'custom_id': custom_id, 'result': {'type': 'errored', 'error': {'type': 'error', 'error': {
+                    'type': 'api_error', 'message': "Internal server error (fake)"}}}} for custom_id, _ in errors]
+            self.files[batch_id] = "".join(json.dumps(line) + "\n" for line in output + errored + canceled)
+            batch.update(processing_status='ended', ended_at=_timestamp(now), results_url=f"{batch['_url']}/v1/messages/batches/{batch_id}/results")
+            batch['request_counts'] = {'processing': 0, 'succeeded': len(output), 'errored': len(errored),
+                                       'canceled': len(canceled), 'expired': 0}
+        else:
+            batch['output_file_id'] = self._store_file([json.dumps(line) for line in output]) if output else None
+            batch['error_file_id'] = self._store_file([json.dumps({
+                'id': self._new_id('batch_req'), 'custom_id': custom_id, 'response': None,
+                'error': {'code': 'server_error', 'message': "Internal server error (fake)"}}) for custom_id, _ in errors]) if errors else None
+            batch.update(status='cancelled' if batch['_cancelled'] else 'completed', completed_at=int(now))
+            batch['request_counts'] = {'total': len(output) + len(errors), 'completed': len(output), 'failed': len(errors)}
+        return batch
+
+    def _store_file(self, lines):
+        file_id = self._new_id('file')
+        self.files[file_id] = "".join(line + "\n" for line in lines)
+        return file_id
+
+    @staticmethod
+    def _public(batch):
+        return {name: value for name, value in batch.items() if not name.startswith('_')}
+
+    def create_openai_batch(self, body):
+        lines = [json.loads(line) for line in self.files[body['input_file_id']].splitlines() if line.strip()]
+        batch_id = self._new_id('batch')
+        now = time.time()
+        self.batches[batch_id] = {
+            'id': batch_id, 'object': 'batch', 'endpoint': body['endpoint'], 'errors': None, 'input_file_id': body['input_file_id'],
+            'completion_window': body['completion_window'], 'status': 'in_progress', 'output_file_id': None,
+            'error_file_id': None, 'created_at': int(now), 'request_counts': {'total': len(lines), 'completed': 0, 'failed': 0},
+            '_created': now, '_ended': False, '_cancelled': False,
+        }
+        self.requests[batch_id] = [(line['custom_id'], 'openai', line['body']) for line in lines]
+        return self._public(self.batches[batch_id])
+
+    def create_anthropic_batch(self, body, url):
+        batch_id = self._new_id('msgbatch')
+        now = time.time()
+        self.batches[batch_id] = {
+            'id': batch_id, 'type': 'message_batch', 'processing_status': 'in_progress', 'created_at': _timestamp(now),
+            'expires_at': _timestamp(now + timedelta(days=1).total_seconds()), 'ended_at': None, 'archived_at': None,
+            'cancel_initiated_at': None, 'results_url': None,
+            'request_counts': {'processing': len(body['requests']), 'succeeded': 0, 'errored': 0, 'canceled': 0, 'expired': 0},
+            '_created': now, '_ended': False, '_cancelled': False, '_url': url,
+        }
+        self.requests[batch_id] = [(request['custom_id'], 'anthropic', request['params']) for request in body['requests']]
+        return self._public(self.batches[batch_id])
+
+    def cancel(self, batch_id):
+        self.batches[batch_id]['_cancelled'] = True
+        # Cancelling ends the batch right away
+        self.batches[batch_id]['_created'] -= self.delay
+        return self._public(self._process(batch_id))
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def _send(self, status, payload, content_type='application/json'):
+                data = payload.encode('utf-8') if isinstance(payload, str) else json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _upload(self):
+                # multipart/form-data with the purpose and file fields
+                form = email.parser.BytesParser().parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + self._body())
+                fields = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True) for part in form.get_payload()}
+                file_id = server._new_id('file')
+                server.files[file_id] = fields['file'].decode('utf-8')
+                return {'id': file_id, 'object': 'file', 'bytes': len(fields['file']), 'created_at': int(time.time()),
+                        'filename': 'requests.jsonl', 'purpose': fields['purpose'].decode('utf-8'), 'status': 'processed'}
+
+            def do_POST(self):
+                path = self.path.split('?')[0].rstrip('/')
+                if path == '/v1/files':
+                    return self._send(200, self._upload())
+                body = json.loads(self._body() or b'{}')
+                if body.get('stream'):
+                    return self._send(400, {'error': {'type': 'invalid_request_error', 'message': "The fake server doesn't stream"}})
+                if path == '/v1/chat/completions':
+                    return self._send(200, server.chat_completion(body))
+                if path == '/v1/messages':
+                    return self._send(200, server.message(body))
+                if path == '/v1/batches':
+                    return self._send(200, server.create_openai_batch(body))
+                if path == '/v1/messages/batches':
+                    return self._send(200, server.create_anthropic_batch(body, f"http://{self.headers['Host']}"))
+                parts = path.split('/')
+                if parts[-1] == 'cancel' and parts[-2] in server.batches:
+                    return self._send(200, server.cancel(parts[-2]))
+                self._send(404, {'error': {'type': 'not_found_error', 'message': f"Unknown path {path}"}})
+
+            def do_GET(self):
+                parts = self.path.split('?')[0].rstrip('/').split('/')
+                if parts[-1] == 'content' and parts[-2] in server.files:
+                    return self._send(200, server.files[parts[-2]], 'application/octet-stream')
+                if parts[-1] == 'results' and parts[-2] in server.files:
+                    return self._send(200, server.files[parts[-2]], 'application/binary')
+                if parts[-1] in server.batches:
+                    return self._send(200, server._public(server._process(parts[-1])))
+                self._send(404, {'error': {'type': 'not_found_error', 'message': f"Unknown path {self.path}"}})
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local fake of the OpenAI and Anthropic chat and batch APIs")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=5.0, help="seconds until a batch ends")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of batched requests that error")
+    parser.add_argument('--output-tokens', type=int, default=200)
+    args = parser.parse_args(argv)
+    server = FakeBatchServer(args.host, args.port, args.delay, args.error_rate,
+                             FakeChatModel(latency=0.0, output_tokens=args.output_tokens, prefix_caching=True))
+    print(f"Serving on {server.url} (OpenAI base URL {server.url}/v1)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
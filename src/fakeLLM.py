@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.pydantic_v1 import PrivateAttr
+
+from rateLimiter import estimate_tokens
+
+
+class FakeRateLimitError(Exception):
+    '''
+    Mimics a provider 429: carries a status code and a Retry-After hint.
+    '''
+    def __init__(self, retry_after=1.0):
+        super().__init__(f"Error code: 429 - rate limit exceeded, retry after {retry_after}s")
+        self.status_code = 429
+        self.retry_after = retry_after
+
+
+class FakeChatModel(BaseChatModel):
+    '''
+    Deterministic local chat model for benchmarks and offline runs. Latency,
+    jitter, rate-limit errors and output length are configurable; all
+    randomness is seeded from the prompt, so runs are repeatable whatever the
+    call order. Fused prompts get answers wrapped in the requested tags.
+    With prefix_caching, a leading system message of at least
+    min_cache_tokens that was sent before is reported as a cache read, like
+    providers with automatic prefix caching do.
+    '''
+    model_name: str = "fake"
+    latency: float = 0.05
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    output_tokens: int = 200
+    seed: int = 0
+    prefix_caching: bool = False
+    min_cache_tokens: int = 1024
+
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _active: int = PrivateAttr(default=0)
+    _peak_concurrency: int = PrivateAttr(default=0)
+    _calls: int = PrivateAttr(default=0)
+    _errors: int = PrivateAttr(default=0)
+    _attempts: Any = PrivateAttr(default_factory=dict)
+    _prefixes: Any = PrivateAttr(default_factory=set)
+
+    @property
+    def _llm_type(self):
+        return "fake-chat-model"
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self._calls, 'errors': self._errors, 'peak_concurrency': self._peak_concurrency}
+
+    def reset_stats(self):
+        with self._lock:
+            self._peak_concurrency = 0
+            self._calls = 0
+            self._errors = 0
+            self._attempts.clear()
+            self._prefixes.clear()
+
+    def _plan(self, messages):
+        prompt = "\n".join(str(message.content) for message in messages)
+        # Seeding on the attempt number as well lets a retried request succeed
+        prompt_key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        with self._lock:
+            attempt = self._attempts.get(prompt_key, 0)
+            self._attempts[prompt_key] = attempt + 1
+        digest = hashlib.sha256(f"{self.seed}:{attempt}:{prompt}".encode('utf-8')).digest()
+        rng = random.Random(digest)
+        delay = max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter))
+        fail = rng.random() < self.error_rate
+        return prompt, rng, delay, fail
+
+    def _cacheable_prefix(self, messages):
+        if not self.prefix_caching or not messages or messages[0].type != 'system':
+            return None
+        prefix = str(messages[0].content)
+        return prefix if estimate_tokens(prefix) >= self.min_cache_tokens else None
+
+    def _cache_read(self, messages):
+        # Only prefixes of requests that already finished are cached
+        prefix = self._cacheable_prefix(messages)
+        with self._lock:
+            return estimate_tokens(prefix) if prefix is not None and prefix in self._prefixes else 0
+
+    def _cache_write(self, messages):
+        prefix = self._cacheable_prefix(messages)
+        if prefix is not None:
+            with self._lock:
+                self._prefixes.add(prefix)
+
+    def _respond(self, prompt, rng, cache_read=0):
+        words = ["model", "paper", "result", "method", "data", "loss", "layer", "token", "proof", "bound"]
+        text = " ".join(rng.choice(words) for _ in range(self.output_tokens))
+        tags = re.findall(r'^<(\w+)>:', prompt, re.M)
+        if tags:
+            text = "".join(f"<{tag}>{text}</{tag}>" for tag in tags)
+        input_tokens = estimate_tokens(prompt)
+        message = AIMessage(content=text, usage_metadata={
+            'input_tokens': input_tokens,
+            'output_tokens': self.output_tokens,
+            'total_tokens': input_tokens + self.output_tokens,
+            'input_token_details': {'cache_read': cache_read},
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _enter(self):
+        with self._lock:
+            self._calls += 1
+            self._active += 1
+            self._peak_concurrency = max(self._peak_concurrency, self._active)
+
+    def _exit(self, failed):
+        with self._lock:
+            self._active -= 1
+            if failed:
+                self._errors += 1
+
+    def _generate(self, messages: List, stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        prompt, rng, delay, fail = self._plan(messages)
+        cache_read = self._cache_read(messages)
+        self._enter()
+        try:
+            time.sleep(delay)
+        finally:
+            self._exit(fail)
+        if fail:
+            raise FakeRateLimitError()
+        self._cache_write(messages)
+        return self._respond(prompt, rng, cache_read)
+
+    async def _agenerate(self, messages: List, stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        prompt, rng, delay, fail = self._plan(messages)
+        cache_read = self._cache_read(messages)
+        self._enter()
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._exit(fail)
+        if fail:
+            raise FakeRateLimitError()
+        self._cache_write(messages)
+        return self._respond(prompt, rng, cache_read)
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from LLMSelect import LLMSelector
+from llmCache import LLMCache
+from pipeline import ExplanationPipeline, create_generator
+from preprocessor import PaperPreprocessor
+from providerBatch import ProviderBatchRunner
+from rateLimiter import RateLimiter
+from telemetry import Telemetry
+
+logger = logging.getLogger(__name__)
+
+# Options that change how a run is scheduled or displayed but not its result. The
+# rate limits only matter through the chunk size derived from the TPM limit, which
+# job_key adds instead.
+NON_RESULT_OPTIONS = ('rate_limits', 'stream_tokens', 'use_cache', 'hedge_budget')
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class Job:
+    '''
+    One paper being processed by the JobQueue. The worker updates status,
+    progress and the partial result in place; readers only poll.
+    '''
+    __slots__ = ('id', 'key', 'file_name', 'status', 'message', 'result', 'error', 'pipeline', 'telemetry',
+                 'execution_mode', 'completed_calls', 'batched_calls', 'total_calls', 'previews', 'created', 'finished')
+
+    def __init__(self, job_id, key, file_name, execution_mode="Async"):
+        self.id = job_id
+        self.key = key
+        self.file_name = file_name
+        self.execution_mode = execution_mode
+        self.status = 'queued'
+        self.message = "Waiting for a free worker..."
+        self.result = None
+        self.error = None
+        self.pipeline = None
+        self.telemetry = Telemetry()
+        self.completed_calls = 0
+        # Requests a provider batch job has answered but not yet returned
+        self.batched_calls = 0
+        self.total_calls = 1
+        # (chunk index, section) -> partial text while tokens are streamed
+        self.previews = {}
+        self.created = time.time()
+        self.finished = None
+
+    @property
+    def active(self):
+        return self.status in ACTIVE_STATUSES
+
+    @property
+    def progress(self):
+        if self.status == 'done':
+            return 1.0
+        return min(1.0, (self.completed_calls + self.batched_calls) / max(1, self.total_calls))
+
+    def _start(self, result, total_calls):
+        self.result = result
+        self.completed_calls = 0
+        self.batched_calls = 0
+        self.total_calls = total_calls
+        resumed = result.metadata.get('resumed_calls')
+        if result.metadata.get('rerun'):
+            self.message = "Requesting the sections explained from the abstract and introduction again with the summary..."
+        elif resumed:
+            self.message = f"Resumed {resumed} sections, generating the rest..."
+        elif result.metadata.get('provisional_summary'):
+            self.message = "Generating explanations, from the abstract and introduction until the summary is ready..."
+        else:
+            self.message = "Generating explanations..."
+
+    def _update(self, index, results):
+        self.completed_calls += 1
+        for section in results:
+            self.previews.pop((index, section), None)
+
+    def _batch_progress(self, answered):
+        self.batched_calls = answered
+
+    def _stream(self, index, section, partial_text):
+        self.previews[(index, section)] = partial_text
+
+
+class JobQueue:
+    '''
+    Local worker pool with a job table shared by every session of the app.
+    Submitting the same paper with the same model, options and execution
+    mode again returns the existing job instead of starting another one;
+    failed jobs are resubmitted. Only the `max_jobs` most recent jobs are kept. With a
+    CheckpointStore, a paper whose job was lost (e.g. the process restarted)
+    resumes from what the earlier job had finished. Finished papers are added
+    to `paper_index`, which the similar papers search uses, and saved to
+    `library` (a BundleLibrary).
+    '''
+    def __init__(self, max_workers=2, max_jobs=100, checkpoints=None, paper_index=None, library=None):
+        self.max_jobs = max_jobs
+        self.checkpoints = checkpoints
+        self.paper_index = paper_index
+        self.library = library
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='explainer-job')
+        self._jobs = OrderedDict()
+        self._by_key = {}
+        self._lock = threading.Lock()
+        self._loop = None
+
+    @staticmethod
+    def job_key(content_hash, api_provider, model_name, options, summarization_method, execution_mode='Async'):
+        relevant = {name: value for name, value in options.items() if name not in NON_RESULT_OPTIONS}
+        tpm = RateLimiter.resolve_limits(api_provider, **(options.get('rate_limits') or {})).get('tpm')
+        relevant['chunk_budget'] = LLMSelector.get_chunk_budget(model_name, tpm)
+        return LLMCache.key(content_hash, api_provider, model_name, json.dumps(relevant, sort_keys=True), summarization_method,
+                            execution_mode)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run_coroutine(self, coroutine):
+        '''
+        Runs `coroutine` on the queue's long-lived event loop and waits for it.
+        Async jobs share that loop so the cached LLM clients can keep reusing
+        their async connection pools, which are bound to the loop that opened them.
+        '''
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='explainer-job-loop', daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _evict(self):
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.max_jobs:
+                break
+            job = self._jobs[job_id]
+            if job.active:
+                continue
+            del self._jobs[job_id]
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+
+    def submit(self, pdf_bytes, file_name, api_provider, model_name, options, summarization_method='map_reduce',
+               execution_mode='Async', cache=None):
+        key = self.job_key(PaperPreprocessor.content_hash(pdf_bytes), api_provider, model_name, options, summarization_method,
+                           execution_mode)
+        with self._lock:
+            existing = self._by_key.get(key)
+            if existing is not None and existing.status != 'failed':
+                return existing
+            job = Job(uuid.uuid4().hex, key, file_name, execution_mode)
+            self._jobs[job.id] = job
+            self._by_key[key] = job
+            self._evict()
+
+        self._executor.submit(self._run, job, pdf_bytes, api_provider, model_name, options, summarization_method, cache)
+        return job
+
+    def retry_failed(self, job_id):
+        '''
+        Re-requests the failed sections of a finished job in the background.
+        '''
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.active or job.result is None or not job.result.failed_sections():
+                return job
+            job.status = 'queued'
+            job.message = "Waiting for a free worker..."
+        self._executor.submit(self._retry, job)
+        return job
+
+    def _run(self, job, pdf_bytes, api_provider, model_name, options, summarization_method, cache):
+        job.status = 'running'
+        try:
+            job.message = "Extracting text from PDF..."
+            with job.telemetry.stage('pdf_extraction'):
+                paper_text = PaperPreprocessor.extract_text_from_bytes(pdf_bytes)
+
+            job.message = f"Initializing {model_name} model from {api_provider}..."
+            generator = create_generator(api_provider, model_name, options.get('rate_limits'), cache, telemetry=job.telemetry,
+                                         fallbacks=options.get('fallbacks'), hedge_budget=options.get('hedge_budget', 0.0),
+                                         token_budget=options.get('token_budget'), prefix_prompts=options.get('prefix_prompts', False),
+                                         paper_index=self.paper_index)
+            job.pipeline = ExplanationPipeline(generator, options, summarization_method, metadata={'file_name': job.file_name},
+                                               checkpoints=self.checkpoints)
+
+            job.message = "Summarizing the paper..."
+            callbacks = {
+                'on_start': lambda result: job._start(result, job.pipeline.total_calls(result)),
+                'on_result': job._update,
+                'on_token': job._stream if options.get('stream_tokens') else None,
+            }
+            if job.execution_mode == "Async":
+                job.result = self._run_coroutine(job.pipeline.run_async(paper_text, **callbacks))
+            elif job.execution_mode == "Batch API":
+                runner = ProviderBatchRunner(on_start=lambda _, result: callbacks['on_start'](result),
+                                             on_status=lambda message: setattr(job, 'message', message),
+                                             on_result=lambda _, index, results: job._update(index, results),
+                                             on_progress=lambda _, answered: job._batch_progress(answered))
+                [outcome] = self._run_coroutine(runner.run_async([(job.pipeline, paper_text)]))
+                if isinstance(outcome, BaseException):
+                    raise outcome
+                job.result = outcome
+            else:
+                job.result = job.pipeline.run_sync(paper_text, **callbacks)
+            self._save(job)
+            self._finish(job)
+        except Exception as e:
+            self._finish(job, e)
+
+    def _retry(self, job):
+        job.status = 'running'
+        try:
+            job._start(job.result, len(job.result.failed_sections()))
+            job.message = "Retrying failed sections..."
+            if job.execution_mode != "Non-Async":
+                self._run_coroutine(job.pipeline.retry_failed_async(job.result, on_result=job._update))
+            else:
+                job.pipeline.retry_failed_sync(job.result, on_result=job._update)
+            self._save(job)
+            self._finish(job)
+        except Exception as e:
+            self._finish(job, e)
+
+    def _save(self, job):
+        # The result is still shown if it can't be saved
+        if self.library is not None:
+            try:
+                self.library.save(job.result)
+            except OSError:
+                logger.exception("Could not save %s to the library", job.file_name)
+
+    @staticmethod
+    def _finish(job, error=None):
+        job.previews.clear()
+        job.finished = time.time()
+        if error is None:
+            job.status = 'done'
+            job.message = "Process Completed!"
+        else:
+            job.status = 'failed'
+            job.error = f"{type(error).__name__}: {error}"
+            job.message = "Processing failed"
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+class LLMCache:
+    '''
+    Disk-backed, content-addressed cache for LLM responses.
+
+    Keys are a hash of (provider, model, rendered prompt), so a result is reused
+    whenever exactly the same request would be sent again, whichever paper or
+    user it came from. Entries expire after `ttl` seconds and the least recently
+    used ones are evicted once the stored values exceed `max_bytes`.
+    '''
+    def __init__(self, path=None, max_bytes=512 * 1024 * 1024, ttl=30 * 24 * 3600):
+        if path is None:
+            path = os.path.join(os.getenv('EXPLAINER_CACHE_DIR', '.cache'), 'llm_cache.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+            'created REAL NOT NULL, accessed REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._conn.commit()
+        self.purge_expired()
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None or (self.ttl and row[1] + self.ttl < now):
+                if row is not None:
+                    self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+
+            self._conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, value, len(value.encode('utf-8')), now, now)
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% so we don't pay for an eviction pass on every insert
+        target = self.max_bytes * 0.9
+        for key, size in self._conn.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+            if total <= target:
+                break
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+
+    def purge_expired(self):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._conn.execute('DELETE FROM entries WHERE created < ?', (time.time() - self.ttl,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM entries')
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
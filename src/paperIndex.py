@@ -0,0 +1,184 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from array import array
+from collections import Counter
+
+TOKEN = re.compile(r'[a-z][a-z0-9]+|\d+[a-z]\w*')
+STOPWORDS = frozenset((
+    'about also an and are as at be been but by can for from has have in into is it its may more not of on or our such '
+    'than that the their then there these this those to was we were which while with within without'
+).split())
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Documents rescored with vectors, and the vectors' share of the blended score
+RERANK_CANDIDATES = 50
+VECTOR_WEIGHT = 0.3
+SNIPPET_CHARS = 300
+
+
+def tokenize(text):
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def hashed_vector(counts, dims):
+    '''
+    Compact signed feature-hashing vector of term counts, L2-normalized and
+    quantized to int8.
+    '''
+    values = [0.0] * dims
+    for term, count in counts.items():
+        digest = zlib.crc32(term.encode('utf-8'))
+        values[digest % dims] += (1.0 + math.log(count)) * (1 if digest & 0x80000000 else -1)
+    norm = math.sqrt(sum(value * value for value in values)) or 1.0
+    return array('b', [round(127 * value / norm) for value in values])
+
+
+class PaperIndex:
+    '''
+    Local retrieval index over the summaries and chunks of every processed
+    paper: a BM25 inverted index in SQLite, optionally plus compact hashed
+    term vectors (`vector_dims` > 0) used to rerank the best BM25 matches.
+    Papers are added one at a time as they finish; searching needs no network
+    and takes milliseconds.
+    '''
+    def __init__(self, path=None, vector_dims=None):
+        if path is None:
+            path = os.path.join(os.getenv('EXPLAINER_CACHE_DIR', '.cache'), 'paper_index.sqlite')
+        if vector_dims is None:
+            vector_dims = int(os.getenv('EXPLAINER_INDEX_VECTOR_DIMS', '0'))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.path = path
+        self.vector_dims = vector_dims
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS docs ('
+            'doc_id INTEGER PRIMARY KEY, paper_id TEXT NOT NULL, title TEXT, kind TEXT NOT NULL, position INTEGER, '
+            'text TEXT NOT NULL, length INTEGER NOT NULL, vector BLOB)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS docs_paper ON docs (paper_id)')
+        # Covering indexes for scoring, so it reads neither the postings rows nor the documents' text
+        self._conn.execute('CREATE INDEX IF NOT EXISTS docs_scoring ON docs (doc_id, paper_id, length)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, doc_id INTEGER NOT NULL, tf INTEGER NOT NULL)')
+        self._conn.execute('DROP INDEX IF EXISTS postings_term')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS postings_term_doc ON postings (term, doc_id, tf)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id)')
+        self._conn.commit()
+
+    def _remove(self, paper_id):
+        self._conn.execute('DELETE FROM postings WHERE doc_id IN (SELECT doc_id FROM docs WHERE paper_id = ?)', (paper_id,))
+        self._conn.execute('DELETE FROM docs WHERE paper_id = ?', (paper_id,))
+
+    def add_paper(self, paper_id, title, summary, chunks):
+        '''
+        Indexes a paper's summary and chunk texts, replacing any earlier
+        version of the same paper.
+        '''
+        docs = [('summary', None, summary)] + [('chunk', position, text) for position, text in enumerate(chunks)]
+        with self._lock:
+            self._remove(paper_id)
+            for kind, position, text in docs:
+                counts = Counter(tokenize(text))
+                if not counts:
+                    continue
+                vector = hashed_vector(counts, self.vector_dims).tobytes() if self.vector_dims else None
+                cursor = self._conn.execute(
+                    'INSERT INTO docs (paper_id, title, kind, position, text, length, vector) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (paper_id, title, kind, position, text, sum(counts.values()), vector))
+                self._conn.executemany('INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)',
+                                       [(term, cursor.lastrowid, tf) for term, tf in counts.items()])
+            self._conn.commit()
+
+    def remove_paper(self, paper_id):
+        with self._lock:
+            self._remove(paper_id)
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(DISTINCT paper_id) FROM docs').fetchone()[0]
+
+    def _bm25(self, terms, exclude, limit, per_paper=False):
+        '''
+        The `limit` best (doc_id, paper_id, score) by BM25, or with per_paper
+        the best document of each of the `limit` best papers. Scores are
+        summed per document in SQL; only the query terms' document
+        frequencies and the results come back to Python.
+        '''
+        n_docs, avg_length = self._conn.execute('SELECT COUNT(*), AVG(length) FROM docs').fetchone()
+        if not n_docs:
+            return []
+        placeholders = ",".join("?" * len(terms))
+        frequencies = self._conn.execute(
+            f'SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) GROUP BY term', list(terms)).fetchall()
+        if not frequencies:
+            return []
+        # Each query term's weight: its count in the query times its idf, times (k1 + 1)
+        weights = [value for term, df in frequencies
+                   for value in (term, terms[term] * math.log(1 + (n_docs - df + 0.5) / (df + 0.5)) * (BM25_K1 + 1))]
+        query = (f'WITH query (term, weight) AS (VALUES {",".join(["(?, ?)"] * len(frequencies))}), '
+                 'scored AS (SELECT d.doc_id, d.paper_id, SUM(q.weight * p.tf / (p.tf + ? * (1 - ? + ? * d.length / ?))) AS score '
+                 'FROM query q JOIN postings p ON p.term = q.term JOIN docs d INDEXED BY docs_scoring ON d.doc_id = p.doc_id '
+                 'WHERE d.paper_id IS NOT ? GROUP BY d.doc_id) ')
+        if per_paper:
+            # SQLite takes the bare doc_id from the row holding MAX(score)
+            query += 'SELECT doc_id, paper_id, MAX(score) AS best FROM scored GROUP BY paper_id ORDER BY best DESC, doc_id LIMIT ?'
+        else:
+            query += 'SELECT doc_id, paper_id, score FROM scored ORDER BY score DESC, doc_id LIMIT ?'
+        return self._conn.execute(query, weights + [BM25_K1, BM25_B, BM25_B, avg_length, exclude, limit]).fetchall()
+
+    def _rerank(self, ranked, query_counts):
+        placeholders = ",".join("?" * len(ranked))
+        vectors = dict(self._conn.execute(f'SELECT doc_id, vector FROM docs WHERE doc_id IN ({placeholders})',
+                                          [doc_id for doc_id, _, _ in ranked]))
+        query = hashed_vector(query_counts, self.vector_dims)
+        best = ranked[0][2]
+        reranked = []
+        for doc_id, paper_id, score in ranked:
+            blob = vectors.get(doc_id)
+            similarity = 0.0
+            if blob is not None and len(blob) == self.vector_dims:
+                similarity = sum(a * b for a, b in zip(query, array('b', blob))) / (127 * 127)
+            reranked.append((doc_id, paper_id, (1 - VECTOR_WEIGHT) * score / best + VECTOR_WEIGHT * max(0.0, similarity)))
+        return sorted(reranked, key=lambda row: -row[2])
+
+    def search(self, text, k=5, exclude=None):
+        '''
+        input:
+            text: query, e.g. the summary of the paper being explained
+            k: number of papers to return
+            exclude: paper_id to leave out (the paper itself)
+        output:
+            list of {'paper_id', 'title', 'score', 'kind', 'snippet'}, one per
+            paper, best match first
+        '''
+        query_counts = Counter(tokenize(text))
+        if not query_counts:
+            return []
+        with self._lock:
+            # A paper is as relevant as its best matching summary or chunk
+            if self.vector_dims:
+                ranked = self._bm25(query_counts, exclude, RERANK_CANDIDATES)
+                if not ranked:
+                    return []
+                best = {}
+                for doc_id, paper_id, score in self._rerank(ranked, query_counts):
+                    best.setdefault(paper_id, (doc_id, paper_id, score))
+                ranked = list(best.values())[:k]
+            else:
+                ranked = self._bm25(query_counts, exclude, k, per_paper=True)
+            if not ranked:
+                return []
+
+            placeholders = ",".join("?" * len(ranked))
+            docs = {row[0]: row[1:] for row in self._conn.execute(
+                f'SELECT doc_id, title, kind, substr(text, 1, ?) FROM docs WHERE doc_id IN ({placeholders})',
+                [SNIPPET_CHARS] + [doc_id for doc_id, _, _ in ranked])}
+        return [{'paper_id': paper_id, 'title': docs[doc_id][0], 'score': score, 'kind': docs[doc_id][1], 'snippet': docs[doc_id][2]}
+                for doc_id, paper_id, score in ranked]
@@ -0,0 +1,408 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from LLMSelect import LLMSelector
+from asyncExplainer import AsyncExplanationGenerator, mark_overlap
+from budget import TokenBudget
+from checkpoint import CheckpointStore
+from llmCache import LLMCache
+from chunkClassifier import ChunkClassifier
+from rateLimiter import RateLimiter
+from preprocessor import PaperPreprocessor
+from results import ChunkResult, PaperResult
+from router import LLMRouter, Route
+
+# Chunks explained at once with the provisional context while the summary is written
+SPECULATION_WINDOW = 4
+
+
+def selected_sections(options):
+    sections = ['Main Explanation']
+    if options.get('include_examples'):
+        sections.append('Examples')
+    if options.get("explain_prereq"):
+        sections.append('Prerequisites')
+    if options.get("explain_math"):
+        sections.append('Mathematical Concepts')
+    return sections
+
+
+def create_generator(api_provider, model_name, rate_limits=None, cache=None, llm=None, telemetry=None,
+                     fallbacks=None, hedge_budget=0.0, token_budget=None, prefix_prompts=False, paper_index=None):
+    '''
+    `fallbacks` is an ordered list of equivalent (api_provider, model_name)
+    pairs tried when the primary model fails or, with a `hedge_budget`, is slow.
+    Fallback models use their provider's default rate limits. `token_budget`
+    caps the tokens the generator may use (None or 0 = unlimited).
+    Similar papers are looked up in `paper_index` (a PaperIndex).
+    '''
+    if llm is None:
+        llm = LLMSelector.get_llm(api_provider, model_name)
+    rate_limiter = RateLimiter.for_model(api_provider, model_name, **(rate_limits or {}))
+    router = None
+    if fallbacks:
+        routes = [Route(api_provider, model_name, llm, rate_limiter)]
+        routes += [Route(provider, model, LLMSelector.get_llm(provider, model), RateLimiter.for_model(provider, model))
+                   for provider, model in fallbacks]
+        router = LLMRouter(routes, hedge_budget=hedge_budget)
+    return AsyncExplanationGenerator(llm, rate_limiter=rate_limiter, cache=cache, api_provider=api_provider,
+                                     model_name=model_name, telemetry=telemetry, router=router,
+                                     token_budget=TokenBudget(token_budget), prefix_prompts=prefix_prompts,
+                                     paper_index=paper_index)
+
+
+class ExplanationPipeline:
+    '''
+    Headless paper text -> PaperResult pipeline shared by the Streamlit app,
+    the benchmark and batch tools. Optional callbacks:
+        on_start(result): the summary is ready and result.chunks holds the empty chunks
+        on_result(index, results): a request for chunk `index` finished and was stored
+            (results is empty if it failed; the failure is recorded in chunk.errors)
+        on_token(index, section, partial_text): token-level streaming updates
+    '''
+    def __init__(self, generator, options, summarization_method='map_reduce', metadata=None, checkpoints=None):
+        self.generator = generator
+        self.options = options
+        self.summarization_method = summarization_method
+        self.sections = selected_sections(options)
+        self.metadata = metadata or {}
+        self.checkpoints = checkpoints
+
+    def pending(self, result):
+        '''
+        (chunk_index, section) pairs that still need a request.
+        '''
+        return [(chunk.index, section) for chunk in result.chunks for section in self.sections if chunk.get(section) is None]
+
+    def total_calls(self, result):
+        pending = result.provisional_sections() if result.metadata.get('rerun') else self.pending(result)
+        return len({index for index, _ in pending}) if self.options.get("fused") else len(pending)
+
+    def _run_key(self, paper_text):
+        if self.checkpoints is None:
+            return None
+        return CheckpointStore.run_key(paper_text, self.generator.api_provider, self.generator.model_name,
+                                       self.summarization_method, self.options['difficulty'])
+
+    def _checkpointed_summary(self, run_key):
+        return None if run_key is None else self.checkpoints.get_summary(run_key)
+
+    def _checkpoint_summary(self, run_key, summary):
+        if run_key is not None:
+            self.checkpoints.set_summary(run_key, summary)
+
+    def _split(self, paper_text):
+        # Split once; the summary and the explanations share the chunks
+        return PaperPreprocessor.split_with_offsets(self.generator.text_splitter, paper_text)
+
+    def _start(self, summary, paper_text, paper_chunks, run_key=None):
+        metadata = dict(self.metadata, **{
+            'model_name': self.generator.model_name,
+            'api_provider': self.generator.api_provider,
+            'difficulty': self.options['difficulty'],
+            'sections': self.sections,
+            'summarization_method': self.summarization_method,
+            'paper_id': LLMCache.key('paper', paper_text),
+        })
+        chunks = [ChunkResult(index, chunk, start=start, overlap=overlap) for index, (start, overlap, chunk) in enumerate(paper_chunks)]
+        result = PaperResult(summary, chunks, metadata=metadata)
+        if self.options.get("skip_chunks", True):
+            self._skip_chunks(result)
+        if run_key is not None:
+            result.metadata['run_key'] = run_key
+            self._restore(result)
+        return result
+
+    def _restore(self, result):
+        # Sections finished by an earlier run of the same paper that was interrupted
+        stored = self.checkpoints.get_results(result.metadata['run_key'])
+        restored = 0
+        for chunk in result.chunks:
+            chunk_key = CheckpointStore.chunk_key(chunk.text)
+            for section in self.sections:
+                value, provisional = stored.get((chunk_key, section), (None, False))
+                if value is not None and chunk.get(section) is None:
+                    chunk.set(section, value, provisional=provisional)
+                    restored += 1
+        result.metadata['resumed_calls'] = restored
+
+    def _finish_checkpoints(self, result):
+        # Nothing is left to resume, and the checkpoints would replay the answers even with the response cache off
+        run_key = result.metadata.get('run_key')
+        if run_key is not None and self.checkpoints is not None and not result.failed_sections():
+            self.checkpoints.delete(run_key)
+
+    def _index(self, result):
+        # Finished papers can be found as similar papers by later ones
+        if self.generator.paper_index is not None:
+            self.generator.paper_index.add_paper(result.metadata['paper_id'], result.metadata.get('file_name'),
+                                                 result.summary, [chunk.new_text for chunk in result.chunks])
+
+    def _skip_chunks(self, result):
+        # Reference lists get no requests, chunks without math no math request
+        for chunk in result.chunks:
+            for section in ChunkClassifier.skipped_sections(chunk.text, self.sections):
+                chunk.skip(section)
+                self.generator.telemetry.record_skip(section)
+        result.metadata['skipped_calls'] = len(result.skipped_sections())
+
+    def _store(self, result, index, results, provisional=False):
+        chunk = result.chunks[index]
+        run_key = result.metadata.get('run_key') if self.checkpoints is not None else None
+        for section, text in results.items():
+            chunk.set(section, text, provisional=provisional)
+            if run_key is not None:
+                self.checkpoints.set_result(run_key, CheckpointStore.chunk_key(chunk.text), section, text, provisional)
+
+    @staticmethod
+    def _start_rerun(result, on_start):
+        result.metadata['rerun'] = True
+        if on_start is not None:
+            on_start(result)
+
+    @staticmethod
+    def _failure_handler(result):
+        def on_error(index, sections, error):
+            for section in sections:
+                result.chunks[index].fail(section, f"{type(error).__name__}: {error}")
+        return on_error
+
+    async def _explain_async(self, result, on_result, on_token, fused, pending=None, provisional_context=None):
+        # Overlap with the previous chunk is sent as context only, so it isn't explained twice
+        paper_chunks = [mark_overlap(chunk.text, chunk.overlap) for chunk in result.chunks]
+        provisional = provisional_context is not None
+        context = result.summary if provisional_context is None else provisional_context
+        async for index, results in self.generator.iter_explanations_async(context, paper_chunks, self.sections,
+                                                                           self.options['difficulty'], fused=fused, on_token=on_token,
+                                                                           on_error=self._failure_handler(result), pending=pending):
+            self._store(result, index, results, provisional)
+            if on_result is not None:
+                on_result(index, results)
+
+    def _explain_sync(self, result, on_result, on_token, fused, pending=None, provisional_context=None):
+        paper_chunks = [mark_overlap(chunk.text, chunk.overlap) for chunk in result.chunks]
+        provisional = provisional_context is not None
+        context = result.summary if provisional_context is None else provisional_context
+        for index, results in self.generator.iter_explanations_sync(context, paper_chunks, self.sections,
+                                                                    self.options['difficulty'], fused=fused, on_token=on_token,
+                                                                    on_error=self._failure_handler(result), pending=pending):
+            self._store(result, index, results, provisional)
+            if on_result is not None:
+                on_result(index, results)
+
+    async def retry_failed_async(self, result, on_result=None, on_token=None):
+        '''
+        Re-requests only the (chunk, section) pairs marked as failed in result,
+        one request per section. Sections that fail again stay marked.
+        '''
+        pending = result.failed_sections()
+        if pending:
+            self.generator.retry_policy.reset()
+            await self._explain_async(result, on_result, on_token, fused=False, pending=pending)
+            self._finish_checkpoints(result)
+        return result
+
+    def retry_failed_sync(self, result, on_result=None, on_token=None):
+        pending = result.failed_sections()
+        if pending:
+            self.generator.retry_policy.reset()
+            self._explain_sync(result, on_result, on_token, fused=False, pending=pending)
+            self._finish_checkpoints(result)
+        return result
+
+    async def _summarize_async(self, paper_text, paper_chunks, run_key):
+        with self.generator.telemetry.stage('summarization'):
+            summary = await self.generator.summarize_paper_async(paper_text, self.summarization_method,
+                                                                 texts=[chunk for _, _, chunk in paper_chunks])
+        self._checkpoint_summary(run_key, summary)
+        return summary
+
+    def _summarize_sync(self, paper_text, paper_chunks, run_key):
+        with self.generator.telemetry.stage('summarization'):
+            summary = self.generator.summarize_paper(paper_text, self.summarization_method,
+                                                     texts=[chunk for _, _, chunk in paper_chunks])
+        self._checkpoint_summary(run_key, summary)
+        return summary
+
+    async def _find_similar_async(self, summary, paper_id):
+        if asyncio.isfuture(summary):
+            summary = await summary
+        return await self.generator.find_similar_papers_async(summary, self.options.get("include_paper_summary", False),
+                                                              exclude=paper_id)
+
+    async def _speculate_async(self, result, summary_task, on_result, on_token):
+        '''
+        Explains chunks in order with the provisional context in result.summary
+        (the abstract and introduction), SPECULATION_WINDOW chunks at a time,
+        until the summary is ready; the remaining chunks then use the summary.
+        Sections explained before it are checkpointed as provisional and stay
+        so when resumed, unless speculative_rerun requests them again.
+        '''
+        fused = self.options.get("fused", False)
+        provisional = result.summary
+        window = asyncio.Semaphore(SPECULATION_WINDOW)
+        speculated, speculative_tasks = set(), []
+
+        async def speculate(pending):
+            try:
+                await self._explain_async(result, on_result, on_token, fused, pending, provisional_context=provisional)
+            finally:
+                window.release()
+
+        try:
+            for index, sections in AsyncExplanationGenerator._group_pending(self.pending(result)).items():
+                slot = asyncio.ensure_future(window.acquire())
+                await asyncio.wait([slot, summary_task], return_when=asyncio.FIRST_COMPLETED)
+                if summary_task.done():
+                    if slot.done():
+                        window.release()
+                    else:
+                        slot.cancel()
+                    break
+                speculated.add(index)
+                speculative_tasks.append(asyncio.ensure_future(speculate([(index, section) for section in sections])))
+
+            result.summary = await summary_task
+            result.metadata.pop('provisional_summary', None)
+            pending = [(index, section) for index, section in self.pending(result) if index not in speculated]
+            await asyncio.gather(self._explain_async(result, on_result, on_token, fused, pending), *speculative_tasks)
+        except BaseException:
+            for task in speculative_tasks:
+                task.cancel()
+            raise
+
+    def _speculate_sync(self, result, summary_future, on_result, on_token):
+        fused = self.options.get("fused", False)
+        provisional = result.summary
+        for index, sections in AsyncExplanationGenerator._group_pending(self.pending(result)).items():
+            if summary_future.done():
+                break
+            pending = [(index, section) for section in sections]
+            self._explain_sync(result, on_result, on_token, fused, pending, provisional_context=provisional)
+        result.summary = summary_future.result()
+        result.metadata.pop('provisional_summary', None)
+        self._explain_sync(result, on_result, on_token, fused, self.pending(result))
+
+    async def prepare_async(self, paper_text):
+        '''
+        Summarizes the paper and returns its PaperResult with the chunks still
+        to be explained, for callers that send the explanation requests
+        themselves (see providerBatch.ProviderBatchRunner); finish_async
+        completes it.
+        '''
+        self.generator.retry_policy.reset()
+        run_key = self._run_key(paper_text)
+        summary = self._checkpointed_summary(run_key)
+        paper_chunks = self._split(paper_text)
+        if summary is None:
+            summary = await self._summarize_async(paper_text, paper_chunks, run_key)
+        return self._start(summary, paper_text, paper_chunks, run_key)
+
+    async def finish_async(self, result, on_result=None, on_token=None):
+        '''
+        Requests whatever is still missing from result live, one section per
+        request, retries failures once, then adds similar papers and indexes
+        the paper.
+        '''
+        with self.generator.telemetry.stage('explanations'):
+            if self.pending(result):
+                await self._explain_async(result, on_result, on_token, fused=False, pending=self.pending(result))
+            if result.failed_sections() and not self.generator.retry_policy.exhausted:
+                await self._explain_async(result, on_result, on_token, fused=False, pending=result.failed_sections())
+        if self.options.get("find_similar_papers"):
+            result.similar_papers = await self._find_similar_async(result.summary, result.metadata['paper_id'])
+        self._finish_checkpoints(result)
+        self._index(result)
+        return result
+
+    async def run_async(self, paper_text, on_start=None, on_result=None, on_token=None):
+        '''
+        With checkpoints, a rerun of the same paper only requests what is still
+        missing; they are deleted once no section has failed. With
+        speculative_rerun, provisional sections are requested again once the
+        summary is ready, calling on_start(result) again first with
+        result.metadata['rerun'] set, so progress restarts from total_calls.
+        '''
+        self.generator.retry_policy.reset()
+        run_key = self._run_key(paper_text)
+        summary = self._checkpointed_summary(run_key)
+        paper_chunks = self._split(paper_text)
+        speculative = summary is None and self.options.get("speculative", False)
+        if speculative:
+            # Chunks are explained from the abstract and introduction while the summary is written
+            summary = asyncio.ensure_future(self._summarize_async(paper_text, paper_chunks, run_key))
+            result = self._start(PaperPreprocessor.provisional_context(paper_text), paper_text, paper_chunks, run_key)
+            result.metadata.update(speculative=True, provisional_summary=True)
+        else:
+            if summary is None:
+                summary = await self._summarize_async(paper_text, paper_chunks, run_key)
+            result = self._start(summary, paper_text, paper_chunks, run_key)
+        if on_start is not None:
+            on_start(result)
+
+        similar_papers = None
+        if self.options.get("find_similar_papers"):
+            similar_papers = asyncio.ensure_future(self._find_similar_async(summary, result.metadata['paper_id']))
+
+        with self.generator.telemetry.stage('explanations'):
+            try:
+                if speculative:
+                    await self._speculate_async(result, summary, on_result, on_token)
+                else:
+                    await self._explain_async(result, on_result, on_token, self.options.get("fused", False), self.pending(result))
+            except BaseException:
+                if similar_papers is not None:
+                    similar_papers.cancel()
+                raise
+            if self.options.get("speculative_rerun") and result.provisional_sections():
+                self._start_rerun(result, on_start)
+                await self._explain_async(result, on_result, on_token, self.options.get("fused", False), result.provisional_sections())
+                result.metadata.pop('rerun')
+            # One more try for sections that failed, unless the provider already used up the failure budget
+            if result.failed_sections() and not self.generator.retry_policy.exhausted:
+                await self._explain_async(result, on_result, on_token, fused=False, pending=result.failed_sections())
+
+        if similar_papers is not None:
+            result.similar_papers = await similar_papers
+        self._finish_checkpoints(result)
+        self._index(result)
+        return result
+
+    def run_sync(self, paper_text, on_start=None, on_result=None, on_token=None):
+        self.generator.retry_policy.reset()
+        run_key = self._run_key(paper_text)
+        summary = self._checkpointed_summary(run_key)
+        paper_chunks = self._split(paper_text)
+        speculative = summary is None and self.options.get("speculative", False)
+        if speculative:
+            # The summary is written in a background thread while chunks are explained one by one
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='explainer-summary')
+            summary_future = executor.submit(self._summarize_sync, paper_text, paper_chunks, run_key)
+            executor.shutdown(wait=False)
+            result = self._start(PaperPreprocessor.provisional_context(paper_text), paper_text, paper_chunks, run_key)
+            result.metadata.update(speculative=True, provisional_summary=True)
+        else:
+            if summary is None:
+                summary = self._summarize_sync(paper_text, paper_chunks, run_key)
+            result = self._start(summary, paper_text, paper_chunks, run_key)
+        if on_start is not None:
+            on_start(result)
+
+        with self.generator.telemetry.stage('explanations'):
+            if speculative:
+                self._speculate_sync(result, summary_future, on_result, on_token)
+            else:
+                self._explain_sync(result, on_result, on_token, self.options.get("fused", False), self.pending(result))
+            if self.options.get("speculative_rerun") and result.provisional_sections():
+                self._start_rerun(result, on_start)
+                self._explain_sync(result, on_result, on_token, self.options.get("fused", False), result.provisional_sections())
+                result.metadata.pop('rerun')
+            if result.failed_sections() and not self.generator.retry_policy.exhausted:
+                self._explain_sync(result, on_result, on_token, fused=False, pending=result.failed_sections())
+
+        if self.options.get("find_similar_papers"):
+            result.similar_papers = self.generator.find_similar_papers_sync(result.summary, self.options.get("include_paper_summary", False),
+                                                                            exclude=result.metadata['paper_id'])
+        self._finish_checkpoints(result)
+        self._index(result)
+        return result
@@ -0,0 +1,206 @@
+import math
+
+from langchain.chains.summarize import map_reduce_prompt, refine_prompts, stuff_prompt
+
+from LLMSelect import LLMSelector
+from asyncExplainer import (PREFIX_SECTION_PROMPTS, SECTION_PROMPTS, SIMILAR_PAPERS, SIMILAR_PAPERS_PROMPT, build_fused_prompt,
+                            build_prefix_fused_prompt)
+from chunkClassifier import ChunkClassifier
+from paperIndex import SNIPPET_CHARS
+from pipeline import selected_sections
+from preprocessor import PaperPreprocessor, count_tokens
+from providerBatch import BATCH_CLIENTS
+from rateLimiter import RateLimiter
+
+# USD per million (input, output) tokens. Approximate list prices, update them when providers change theirs
+MODEL_PRICES = {
+    'llama-3.1-70b-versatile': (0.59, 0.79),
+    'llama3-70b-8192': (0.59, 0.79),
+    'llama3-8b-8192': (0.05, 0.08),
+    'llama-3.1-8b-instant': (0.05, 0.08),
+    'mixtral-8x7b-32768-groq': (0.24, 0.24),
+    'gemma-7b-it': (0.07, 0.07),
+    'gemma2-9b-it': (0.20, 0.20),
+    'gemini-pro': (0.50, 1.50),
+    'gemini-1.5-pro': (3.50, 10.50),
+    'gemini-1.5-flash': (0.35, 1.05),
+    'gpt-4o': (5.00, 15.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4-turbo': (10.00, 30.00),
+    'gpt-4': (30.00, 60.00),
+    'gpt-3.5-turbo': (0.50, 1.50),
+    'chatgpt-4o-latest': (5.00, 15.00),
+    'claude-3-opus-20240229': (15.00, 75.00),
+    'claude-3-sonnet-20240229': (3.00, 15.00),
+    'claude-3-haiku-20240307': (0.25, 1.25),
+    'mistral-large-2402': (4.00, 12.00),
+    'mistral-large-2407': (3.00, 9.00),
+}
+
+# Typical response lengths, capped by the model's output limit
+SUMMARY_OUTPUT_TOKENS = 300
+SECTION_OUTPUT_TOKENS = 400
+# Rough generation speed used for wall time estimates
+REQUEST_OVERHEAD_SECONDS = 0.5
+SECONDS_PER_OUTPUT_TOKEN = 0.02
+# Concurrent map requests in async summarization (see summarize_paper_async)
+SUMMARY_CONCURRENCY = 8
+
+# Provider batch jobs bill at about half the live price. They promise results within
+# 24 hours, but most finish within one
+BATCH_DISCOUNT = 0.5
+BATCH_TURNAROUND_SECONDS = 3600
+
+EXECUTION_MODES = ["Async", "Non-Async"]
+BATCH_MODE = "Batch API"
+SUMMARIZATION_METHODS = ["map_reduce", "refine", "stuff"]
+
+
+def _template_tokens(prompt_template, **values):
+    values = {name: values.get(name, '') for name in prompt_template.input_variables}
+    return count_tokens(prompt_template.format(**values))
+
+
+class RunPlanner:
+    '''
+    Estimates what processing a paper will take before any request is sent:
+    request count, input/output tokens, wall time under the model's rate
+    limits and cost. Requests are modelled as waves that run one after the
+    other (e.g. map, then reduce, then explanations), each request answering
+    with a typical response length.
+    '''
+    def __init__(self, api_provider, model_name, options, rate_limits=None):
+        self.api_provider = api_provider
+        self.model_name = model_name
+        self.options = options
+        self.limits = RateLimiter.resolve_limits(api_provider, **(rate_limits or {}))
+        self.text_splitter = PaperPreprocessor.get_text_splitter(model_name, self.limits.get('tpm'))
+        max_output = LLMSelector.get_budget(model_name)['max_output']
+        self.summary_tokens = min(SUMMARY_OUTPUT_TOKENS, max_output)
+        self.section_tokens = min(SECTION_OUTPUT_TOKENS, max_output)
+
+    def summary_waves(self, paper_text, chunks, summarization_method):
+        '''
+        output:
+            list of waves, each a list of (input_tokens, output_tokens) requests
+        '''
+        if not chunks:
+            # No extractable text (e.g. a scanned PDF), so no summary is requested
+            return []
+        summary = self.summary_tokens
+        if summarization_method == 'stuff':
+            return [[(_template_tokens(stuff_prompt.PROMPT) + count_tokens(paper_text), summary)]]
+        if summarization_method == 'refine':
+            waves = [[(_template_tokens(refine_prompts.PROMPT) + chunks[0], summary)]]
+            overhead = _template_tokens(refine_prompts.REFINE_PROMPT) + summary
+            return waves + [[(overhead + tokens, summary)] for tokens in chunks[1:]]
+        if summarization_method == 'map_reduce':
+            overhead = _template_tokens(map_reduce_prompt.PROMPT)
+            waves = [[(overhead + tokens, summary) for tokens in chunks]]
+            token_max = LLMSelector.get_chunk_budget(self.model_name, self.limits.get('tpm'))[0]
+            total = summary * len(chunks)
+            while total > token_max:
+                groups = math.ceil(total / token_max)
+                waves.append([(overhead + total // groups, summary)] * groups)
+                total = summary * groups
+            return waves + [[(overhead + total, summary)]]
+        raise ValueError(f"Unsupported summarization method: {summarization_method}")
+
+    def explanation_wave(self, chunk_texts):
+        sections = selected_sections(self.options)
+        difficulty = self.options.get('difficulty', '')
+        prefix = self.options.get('prefix_prompts')
+        prompts = PREFIX_SECTION_PROMPTS if prefix else SECTION_PROMPTS
+        requests = []
+        for text in chunk_texts:
+            needed = list(sections)
+            if self.options.get('skip_chunks', True):
+                skipped = ChunkClassifier.skipped_sections(text, sections)
+                needed = [section for section in sections if section not in skipped]
+            if not needed:
+                continue
+            tokens = count_tokens(text) + self.summary_tokens
+            if self.options.get('fused'):
+                fused_prompt = build_prefix_fused_prompt(needed) if prefix else build_fused_prompt(needed)
+                requests.append((_template_tokens(fused_prompt, difficulty=difficulty) + tokens, self.section_tokens * len(needed)))
+            else:
+                requests.extend((_template_tokens(prompts[section], difficulty=difficulty) + tokens, self.section_tokens)
+                                for section in needed)
+        if self.options.get('find_similar_papers') and self.options.get('include_paper_summary'):
+            # One request summarizes the matches found in the local paper index
+            matches = SIMILAR_PAPERS * SNIPPET_CHARS // 4
+            requests.append((_template_tokens(SIMILAR_PAPERS_PROMPT) + self.summary_tokens + matches, self.section_tokens))
+        return requests
+
+    def wall_time(self, summary_waves, explanations, execution_mode):
+        '''
+        Seconds to run the requests: each wave takes as long as its requests
+        need at the allowed concurrency, and the whole run at least as long as
+        the requests- and tokens-per-minute limits allow.
+        '''
+        concurrency = (self.limits.get('max_concurrency') or math.inf) if execution_mode == "Async" else 1
+        waves = [(wave, min(concurrency, SUMMARY_CONCURRENCY)) for wave in summary_waves] + [(explanations, concurrency)]
+        seconds = 0.0
+        for wave, parallel in waves:
+            latencies = [REQUEST_OVERHEAD_SECONDS + output * SECONDS_PER_OUTPUT_TOKEN for _, output in wave]
+            if latencies:
+                seconds += max(max(latencies), sum(latencies) / parallel)
+
+        requests = [request for wave in summary_waves for request in wave] + explanations
+        rpm, tpm = self.limits.get('rpm'), self.limits.get('tpm')
+        if rpm:
+            seconds = max(seconds, 60.0 * (len(requests) - rpm) / rpm)
+        if tpm:
+            # Prompt and output tokens both count, as with the providers
+            tokens = sum(input_tokens + output_tokens for input_tokens, output_tokens in requests)
+            seconds = max(seconds, 60.0 * (tokens - tpm) / tpm)
+        return seconds
+
+    def cost(self, input_tokens, output_tokens):
+        prices = MODEL_PRICES.get(self.model_name)
+        if prices is None:
+            return None
+        return (input_tokens * prices[0] + output_tokens * prices[1]) / 1_000_000
+
+    def plan(self, paper_text, summarization_method='map_reduce', execution_mode='Async'):
+        chunk_texts = self.text_splitter.split_text(paper_text)
+        return self._plan(paper_text, chunk_texts, summarization_method, execution_mode)
+
+    def _plan(self, paper_text, chunk_texts, summarization_method, execution_mode):
+        chunks = [count_tokens(text) for text in chunk_texts]
+        summary_waves = self.summary_waves(paper_text, chunks, summarization_method)
+        explanations = self.explanation_wave(chunk_texts) if chunk_texts else []
+        requests = [request for wave in summary_waves for request in wave] + explanations
+        input_tokens = sum(tokens for tokens, _ in requests)
+        output_tokens = sum(tokens for _, tokens in requests)
+        if execution_mode == BATCH_MODE:
+            # Only the summary is requested live; the explanations wait for the batch job
+            wall_time = self.wall_time(summary_waves, [], "Async") + (BATCH_TURNAROUND_SECONDS if explanations else 0)
+            cost = self.cost(input_tokens, output_tokens)
+            if cost is not None:
+                cost -= (1 - BATCH_DISCOUNT) * self.cost(sum(tokens for tokens, _ in explanations), sum(tokens for _, tokens in explanations))
+        else:
+            wall_time = self.wall_time(summary_waves, explanations, execution_mode)
+            cost = self.cost(input_tokens, output_tokens)
+        return {
+            'execution_mode': execution_mode,
+            'summarization_method': summarization_method,
+            'chunks': len(chunk_texts),
+            'requests': len(requests),
+            'summary_requests': len(requests) - len(explanations),
+            'explanation_requests': len(explanations),
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'wall_time': wall_time,
+            'cost': cost,
+        }
+
+    def plans(self, paper_text):
+        '''
+        One plan per execution mode and summarization method; the Batch API
+        mode only for providers that have one.
+        '''
+        chunk_texts = self.text_splitter.split_text(paper_text)
+        modes = EXECUTION_MODES + ([BATCH_MODE] if self.api_provider in BATCH_CLIENTS else [])
+        return [self._plan(paper_text, chunk_texts, method, mode)
+                for mode in modes for method in SUMMARIZATION_METHODS]
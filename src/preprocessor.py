@@ -1,30 +1,258 @@
+import atexit
+import hashlib
 import io
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PyPDF2 import PdfReader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from LLMSelect import LLMSelector
+
+logger = logging.getLogger(__name__)
+
+_encoding = None
+_encoding_unavailable = False
+
+
+def count_tokens(text):
+    '''
+    Token count using tiktoken's cl100k_base encoding. It is a close enough
+    proxy for all supported providers; when tiktoken or its encoding data is
+    unavailable we fall back to ~4 characters per token, which can make
+    chunks noticeably larger or smaller than their token budget.
+    '''
+    global _encoding, _encoding_unavailable
+    if _encoding is None and not _encoding_unavailable:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            _encoding_unavailable = True
+            logger.warning("tiktoken is unavailable (%s), estimating token counts as 4 characters per token; "
+                           "install tiktoken for token-accurate chunking", e)
+    if _encoding is None:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+ABSTRACT_HEADER = re.compile(r'^\s*abstract\b', re.I | re.M)
+# Heading of the section after the introduction, e.g. "2 Related Work" or "II. METHOD"
+SECOND_SECTION_HEADER = re.compile(r'^\s*(?:2|II)\.?\s+[A-Z][^\n]{0,80}$', re.M)
+# An abstract header further in than this is more likely a word in the body
+MAX_ABSTRACT_OFFSET = 10000
+PROVISIONAL_CONTEXT_TOKENS = 1500
+
+# Below this many uncached pages, spinning up worker processes costs more than it saves
+PARALLEL_MIN_PAGES = 16
+
+
+def _extract_pages(pdf_reader, page_numbers):
+    '''
+    Returns (page_number, text or None) for each requested page. A page that
+    fails to extract yields None instead of aborting the whole document.
+    '''
+    pages = []
+    for page_number in page_numbers:
+        try:
+            pages.append((page_number, pdf_reader.pages[page_number].extract_text() or ""))
+        except Exception:
+            pages.append((page_number, None))
+    return pages
+
+
+def _extract_page_range(pdf_bytes, start, stop):
+    # Runs in a worker process, which parses its own copy of the PDF
+    return _extract_pages(PdfReader(io.BytesIO(pdf_bytes)), range(start, stop))
+
+
+class PageCache:
+    '''
+    Extracted page text stored on disk under the PDF's content hash, so
+    re-uploads of the same file skip extraction entirely.
+    '''
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.getenv('EXPLAINER_CACHE_DIR', '.cache'), 'pages')
+        self.cache_dir = cache_dir
+
+    def _page_path(self, digest, page_number):
+        return os.path.join(self.cache_dir, digest, f"{page_number}.txt")
+
+    def get(self, digest, page_number):
+        try:
+            with open(self._page_path(digest, page_number), encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, digest, page_number, text):
+        path = self._page_path(digest, page_number)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
 class PaperPreprocessor:
+    _executor = None
+    _executor_lock = threading.Lock()
+    page_cache = PageCache()
+
     @staticmethod
     def extract_text_from_pdf(uploaded_file):
         if uploaded_file.type != "application/pdf":
             raise ValueError("Uploaded file is not a PDF")
-        
+        return PaperPreprocessor.extract_text_from_bytes(uploaded_file.getvalue())
+
+    @staticmethod
+    def content_hash(pdf_bytes):
+        return hashlib.sha256(pdf_bytes).hexdigest()
+
+    @classmethod
+    def _get_executor(cls):
+        # Workers are spawned, not forked: the app and the job queue run threads,
+        # and a forked child can inherit a lock another thread was holding
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+                atexit.register(cls.shutdown_executor)
+            return cls._executor
+
+    @classmethod
+    def shutdown_executor(cls):
+        with cls._executor_lock:
+            executor, cls._executor = cls._executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    @classmethod
+    def extract_pages_from_bytes(cls, pdf_bytes):
+        '''
+        input:
+            pdf_bytes: bytes
+        output:
+            (list of page texts, list of page numbers that failed to extract)
+        '''
         try:
-            pdf_reader = PdfReader(uploaded_file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text()
-            return text
+            pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+            page_count = len(pdf_reader.pages)
         except Exception as e:
             raise ValueError(f"Error reading PDF: {str(e)}")
-    
+
+        digest = cls.content_hash(pdf_bytes)
+        pages = [cls.page_cache.get(digest, page_number) for page_number in range(page_count)]
+        missing = [page_number for page_number, text in enumerate(pages) if text is None]
+
+        if len(missing) < PARALLEL_MIN_PAGES or (os.cpu_count() or 1) == 1:
+            extracted = _extract_pages(pdf_reader, missing)
+        else:
+            # Missing pages are contiguous in practice (usually all of them), so split
+            # their span into one range per worker and send the PDF bytes once per range
+            executor = cls._get_executor()
+            workers = executor._max_workers
+            first, last = missing[0], missing[-1] + 1
+            step = -(-(last - first) // workers)
+            ranges = [(start, min(start + step, last)) for start in range(first, last, step)]
+            futures = [executor.submit(_extract_page_range, pdf_bytes, start, stop) for start, stop in ranges]
+            missing_set = set(missing)
+            try:
+                extracted = [page for future in futures for page in future.result() if page[0] in missing_set]
+            except BrokenProcessPool:
+                # e.g. a worker couldn't start; a broken pool stays broken, so start a new one next time
+                logger.warning("Page extraction workers failed, extracting in this process")
+                cls.shutdown_executor()
+                extracted = _extract_pages(pdf_reader, missing)
+
+        failed = []
+        for page_number, text in extracted:
+            if text is None:
+                failed.append(page_number)
+                pages[page_number] = ""
+            else:
+                pages[page_number] = text
+                cls.page_cache.set(digest, page_number, text)
+
+        if failed:
+            logger.warning("Could not extract text from %d page(s): %s", len(failed), failed)
+        return pages, failed
+
+    @classmethod
+    def iter_pages(cls, pdf_bytes):
+        '''
+        Yields the text of each page in order, extracting (or reading from the
+        page cache) one page at a time so only that page is held in memory.
+        Pages that fail to extract yield "".
+        '''
+        try:
+            pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+            page_count = len(pdf_reader.pages)
+        except Exception as e:
+            raise ValueError(f"Error reading PDF: {str(e)}")
+
+        digest = cls.content_hash(pdf_bytes)
+        for page_number in range(page_count):
+            text = cls.page_cache.get(digest, page_number)
+            if text is None:
+                [(_, text)] = _extract_pages(pdf_reader, [page_number])
+                if text is None:
+                    logger.warning("Could not extract text from page %d", page_number)
+                    text = ""
+                else:
+                    cls.page_cache.set(digest, page_number, text)
+            yield text
+
     @staticmethod
-    def split_text(text, chunk_size = 2000, chunk_overlap = 200, length_function = len):
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=len)
-        splitted_text = text_splitter.split_text(text)
-        return splitted_text
-    
+    def extract_text_from_bytes(pdf_bytes):
+        pages, _ = PaperPreprocessor.extract_pages_from_bytes(pdf_bytes)
+        return "".join(pages)
 
+    @staticmethod
+    def get_text_splitter(model_name=None, tpm=None):
+        chunk_tokens, overlap_tokens = LLMSelector.get_chunk_budget(model_name, tpm)
+        return RecursiveCharacterTextSplitter(chunk_size=chunk_tokens, chunk_overlap=overlap_tokens, length_function=count_tokens)
 
+    @staticmethod
+    def split_with_offsets(text_splitter, text):
+        '''
+        output:
+            list of (start, overlap, chunk): start is the chunk's offset in
+            text (None if it can't be located) and overlap the number of its
+            leading characters already in the previous chunk
+        '''
+        chunks, search_from, previous_end = [], 0, None
+        for chunk in text_splitter.split_text(text):
+            start = text.find(chunk, search_from)
+            if start == -1:
+                chunks.append((None, 0, chunk))
+                previous_end = None
+                continue
+            overlap = 0 if previous_end is None else max(0, min(len(chunk), previous_end - start))
+            chunks.append((start, overlap, chunk))
+            search_from, previous_end = start + 1, start + len(chunk)
+        return chunks
 
-    
+    @staticmethod
+    def provisional_context(text, max_tokens=PROVISIONAL_CONTEXT_TOKENS):
+        '''
+        Abstract and introduction of the paper, capped at max_tokens, to stand
+        in for the summary while it is being written. Falls back to the start
+        of the paper when there are no recognisable headings.
+        '''
+        abstract = ABSTRACT_HEADER.search(text, 0, MAX_ABSTRACT_OFFSET)
+        start = abstract.start() if abstract else 0
+        next_section = SECOND_SECTION_HEADER.search(text, start)
+        context = text[start:next_section.start() if next_section else len(text)].strip() or text.strip()
+        if not context:
+            return ''
+        splitter = RecursiveCharacterTextSplitter(chunk_size=max_tokens, chunk_overlap=0, length_function=count_tokens)
+        return splitter.split_text(context[:max_tokens * 8])[0]
 
+    @staticmethod
+    def split_text(text, model_name=None, tpm=None):
+        return PaperPreprocessor.get_text_splitter(model_name, tpm).split_text(text)
@@ -0,0 +1,411 @@
+'''
+Provider batch APIs (OpenAI Batch, Anthropic Message Batches) for bulk,
+non-interactive runs. Batched requests cost about half the live price and
+don't count against the live rate limits, but the provider may take up to
+24 hours to answer them.
+
+ProviderBatchRunner summarizes one or more papers with live requests, sends
+all of their explanation requests as batch jobs, polls until the jobs end
+and stores the answers in each paper's PaperResult. Requests a batch could
+not answer are sent again as live requests. The SDK clients read
+OPENAI_BASE_URL and ANTHROPIC_BASE_URL, so a run can be pointed at the local
+stub in fakeBatchServer.py.
+'''
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+
+from LLMSelect import LLMSelector
+from asyncExplainer import AsyncExplanationGenerator, mark_overlap, parse_fused_response
+from budget import TokenBudgetExceeded
+
+logger = logging.getLogger(__name__)
+
+# Requests per batch job; providers accept more, but smaller jobs finish (and fail) independently
+MAX_BATCH_REQUESTS = 10000
+POLL_INTERVAL = float(os.getenv('EXPLAINER_BATCH_POLL_SECONDS', 60))
+
+ROLES = {'system': 'system', 'human': 'user', 'ai': 'assistant'}
+
+
+def chat_messages(prompt):
+    # PromptValue -> provider message dicts
+    return [{'role': ROLES[message.type], 'content': message.content} for message in prompt.to_messages()]
+
+
+class BatchResult:
+    '''
+    The answer to one batched request, or the reason there is none.
+    '''
+    __slots__ = ('text', 'error', 'input_tokens', 'output_tokens', 'cache_read_tokens')
+
+    def __init__(self, text=None, error=None, input_tokens=0, output_tokens=0, cache_read_tokens=0):
+        self.text = text
+        self.error = error
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cache_read_tokens = cache_read_tokens
+
+
+class OpenAIBatchClient:
+    '''
+    OpenAI Batch API: the requests are uploaded as a JSONL file of chat
+    completion bodies, and the answers and errors downloaded as two more.
+    '''
+    api_provider = 'openai'
+    ENDED = ('completed', 'failed', 'expired', 'cancelled')
+
+    def __init__(self, model_name, max_tokens, client=None):
+        if client is None:
+            import openai
+            client = openai.OpenAI()
+        self.client = client
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+
+    def submit(self, requests):
+        '''
+        input:
+            requests: list of (custom_id, PromptValue)
+        output:
+            batch id
+        '''
+        lines = [json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions',
+                             'body': {'model': self.model_name, 'max_tokens': self.max_tokens, 'messages': chat_messages(prompt)}})
+                 for custom_id, prompt in requests]
+        input_file = self.client.files.create(file=('requests.jsonl', "\n".join(lines).encode('utf-8')), purpose='batch')
+        return self.client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions', completion_window='24h').id
+
+    def status(self, batch_id):
+        '''
+        (ended, provider status, requests finished so far)
+        '''
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        finished = 0 if counts is None else counts.completed + counts.failed
+        return batch.status in self.ENDED, batch.status, finished
+
+    def cancel(self, batch_id):
+        self.client.batches.cancel(batch_id)
+
+    def results(self, batch_id):
+        '''
+        {custom_id: BatchResult} for the requests the batch has an outcome for.
+        '''
+        batch = self.client.batches.retrieve(batch_id)
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get('response') or {}
+                body = response.get('body') or {}
+                if response.get('status_code') == 200 and body.get('choices'):
+                    usage = body.get('usage') or {}
+                    results[record['custom_id']] = BatchResult(
+                        body['choices'][0]['message']['content'] or "",
+                        input_tokens=usage.get('prompt_tokens', 0), output_tokens=usage.get('completion_tokens', 0),
+                        cache_read_tokens=(usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0)
+                else:
+                    error = record.get('error') or body.get('error') or {}
+                    results[record['custom_id']] = BatchResult(
+                        error=error.get('message') or f"status code {response.get('status_code')}")
+        return results
+
+
+class AnthropicBatchClient:
+    '''
+    Anthropic Message Batches. A leading system message is marked as a
+    cacheable prefix, as with_cache_hints does for live requests.
+    '''
+    api_provider = 'anthropic'
+
+    def __init__(self, model_name, max_tokens, client=None):
+        if client is None:
+            import anthropic
+            client = anthropic.Anthropic()
+        self.client = client
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+
+    def _params(self, prompt):
+        messages = chat_messages(prompt)
+        params = {'model': self.model_name, 'max_tokens': self.max_tokens}
+        if messages[0]['role'] == 'system':
+            params['system'] = [{'type': 'text', 'text': messages[0]['content'], 'cache_control': {'type': 'ephemeral'}}]
+            messages = messages[1:]
+        params['messages'] = messages
+        return params
+
+    def submit(self, requests):
+        batch = self.client.messages.batches.create(requests=[{'custom_id': custom_id, 'params': self._params(prompt)}
+                                                              for custom_id, prompt in requests])
+        return batch.id
+
+    def status(self, batch_id):
+        batch = self.client.messages.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        finished = counts.succeeded + counts.errored + counts.canceled + counts.expired
+        return batch.processing_status == 'ended', batch.processing_status, finished
+
+    def cancel(self, batch_id):
+        self.client.messages.batches.cancel(batch_id)
+
+    def results(self, batch_id):
+        results = {}
+        for entry in self.client.messages.batches.results(batch_id):
+            outcome = entry.result
+            if outcome.type == 'succeeded':
+                message = outcome.message
+                results[entry.custom_id] = BatchResult(
+                    "".join(block.text for block in message.content if block.type == 'text'),
+                    input_tokens=message.usage.input_tokens, output_tokens=message.usage.output_tokens,
+                    cache_read_tokens=message.usage.cache_read_input_tokens or 0)
+            elif outcome.type == 'errored':
+                results[entry.custom_id] = BatchResult(error=outcome.error.error.message)
+            else:
+                results[entry.custom_id] = BatchResult(error=f"request {outcome.type}")
+        return results
+
+
+BATCH_CLIENTS = {'openai': OpenAIBatchClient, 'anthropic': AnthropicBatchClient}
+
+
+def create_batch_client(api_provider, model_name):
+    if api_provider not in BATCH_CLIENTS:
+        raise ValueError(f"{api_provider} has no batch API, use live requests instead")
+    return BATCH_CLIENTS[api_provider](model_name, LLMSelector.get_budget(model_name)['max_output'])
+
+
+class BatchRequest:
+    '''
+    One explanation request of a paper: a single section, or all pending
+    sections of a chunk for fused runs.
+    '''
+    __slots__ = ('custom_id', 'paper', 'index', 'sections', 'section', 'prompt', 'prompt_text', 'key', 'reserved')
+
+    def __init__(self, custom_id, paper, index, sections, section, prompt, key, reserved):
+        self.custom_id = custom_id
+        self.paper = paper
+        self.index = index
+        self.sections = sections
+        # Telemetry label, as for live requests
+        self.section = section
+        self.prompt = prompt
+        self.prompt_text = prompt.to_string()
+        self.key = key
+        self.reserved = reserved
+
+
+class ProviderBatchRunner:
+    '''
+    Explains papers with provider batch jobs, one job per (provider, model)
+    and at most max_requests requests. Summaries are written with live
+    requests, at most max_papers papers at a time, since every explanation
+    request needs one. Responses found in the response cache are not sent,
+    and neither are requests the token budget can't cover up front; like the
+    sections a batch could not answer, they are requested live afterwards,
+    one section per request. on_start(number, result) is called once a
+    paper's summary is ready, on_status(message) while the batches run.
+    on_result(number, index, results) is called whenever a request of the
+    paper is stored, as the pipeline's on_result, and on_progress(number,
+    answered) with how many of its batched requests the provider has
+    answered so far, which are only stored once their job has ended.
+    A timeout (seconds) cancels jobs that haven't ended by then; providers
+    end them themselves after 24 hours.
+    '''
+    def __init__(self, poll_interval=POLL_INTERVAL, max_requests=MAX_BATCH_REQUESTS, max_papers=4, timeout=None,
+                 on_start=None, on_status=None, on_result=None, on_progress=None, clients=None):
+        self.poll_interval = poll_interval
+        self.max_requests = max_requests
+        self.max_papers = max_papers
+        self.timeout = timeout
+        self.on_start = on_start
+        self.on_status = on_status
+        self.on_result = on_result
+        self.on_progress = on_progress
+        # (api_provider, model_name) -> batch client, created on first use
+        self.clients = clients or {}
+
+    def _status(self, message):
+        logger.info(message)
+        if self.on_status is not None:
+            self.on_status(message)
+
+    def _store(self, number, pipeline, result, index, results):
+        pipeline._store(result, index, results)
+        if self.on_result is not None:
+            self.on_result(number, index, results)
+
+    def _client(self, api_provider, model_name):
+        if (api_provider, model_name) not in self.clients:
+            self.clients[(api_provider, model_name)] = create_batch_client(api_provider, model_name)
+        return self.clients[(api_provider, model_name)]
+
+    async def _prepare(self, semaphore, number, pipeline, paper_text):
+        async with semaphore:
+            result = await pipeline.prepare_async(paper_text)
+        if self.on_start is not None:
+            self.on_start(number, result)
+        return result
+
+    def _requests(self, number, pipeline, result):
+        '''
+        Yields the BatchRequests still needed for a paper; cached responses are stored right away.
+        '''
+        generator = pipeline.generator
+        fused = pipeline.options.get("fused", False)
+        difficulty = pipeline.options['difficulty']
+        for index, sections in AsyncExplanationGenerator._group_pending(pipeline.pending(result)).items():
+            chunk = result.chunks[index]
+            input_dict = {'summary': result.summary, 'chunk': mark_overlap(chunk.text, chunk.overlap)}
+            if difficulty is not None:
+                input_dict['difficulty'] = difficulty
+            groups = [sections] if fused else [[section] for section in sections]
+            for group in groups:
+                template = generator.fused_prompt(group) if fused else generator.section_prompt(group[0])
+                section = 'Fused' if fused else group[0]
+                prompt = template.format_prompt(**input_dict)
+                key = generator._cache_key(prompt.to_string())
+                cached = generator._cache_get(key)
+                if cached is not None:
+                    generator.telemetry.record_call(generator.api_provider, generator.model_name, section, cache_hit=True)
+                    self._store(number, pipeline, result, index, parse_fused_response(cached, group) if fused else {section: cached})
+                    continue
+                reserved = generator._reservation(prompt.to_string())
+                try:
+                    # Nothing settles while the batch runs, so a request that has to wait is sent live afterwards
+                    if not generator.token_budget.try_reserve(reserved):
+                        continue
+                except TokenBudgetExceeded:
+                    continue
+                yield BatchRequest(f"paper{number}-chunk{index}-{section.lower().replace(' ', '-')}", number, index,
+                                   group, section, prompt, key, reserved)
+
+    async def _run_batch(self, client, requests, on_progress=None):
+        '''
+        Submits one batch job and waits for it to end, calling
+        on_progress(finished) with the provider's count of finished requests.
+        output:
+            ({custom_id: BatchResult}, seconds waited)
+        '''
+        start = time.perf_counter()
+        batch_id = await asyncio.to_thread(client.submit, [(request.custom_id, request.prompt) for request in requests])
+        self._status(f"Submitted {client.api_provider} batch {batch_id} with {len(requests)} requests")
+        cancelled = False
+        while True:
+            ended, status, finished = await asyncio.to_thread(client.status, batch_id)
+            if on_progress is not None:
+                on_progress(finished)
+            if ended:
+                break
+            if self.timeout is not None and not cancelled and time.perf_counter() - start > self.timeout:
+                # A cancelled batch still ends, with the answers it had so far
+                await asyncio.to_thread(client.cancel, batch_id)
+                cancelled = True
+                self._status(f"Batch {batch_id} timed out, cancelling it")
+            else:
+                self._status(f"Batch {batch_id}: {status}, {finished} of {len(requests)} requests finished "
+                             f"({time.perf_counter() - start:.0f}s)")
+            await asyncio.sleep(self.poll_interval)
+        results = await asyncio.to_thread(client.results, batch_id)
+        self._status(f"Batch {batch_id} {status}: {sum(result.error is None for result in results.values())} of "
+                     f"{len(requests)} requests answered")
+        return results, time.perf_counter() - start
+
+    def _apply(self, papers, request, outcome, waited):
+        pipeline, result = papers[request.paper]
+        generator = pipeline.generator
+        if outcome is None or outcome.error is not None:
+            generator.token_budget.settle(request.reserved, 0)
+            error = "no result" if outcome is None else outcome.error
+            generator.telemetry.record_call(generator.api_provider, generator.model_name, request.section,
+                                            queue_wait=waited, error=f"BatchError: {error}")
+            return
+        generator.token_budget.settle(request.reserved, outcome.input_tokens + outcome.output_tokens, outcome.output_tokens)
+        # The whole wait for the batch counts as queueing; providers don't report per-request latency
+        generator.telemetry.record_call(generator.api_provider, generator.model_name, request.section, queue_wait=waited,
+                                        input_tokens=outcome.input_tokens, output_tokens=outcome.output_tokens,
+                                        cache_read_tokens=outcome.cache_read_tokens)
+        generator._cache_set(request.key, outcome.text)
+        if request.section == 'Fused':
+            self._store(request.paper, pipeline, result, request.index, parse_fused_response(outcome.text, request.sections))
+        else:
+            self._store(request.paper, pipeline, result, request.index, {request.section: outcome.text})
+
+    def _report_progress(self, answered, batch, finished):
+        # Providers count the finished requests of a job, not of a paper; they are split by the papers' shares of the job
+        counts = collections.Counter(request.paper for request in batch)
+        for number, count in counts.items():
+            answered[number][id(batch)] = finished * count // len(batch)
+            if self.on_progress is not None:
+                self.on_progress(number, sum(answered[number].values()))
+
+    async def _run_group(self, papers, requests, answered):
+        # All requests for one (provider, model), in jobs of at most max_requests
+        generator = papers[requests[0].paper][0].generator
+        try:
+            client = self._client(generator.api_provider, generator.model_name)
+        except Exception as e:
+            logger.warning("Batch jobs unavailable, sending %d requests live: %s", len(requests), e)
+            client = None
+
+        async def run(batch):
+            if client is None:
+                outcomes, waited = {}, 0.0
+            else:
+                try:
+                    outcomes, waited = await self._run_batch(
+                        client, batch, on_progress=lambda finished: self._report_progress(answered, batch, finished))
+                except Exception as e:
+                    logger.warning("Batch job failed, sending its %d requests live: %s", len(batch), e)
+                    outcomes, waited = {}, 0.0
+            for request in batch:
+                self._apply(papers, request, outcomes.get(request.custom_id), waited)
+            # The stored answers have been reported through on_result
+            self._report_progress(answered, batch, 0)
+
+        await asyncio.gather(*[run(requests[start:start + self.max_requests])
+                               for start in range(0, len(requests), self.max_requests)])
+
+    def _paper_callback(self, number):
+        # The pipeline's on_result for paper `number`
+        if self.on_result is None:
+            return None
+        return lambda index, results: self.on_result(number, index, results)
+
+    async def run_async(self, papers):
+        '''
+        input:
+            papers: list of (ExplanationPipeline, paper_text)
+        output:
+            list with a PaperResult, or the exception that stopped the paper, per paper
+        '''
+        semaphore = asyncio.Semaphore(self.max_papers)
+        results = await asyncio.gather(*[self._prepare(semaphore, number, pipeline, paper_text)
+                                         for number, (pipeline, paper_text) in enumerate(papers)], return_exceptions=True)
+        prepared = {number: (papers[number][0], result) for number, result in enumerate(results)
+                    if not isinstance(result, BaseException)}
+
+        groups = {}
+        for number, (pipeline, result) in prepared.items():
+            for request in self._requests(number, pipeline, result):
+                groups.setdefault((pipeline.generator.api_provider, pipeline.generator.model_name), []).append(request)
+        # paper number -> {batch job: requests of the paper the provider has answered}
+        answered = collections.defaultdict(dict)
+        start = time.perf_counter()
+        await asyncio.gather(*[self._run_group(prepared, requests, answered) for requests in groups.values()])
+        for telemetry in {id(pipeline.generator.telemetry): pipeline.generator.telemetry for pipeline, _ in prepared.values()}.values():
+            telemetry.record_stage('provider_batch', time.perf_counter() - start)
+
+        finished = await asyncio.gather(*[pipeline.finish_async(result, on_result=self._paper_callback(number))
+                                          for number, (pipeline, result) in prepared.items()], return_exceptions=True)
+        for number, outcome in zip(prepared, finished):
+            results[number] = outcome
+        return results
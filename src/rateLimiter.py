@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+# Conservative defaults roughly matching the free/entry tiers of each provider.
+# None or 0 means "no limit" for that dimension.
+DEFAULT_LIMITS = {
+    'groq': {'rpm': 30, 'tpm': 6000, 'max_concurrency': 4},
+    'google': {'rpm': 15, 'tpm': 1000000, 'max_concurrency': 4},
+    'openai': {'rpm': 500, 'tpm': 30000, 'max_concurrency': 16},
+    'anthropic': {'rpm': 50, 'tpm': 40000, 'max_concurrency': 8},
+    'mistralai': {'rpm': 60, 'tpm': 500000, 'max_concurrency': 8},
+}
+
+
+def estimate_tokens(text):
+    # ~4 characters per token is close enough for scheduling purposes
+    return len(text) // 4 + 1
+
+
+class Reservation:
+    '''
+    Tokens a request holds in the tokens-per-minute window from the time it
+    was let through: its prompt plus the output it is expected to write.
+    Setting `used` to the usage the response reported corrects the
+    reservation when the request is released.
+    '''
+    __slots__ = ('time', 'tokens', 'used')
+
+    def __init__(self, time, tokens):
+        self.time = time
+        self.tokens = tokens
+        self.used = None
+
+
+class QuotaUsage:
+    '''
+    Requests, tokens and calls in flight within the sliding window, shared by
+    every limiter drawing on one provider quota.
+    '''
+    __slots__ = ('lock', 'request_times', 'token_events', 'tokens_in_window', 'active', 'paused_until')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_times = deque()
+        self.token_events = deque()
+        self.tokens_in_window = 0
+        self.active = 0
+        self.paused_until = 0.0
+
+
+class RateLimiter:
+    '''
+    Sliding-window scheduler enforcing requests-per-minute, tokens-per-minute
+    and max-concurrency limits. Like the providers, tokens-per-minute counts
+    prompt and output tokens: requests reserve their expected total and are
+    corrected to what they used once they are released. Limiters for the same (provider, model) share
+    one QuotaUsage, so every pipeline running in the process draws from the
+    same quota, while each run is held to the limits it was created with.
+    '''
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, rpm=None, tpm=None, max_concurrency=None, window=60.0, poll_interval=0.05, usage=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.window = window
+        self.poll_interval = poll_interval
+        self.usage = usage or QuotaUsage()
+
+    @classmethod
+    def for_model(cls, api_provider, model_name, rpm=None, tpm=None, max_concurrency=None):
+        '''
+        Returns a limiter with the given limits that counts the requests and
+        tokens of every caller of (api_provider, model_name). Limits left as
+        None fall back to the provider defaults, 0 disables them. Callers with
+        different limits don't change each other's: a run with rpm=30 waits
+        while 30 requests of any run on the model are in the window, one with
+        rpm=60 only at 60.
+        '''
+        limits = cls.resolve_limits(api_provider, rpm, tpm, max_concurrency)
+        with cls._registry_lock:
+            usage = cls._registry.setdefault((api_provider, model_name), QuotaUsage())
+        return cls(**limits, usage=usage)
+
+    @staticmethod
+    def resolve_limits(api_provider, rpm=None, tpm=None, max_concurrency=None):
+        limits = dict(DEFAULT_LIMITS.get(api_provider, {}))
+        overrides = {'rpm': rpm, 'tpm': tpm, 'max_concurrency': max_concurrency}
+        limits.update({k: v for k, v in overrides.items() if v is not None})
+        return limits
+
+    def pause(self, seconds):
+        '''
+        Hold back every caller for `seconds`, e.g. when the provider answered
+        with a Retry-After hint that applies to the whole quota.
+        '''
+        usage = self.usage
+        with usage.lock:
+            usage.paused_until = max(usage.paused_until, time.monotonic() + seconds)
+
+    def _evict(self, usage, now):
+        cutoff = now - self.window
+        while usage.request_times and usage.request_times[0] <= cutoff:
+            usage.request_times.popleft()
+        while usage.token_events and usage.token_events[0].time <= cutoff:
+            usage.tokens_in_window -= usage.token_events.popleft().tokens
+
+    def _try_acquire(self, tokens):
+        '''
+        Reserve a slot if all limits allow it and return (0, Reservation),
+        otherwise return (seconds to wait before trying again, None).
+        '''
+        now, usage = time.monotonic(), self.usage
+        with usage.lock:
+            self._evict(usage, now)
+            wait = max(0.0, usage.paused_until - now)
+
+            if self.max_concurrency and usage.active >= self.max_concurrency:
+                # Calls in flight don't say when they'll finish, so check again shortly
+                wait = max(wait, self.poll_interval)
+
+            if self.rpm and len(usage.request_times) >= self.rpm:
+                wait = max(wait, usage.request_times[0] + self.window - now)
+
+            # A single request larger than the whole budget is let through once
+            # the window is empty, otherwise it would never be scheduled.
+            if self.tpm and usage.token_events and usage.tokens_in_window + tokens > self.tpm:
+                freed = 0
+                for event in usage.token_events:
+                    freed += event.tokens
+                    if usage.tokens_in_window - freed + tokens <= self.tpm:
+                        break
+                wait = max(wait, event.time + self.window - now)
+
+            if wait > 0:
+                return wait, None
+
+            reservation = Reservation(now, tokens)
+            usage.request_times.append(now)
+            usage.token_events.append(reservation)
+            usage.tokens_in_window += tokens
+            usage.active += 1
+            return 0, reservation
+
+    def release(self, reservation=None):
+        '''
+        Frees the request's concurrency slot and, if reservation.used is set,
+        replaces its reserved tokens with the ones it used.
+        '''
+        usage = self.usage
+        with usage.lock:
+            usage.active -= 1
+            if reservation is None or reservation.used is None:
+                return
+            now = time.monotonic()
+            self._evict(usage, now)
+            if reservation.time > now - self.window:
+                usage.tokens_in_window += reservation.used - reservation.tokens
+                reservation.tokens = reservation.used
+            elif reservation.used > reservation.tokens:
+                # The request outlasted the window, only what it used beyond its reservation still counts
+                extra = Reservation(now, reservation.used - reservation.tokens)
+                usage.token_events.append(extra)
+                usage.tokens_in_window += extra.tokens
+
+    async def acquire(self, tokens=0):
+        while True:
+            wait, reservation = self._try_acquire(tokens)
+            if not wait:
+                return reservation
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens=0):
+        while True:
+            wait, reservation = self._try_acquire(tokens)
+            if not wait:
+                return reservation
+            time.sleep(wait)
+
+    @asynccontextmanager
+    async def limit(self, tokens=0):
+        reservation = await self.acquire(tokens)
+        try:
+            yield reservation
+        finally:
+            self.release(reservation)
+
+    @contextmanager
+    def limit_sync(self, tokens=0):
+        reservation = self.acquire_sync(tokens)
+        try:
+            yield reservation
+        finally:
+            self.release(reservation)
+
@@ -0,0 +1,185 @@
+import html
+import json
+
+# Section name -> attribute on ChunkResult, in display order
+SECTION_FIELDS = {
+    'Prerequisites': 'prerequisites',
+    'Main Explanation': 'main_explanation',
+    'Examples': 'examples',
+    'Mathematical Concepts': 'mathematical_concepts',
+}
+
+SECTION_TITLES = {
+    'Prerequisites': 'Prerequisites',
+    'Main Explanation': 'Explanation',
+    'Examples': 'Examples',
+    'Mathematical Concepts': 'Mathematical Concepts',
+}
+
+
+def _html_block(css_class, text):
+    paragraphs = "".join(f"<p>{html.escape(p)}</p>" for p in text.strip().split("\n\n") if p.strip())
+    return f'<div class="{css_class}">{paragraphs}</div>'
+
+
+class ChunkResult:
+    '''
+    Explanations generated for one chunk of the paper. Sections that were not
+    requested stay None; rendering happens on demand from these fields.
+    Sections whose requests failed are listed in errors (section -> message),
+    sections that were not worth requesting in skipped. start is the chunk's
+    offset in the paper text and overlap the number of leading characters it
+    shares with the previous chunk; they are rendered only once. Sections
+    explained from a provisional context instead of the paper summary are
+    listed in provisional.
+    '''
+    __slots__ = ('index', 'text', 'prerequisites', 'main_explanation', 'examples', 'mathematical_concepts', 'errors', 'skipped',
+                 'start', 'overlap', 'provisional')
+
+    def __init__(self, index, text, prerequisites=None, main_explanation=None, examples=None, mathematical_concepts=None,
+                 errors=None, skipped=None, start=None, overlap=0, provisional=None):
+        self.index = index
+        self.text = text
+        self.start = start
+        self.overlap = overlap
+        self.prerequisites = prerequisites
+        self.main_explanation = main_explanation
+        self.examples = examples
+        self.mathematical_concepts = mathematical_concepts
+        self.errors = errors or {}
+        self.skipped = skipped or []
+        self.provisional = provisional or []
+
+    @property
+    def new_text(self):
+        '''
+        The chunk's text without the part already shown with the previous chunk.
+        '''
+        return self.text[self.overlap:]
+
+    def get(self, section):
+        return getattr(self, SECTION_FIELDS[section])
+
+    def set(self, section, value, provisional=False):
+        setattr(self, SECTION_FIELDS[section], value)
+        self.errors.pop(section, None)
+        if provisional and section not in self.provisional:
+            self.provisional.append(section)
+        elif not provisional and section in self.provisional:
+            self.provisional.remove(section)
+
+    def fail(self, section, message):
+        self.errors[section] = message
+
+    def skip(self, section):
+        self.set(section, "")
+        if section not in self.skipped:
+            self.skipped.append(section)
+
+    def has_sections(self, sections):
+        return all(self.get(section) is not None for section in sections)
+
+    def is_settled(self, sections):
+        '''
+        True once every section has either arrived or failed.
+        '''
+        return all(self.get(section) is not None or section in self.errors for section in sections)
+
+    def sections(self):
+        '''
+        Yields (section, title, content) for every section worth showing.
+        '''
+        for section in SECTION_FIELDS:
+            content = self.get(section)
+            if content is None or not content.strip():
+                continue
+            yield section, SECTION_TITLES[section], content
+
+    def copy(self):
+        return ChunkResult(**self.to_dict())
+
+    def to_markdown(self):
+        parts = [f"\n\n## Chunk {self.index + 1}\n\n{self.new_text}\n\n"]
+        parts.extend(f"### {title}\n\n{content}\n\n" for _, title, content in self.sections())
+        return "".join(parts)
+
+    def to_html(self):
+        parts = [f'<h2 class="chunk-header">Chunk {self.index + 1}</h2>', _html_block("chunk-text", self.new_text)]
+        for _, title, content in self.sections():
+            parts.append(f"<h3>{html.escape(title)}</h3>")
+            parts.append(_html_block("explanation-text", content))
+        return "\n".join(parts)
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.__slots__}
+        data['errors'] = dict(self.errors)
+        data['skipped'] = list(self.skipped)
+        data['provisional'] = list(self.provisional)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class PaperResult:
+    '''
+    Summary plus per-chunk results of one processed paper. Markdown, HTML and
+    JSON are rendered lazily, and from_json restores a result without
+    re-parsing any rendered text.
+    '''
+    __slots__ = ('summary', 'chunks', 'similar_papers', 'metadata')
+
+    def __init__(self, summary, chunks, similar_papers=None, metadata=None):
+        self.summary = summary
+        self.chunks = chunks
+        self.similar_papers = similar_papers
+        self.metadata = metadata or {}
+
+    def skipped_sections(self):
+        return [(chunk.index, section) for chunk in self.chunks for section in chunk.skipped]
+
+    def failed_sections(self):
+        return [(chunk.index, section) for chunk in self.chunks for section in chunk.errors]
+
+    def provisional_sections(self):
+        return [(chunk.index, section) for chunk in self.chunks for section in chunk.provisional]
+
+    def to_markdown(self):
+        parts = [f"# Paper Summary\n\n{self.summary}\n\n"]
+        parts.extend(chunk.to_markdown() for chunk in self.chunks)
+        if self.similar_papers is not None:
+            parts.append(f"# Similar Papers\n\n{self.similar_papers}\n\n")
+        return "".join(parts)
+
+    def to_html(self):
+        parts = ["<h1>Paper Summary</h1>", _html_block("paper-summary", self.summary)]
+        parts.extend(chunk.to_html() for chunk in self.chunks)
+        if self.similar_papers is not None:
+            parts.append("<h1>Similar Papers</h1>")
+            parts.append(_html_block("similar-papers", self.similar_papers))
+        return "\n".join(parts)
+
+    def to_dict(self):
+        return {
+            'summary': self.summary,
+            'chunks': [chunk.to_dict() for chunk in self.chunks],
+            'similar_papers': self.similar_papers,
+            'metadata': self.metadata,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            summary=data['summary'],
+            chunks=[ChunkResult.from_dict(chunk) for chunk in data['chunks']],
+            similar_papers=data.get('similar_papers'),
+            metadata=data.get('metadata'),
+        )
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
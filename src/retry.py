@@ -0,0 +1,102 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Rate limits, timeouts, overload and transient server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+# Matched against the error's class name. 'Connect' covers httpx.ConnectError as well as
+# the SDKs' APIConnectionError, 'RemoteProtocol' a server closing the connection mid-response
+RETRYABLE_ERROR_NAMES = ('Timeout', 'Connect', 'RemoteProtocol', 'RateLimit', 'ServiceUnavailable', 'Overloaded', 'ResourceExhausted')
+
+
+def status_code(error):
+    '''
+    HTTP status of a provider error. The OpenAI, Anthropic and Groq SDKs set
+    error.status_code, httpx errors carry error.response, Google API errors
+    use error.code.
+    '''
+    for candidate in (getattr(error, 'status_code', None),
+                      getattr(getattr(error, 'response', None), 'status_code', None),
+                      getattr(error, 'code', None)):
+        if isinstance(candidate, int):
+            return candidate
+    return None
+
+
+def is_retryable(error):
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS_CODES
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    return any(name in type(error).__name__ for name in RETRYABLE_ERROR_NAMES)
+
+
+def retry_after(error):
+    '''
+    Seconds the provider asked us to wait, from a retry_after attribute or the
+    Retry-After / retry-after-ms response headers. None when there is no hint.
+    '''
+    value = getattr(error, 'retry_after', None)
+    if value is not None:
+        return float(value)
+
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    '''
+    Exponential backoff with full jitter for transient provider errors, never
+    waiting less than the provider's Retry-After hint. failure_budget caps the
+    retries spent on one paper, so a provider that is down fails the remaining
+    calls fast instead of retrying each of them; reset() starts a new paper.
+    '''
+    def __init__(self, max_retries=4, base_delay=1.0, max_delay=60.0, failure_budget=30):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_budget = failure_budget
+        self.retries_spent = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.retries_spent = 0
+
+    @property
+    def exhausted(self):
+        return self.failure_budget is not None and self.retries_spent >= self.failure_budget
+
+    def should_retry(self, error, attempt):
+        '''
+        True if `error` on the given attempt (0-based) may be retried, in which
+        case one retry is charged to the failure budget.
+        '''
+        if attempt >= self.max_retries or not is_retryable(error):
+            return False
+        with self._lock:
+            if self.exhausted:
+                return False
+            self.retries_spent += 1
+            return True
+
+    def delay(self, attempt, error=None):
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hint = retry_after(error) if error is not None else None
+        return backoff if hint is None else max(hint, backoff)
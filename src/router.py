@@ -0,0 +1,268 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from langchain_core.messages import SystemMessage
+
+from budget import TokenBudgetExceeded
+from rateLimiter import estimate_tokens
+from retry import retry_after
+from telemetry import _percentile
+
+
+def with_cache_hints(prompt, api_provider):
+    '''
+    Marks a leading system message as a cacheable prefix for providers that
+    need an explicit hint (Anthropic); the others cache prefixes automatically.
+    '''
+    if api_provider != 'anthropic':
+        return prompt
+    messages = prompt.to_messages()
+    if not messages or messages[0].type != 'system' or not isinstance(messages[0].content, str):
+        return prompt
+    system = SystemMessage(content=[{'type': 'text', 'text': messages[0].content, 'cache_control': {'type': 'ephemeral'}}])
+    return [system] + messages[1:]
+
+
+def reported_tokens(message):
+    '''
+    Prompt plus output tokens the provider reported for a response, or None.
+    '''
+    usage = getattr(message, 'usage_metadata', None)
+    if not usage:
+        return None
+    return usage.get('input_tokens', 0) + usage.get('output_tokens', 0)
+
+
+class Route:
+    '''
+    One (provider, model) a request can be sent to, with its own rate limiter
+    and a window of recent call latencies.
+    '''
+    __slots__ = ('api_provider', 'model_name', 'llm', 'rate_limiter', 'latencies')
+
+    def __init__(self, api_provider, model_name, llm, rate_limiter, window=200):
+        self.api_provider = api_provider
+        self.model_name = model_name
+        self.llm = llm
+        self.rate_limiter = rate_limiter
+        self.latencies = deque(maxlen=window)
+
+    def _failed(self, error):
+        # A Retry-After hint applies to the whole quota, so hold back every caller
+        hint = retry_after(error)
+        if hint:
+            self.rate_limiter.pause(hint)
+
+    async def ainvoke(self, prompt, tokens, on_token=None, sent=None):
+        '''
+        `tokens` is what the request is expected to use, prompt and output.
+        The `sent` event is set once the request leaves the local queue.
+        output:
+            (message, queue_wait, latency)
+        '''
+        prompt = with_cache_hints(prompt, self.api_provider)
+        queued = time.perf_counter()
+        try:
+            async with self.rate_limiter.limit(tokens) as reservation:
+                started = time.perf_counter()
+                if sent is not None:
+                    sent.set()
+                if on_token is None:
+                    message = await self.llm.ainvoke(prompt)
+                else:
+                    message = None
+                    async for piece in self.llm.astream(prompt):
+                        message = piece if message is None else message + piece
+                        on_token(message.content)
+                reservation.used = reported_tokens(message)
+        except Exception as e:
+            self._failed(e)
+            raise
+        latency = time.perf_counter() - started
+        self.latencies.append(latency)
+        return message, started - queued, latency
+
+    def invoke(self, prompt, tokens, on_token=None):
+        prompt = with_cache_hints(prompt, self.api_provider)
+        queued = time.perf_counter()
+        try:
+            with self.rate_limiter.limit_sync(tokens) as reservation:
+                started = time.perf_counter()
+                if on_token is None:
+                    message = self.llm.invoke(prompt)
+                else:
+                    message = None
+                    for piece in self.llm.stream(prompt):
+                        message = piece if message is None else message + piece
+                        on_token(message.content)
+                reservation.used = reported_tokens(message)
+        except Exception as e:
+            self._failed(e)
+            raise
+        latency = time.perf_counter() - started
+        self.latencies.append(latency)
+        return message, started - queued, latency
+
+
+class LLMRouter:
+    '''
+    Sends each request to an ordered list of equivalent routes. A route that
+    errors fails over to the next one. In async runs, a call still unanswered
+    after the primary's `hedge_percentile` latency (counted from when it was
+    sent, not queued) gets a hedged duplicate on the next route and the first
+    answer wins; hedges are capped at `hedge_budget` times the number of
+    requests. A hedge reserves its tokens in `token_budget` as well, and the
+    losing request is recorded and charged to it. Streamed requests are never
+    hedged.
+    '''
+    def __init__(self, routes, hedge_budget=0.0, hedge_percentile=0.95, min_samples=20, telemetry=None, token_budget=None):
+        self.routes = routes
+        self.hedge_budget = hedge_budget
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.telemetry = telemetry
+        self.token_budget = token_budget
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self):
+        return self.routes[0]
+
+    def _event(self, event, route):
+        if self.telemetry is not None:
+            self.telemetry.record_routing(event, route.api_provider, route.model_name)
+
+    def hedge_delay(self, route):
+        '''
+        Seconds after which a call on `route` counts as slow, or None while
+        there are too few samples to tell.
+        '''
+        latencies = list(route.latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        return _percentile(latencies, self.hedge_percentile)
+
+    def _take_hedge(self, tokens):
+        # A hedge is a second paid request, so it needs room in the token budget too
+        with self._lock:
+            if self.hedges >= self.hedge_budget * self.requests:
+                return False
+            if self.token_budget is not None:
+                try:
+                    if not self.token_budget.try_reserve(tokens):
+                        return False
+                except TokenBudgetExceeded:
+                    return False
+            self.hedges += 1
+            return True
+
+    def _settle_loser(self, task, route, prompt, tokens, section, started, cancelled, sent):
+        '''
+        Records the request that lost a hedged race and charges it to the
+        token budget in place of the hedge's reservation.
+        '''
+        fields, used, output_tokens = {'latency': time.perf_counter() - started}, 0, None
+        if cancelled and not sent:
+            # Cancelled while waiting for a rate limiter slot, so never sent
+            if self.token_budget is not None:
+                self.token_budget.settle(tokens, 0)
+            return
+        if cancelled:
+            # Providers may still finish, and bill, a request whose caller has gone
+            input_tokens = estimate_tokens(prompt.to_string())
+            fields.update(input_tokens=input_tokens, output_tokens=max(0, tokens - input_tokens))
+            used = tokens
+        elif task.exception() is not None:
+            fields['error'] = f"{type(task.exception()).__name__}: {task.exception()}"
+        else:
+            usage = task.result()[0].usage_metadata or {}
+            output_tokens = usage.get('output_tokens', 0)
+            fields.update(input_tokens=usage.get('input_tokens', 0), output_tokens=output_tokens)
+            used = fields['input_tokens'] + output_tokens
+        if self.token_budget is not None:
+            self.token_budget.settle(tokens, used, output_tokens)
+        if self.telemetry is not None:
+            self.telemetry.record_call(route.api_provider, route.model_name, section, **fields)
+
+    async def _ainvoke_hedged(self, route, backup, prompt, tokens, tried, section=None):
+        # Adds backup to `tried` once it has been sent the request, so a failover doesn't send it again
+        delay = self.hedge_delay(route)
+        sent = asyncio.Event()
+        primary = asyncio.ensure_future(route.ainvoke(prompt, tokens, sent=sent))
+        started = {primary: time.perf_counter()}
+        routes, waiting, hedge, winner = {primary: route}, None, None, None
+        try:
+            if delay is None:
+                return (route,) + await primary
+
+            # Time spent waiting for a rate limiter slot isn't the provider being slow
+            waiting = asyncio.ensure_future(sent.wait())
+            await asyncio.wait({primary, waiting}, return_when=asyncio.FIRST_COMPLETED)
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self._take_hedge(tokens):
+                return (route,) + await primary
+
+            self._event('hedge', backup)
+            tried.add(backup)
+            hedge_sent = asyncio.Event()
+            hedge = asyncio.ensure_future(backup.ainvoke(prompt, tokens, sent=hedge_sent))
+            routes[hedge], started[hedge] = backup, time.perf_counter()
+            pending, error = set(routes), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return (routes[task],) + task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            if waiting is not None:
+                waiting.cancel()
+            # The losing call, or both if the caller was cancelled while waiting
+            in_flight = {task for task in routes if not task.done()}
+            for task in in_flight:
+                task.cancel()
+            if hedge is not None:
+                # The caller settles the winner's tokens, or the primary's if neither won
+                loser, loser_sent = (primary, sent) if winner is hedge else (hedge, hedge_sent)
+                self._settle_loser(loser, routes[loser], prompt, tokens, section, started[loser],
+                                   cancelled=loser in in_flight, sent=loser_sent.is_set())
+
+    async def ainvoke(self, prompt, tokens, on_token=None, section=None):
+        '''
+        `section` labels the telemetry of hedges that lost.
+        output:
+            (route that answered, message, queue_wait, latency)
+        '''
+        with self._lock:
+            self.requests += 1
+        tried = set()
+        for position, route in enumerate(self.routes):
+            if route in tried:
+                continue
+            tried.add(route)
+            backup = self.routes[position + 1] if position + 1 < len(self.routes) else None
+            try:
+                if backup is None or on_token is not None or not self.hedge_budget:
+                    return (route,) + await route.ainvoke(prompt, tokens, on_token)
+                return await self._ainvoke_hedged(route, backup, prompt, tokens, tried, section)
+            except Exception:
+                if tried.issuperset(self.routes):
+                    raise
+                self._event('failover', route)
+
+    def invoke(self, prompt, tokens, on_token=None):
+        with self._lock:
+            self.requests += 1
+        for position, route in enumerate(self.routes):
+            try:
+                return (route,) + route.invoke(prompt, tokens, on_token)
+            except Exception:
+                if position + 1 == len(self.routes):
+                    raise
+                self._event('failover', route)
@@ -0,0 +1,302 @@
+'''
+Bounded-memory pipeline for very long documents (theses, long reports).
+
+ExplanationPipeline holds the whole paper text and every result in memory
+until the end. StreamingPipeline runs page -> chunk -> explain -> write as a
+chain of generators with bounded hand-offs instead, so memory stays flat
+however long the document is:
+
+- pages are extracted one at a time (PaperPreprocessor.iter_pages)
+- chunks are split as the pages arrive, once, and spooled to a temporary
+  file for the explanation pass
+- the summary pass keeps only the partial summaries
+- at most `window` chunks are being explained or waiting for their turn to
+  be written; each is written in order and dropped
+
+Results are written as JSON lines by ResultStreamWriter. Checkpoints, the
+similar papers search and the stuff summarization method need the whole
+paper and are not available here.
+'''
+import asyncio
+import json
+import os
+import tempfile
+
+from LLMSelect import LLMSelector
+from asyncExplainer import mark_overlap
+from chunkClassifier import ChunkClassifier
+from pipeline import selected_sections
+from preprocessor import PaperPreprocessor
+from results import ChunkResult, PaperResult
+
+# Page text buffered before splitting, in chunks' worth of characters
+BUFFER_CHUNKS = 4
+CHARS_PER_TOKEN = 4
+
+
+def iter_chunks(pages, text_splitter, buffer_chars):
+    '''
+    Splits a stream of page texts the way PaperPreprocessor.split_with_offsets
+    splits the whole text, yielding (start, overlap, chunk) while holding
+    about buffer_chars of text. The last chunk of each split may continue on
+    the next page, so it is split again together with it.
+    '''
+    buffer, buffer_start, previous_end = '', 0, None
+
+    def emit(pieces):
+        nonlocal previous_end
+        for start, _, chunk in pieces:
+            if start is None:
+                previous_end = None
+                yield None, 0, chunk
+                continue
+            start += buffer_start
+            overlap = 0 if previous_end is None else max(0, min(len(chunk), previous_end - start))
+            previous_end = start + len(chunk)
+            yield start, overlap, chunk
+
+    for page in pages:
+        buffer += page
+        if len(buffer) < buffer_chars:
+            continue
+        pieces = PaperPreprocessor.split_with_offsets(text_splitter, buffer)
+        if len(pieces) < 2:
+            continue
+        keep = pieces[-1][0]
+        if keep is None:
+            yield from emit(pieces)
+            buffer_start, buffer = buffer_start + len(buffer), ''
+            continue
+        yield from emit(pieces[:-1])
+        buffer_start, buffer = buffer_start + keep, buffer[keep:]
+    if buffer:
+        yield from emit(PaperPreprocessor.split_with_offsets(text_splitter, buffer))
+
+
+class ChunkSpool:
+    '''
+    Append-only temporary file of (start, overlap, text) chunks readable by
+    index; only the file offsets are kept in memory.
+    '''
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._offsets = []
+
+    def append(self, start, overlap, text):
+        self._file.seek(0, os.SEEK_END)
+        self._offsets.append(self._file.tell())
+        self._file.write(json.dumps([start, overlap, text]).encode('utf-8') + b'\n')
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        self._file.seek(self._offsets[index])
+        return tuple(json.loads(self._file.readline()))
+
+    def close(self):
+        self._file.close()
+
+
+class ResultStreamWriter:
+    '''
+    Writes a result as JSON lines while it is produced: a header with the
+    summary and metadata, one line per chunk in order and a closing line
+    with the counts. Files are written under a temporary name and renamed by
+    close(), so an existing path always holds a complete result. With
+    markdown_path, a Markdown rendering is written alongside.
+    '''
+    def __init__(self, path, markdown_path=None):
+        self.path = path
+        self.markdown_path = markdown_path
+        self.chunks = 0
+        self.failed_sections = 0
+        self.skipped_sections = 0
+        self._file = open(f"{path}.tmp", 'w', encoding='utf-8')
+        self._markdown = None if markdown_path is None else open(f"{markdown_path}.tmp", 'w', encoding='utf-8')
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def start(self, summary, metadata):
+        self._write({'summary': summary, 'metadata': metadata})
+        if self._markdown is not None:
+            self._markdown.write(f"# Paper Summary\n\n{summary}\n\n")
+
+    def write(self, chunk):
+        self._write({'chunk': chunk.to_dict()})
+        self.chunks += 1
+        self.failed_sections += len(chunk.errors)
+        self.skipped_sections += len(chunk.skipped)
+        if self._markdown is not None:
+            self._markdown.write(chunk.to_markdown())
+
+    def close(self):
+        self._write({'end': True, 'chunks': self.chunks, 'failed_sections': self.failed_sections})
+        self._file.close()
+        os.replace(f"{self.path}.tmp", self.path)
+        if self._markdown is not None:
+            self._markdown.close()
+            os.replace(f"{self.markdown_path}.tmp", self.markdown_path)
+
+    def abort(self):
+        for handle, path in ((self._file, self.path), (self._markdown, self.markdown_path)):
+            if handle is not None:
+                handle.close()
+                os.remove(f"{path}.tmp")
+
+
+def iter_result_stream(path):
+    '''
+    Yields the records of a streamed result one line at a time: the header
+    dict, then a ChunkResult per chunk, then the closing dict.
+    '''
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            yield ChunkResult.from_dict(record['chunk']) if 'chunk' in record else record
+
+
+def read_stream_ends(path):
+    '''
+    (header, closing record) of a complete streamed result, or None.
+    '''
+    header = end = None
+    try:
+        for record in iter_result_stream(path):
+            if header is None:
+                header = record
+            elif isinstance(record, dict):
+                end = record
+    except (OSError, ValueError, KeyError):
+        return None
+    return None if end is None else (header, end)
+
+
+def load_result_stream(path):
+    '''
+    Loads a whole streamed result into a PaperResult (for results that fit in memory).
+    '''
+    records = list(iter_result_stream(path))
+    header = records[0]
+    return PaperResult(header['summary'], [record for record in records if isinstance(record, ChunkResult)],
+                       metadata=header['metadata'])
+
+
+class StreamingPipeline:
+    '''
+    Page texts -> streamed result, in two passes over the chunks: the first
+    writes the summary (map_reduce or refine), the second explains the chunks
+    with at most `window` of them in memory and hands each to the writer in
+    order. on_chunk(chunk) is called after each chunk is written.
+    '''
+    def __init__(self, generator, options, summarization_method='map_reduce', metadata=None, window=8):
+        if summarization_method == 'stuff':
+            raise ValueError("The stuff summarization method needs the whole paper text, use map_reduce or refine")
+        self.generator = generator
+        self.options = options
+        self.summarization_method = summarization_method
+        self.sections = selected_sections(options)
+        self.metadata = metadata or {}
+        self.window = window
+        chunk_tokens = LLMSelector.get_chunk_budget(generator.model_name, generator.rate_limiter.tpm)[0]
+        self.buffer_chars = chunk_tokens * CHARS_PER_TOKEN * BUFFER_CHUNKS
+
+    async def _request(self, summary, chunk, pending, fused):
+        def on_error(index, sections, error):
+            for section in sections:
+                chunk.fail(section, f"{type(error).__name__}: {error}")
+
+        async for _, results in self.generator.iter_explanations_async(summary, [mark_overlap(chunk.text, chunk.overlap)], self.sections,
+                                                                       self.options['difficulty'], fused=fused, on_error=on_error,
+                                                                       pending=pending):
+            for section, text in results.items():
+                chunk.set(section, text)
+
+    async def _explain_chunk(self, summary, index, start, overlap, text):
+        chunk = ChunkResult(index, text, start=start, overlap=overlap)
+        if self.options.get("skip_chunks", True):
+            for section in ChunkClassifier.skipped_sections(text, self.sections):
+                chunk.skip(section)
+                self.generator.telemetry.record_skip(section)
+        pending = [(0, section) for section in self.sections if chunk.get(section) is None]
+        if pending:
+            await self._request(summary, chunk, pending, self.options.get("fused", False))
+        # One more try for sections that failed, unless the provider already used up the failure budget
+        if chunk.errors and not self.generator.retry_policy.exhausted:
+            await self._request(summary, chunk, [(0, section) for section in chunk.errors], fused=False)
+        return chunk
+
+    async def _explain(self, summary, spool, writer, on_chunk):
+        window = asyncio.Semaphore(self.window)
+        finished, tasks, errors = {}, set(), []
+        next_index = 0
+
+        async def explain(index):
+            nonlocal next_index
+            try:
+                finished[index] = await self._explain_chunk(summary, index, *spool[index])
+            except BaseException as e:
+                errors.append(e)
+                window.release()
+                raise
+            # Chunks are written in order; a finished chunk keeps its window slot until it is written
+            while next_index in finished:
+                chunk = finished.pop(next_index)
+                writer.write(chunk)
+                if on_chunk is not None:
+                    on_chunk(chunk)
+                next_index += 1
+                window.release()
+
+        try:
+            for index in range(len(spool)):
+                await window.acquire()
+                if errors:
+                    break
+                task = asyncio.ensure_future(explain(index))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def run_async(self, pages, writer, on_chunk=None):
+        '''
+        input:
+            pages: iterable of page texts, e.g. PaperPreprocessor.iter_pages(pdf_bytes)
+            writer: ResultStreamWriter (or any object with start, write and close)
+        '''
+        self.generator.retry_policy.reset()
+        spool = ChunkSpool()
+
+        async def spooled_chunks():
+            chunks = iter_chunks(pages, self.generator.text_splitter, self.buffer_chars)
+            while True:
+                # Page extraction and splitting run in a thread, so other papers' requests carry on meanwhile
+                item = await asyncio.to_thread(next, chunks, None)
+                if item is None:
+                    return
+                start, overlap, chunk = item
+                spool.append(start, overlap, chunk)
+                yield chunk
+
+        try:
+            with self.generator.telemetry.stage('summarization'):
+                summary = await self.generator.summarize_paper_async(None, self.summarization_method, texts=spooled_chunks())
+            writer.start(summary, dict(self.metadata, **{
+                'model_name': self.generator.model_name,
+                'api_provider': self.generator.api_provider,
+                'difficulty': self.options['difficulty'],
+                'sections': self.sections,
+                'summarization_method': self.summarization_method,
+                'streamed': True,
+            }))
+            with self.generator.telemetry.stage('explanations'):
+                await self._explain(summary, spool, writer, on_chunk)
+            writer.close()
+        finally:
+            spool.close()
+        return writer
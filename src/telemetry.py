@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class CallRecord:
+    __slots__ = ('provider', 'model', 'section', 'latency', 'queue_wait', 'input_tokens', 'output_tokens',
+                 'cache_read_tokens', 'retries', 'cache_hit', 'error')
+
+    def __init__(self, provider, model, section, latency=0.0, queue_wait=0.0, input_tokens=0, output_tokens=0,
+                 cache_read_tokens=0, retries=0, cache_hit=False, error=None):
+        self.provider = provider
+        self.model = model
+        self.section = section
+        self.latency = latency
+        self.queue_wait = queue_wait
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        # Prompt tokens the provider served from its prefix cache
+        self.cache_read_tokens = cache_read_tokens
+        self.retries = retries
+        self.cache_hit = cache_hit
+        self.error = error
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Telemetry:
+    '''
+    Per-run record of every LLM call (latency, queue wait, tokens, retries,
+    cache hits) and of pipeline stages such as PDF extraction, tagged by
+    provider, model and section. Exportable as JSON or Prometheus text.
+    '''
+    def __init__(self):
+        self.calls = []
+        self.stages = defaultdict(float)
+        # section -> requests the chunk classifier decided not to send
+        self.skipped = defaultdict(int)
+        # (event, provider, model) -> failovers away from / hedges sent to that route
+        self.routing = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record_call(self, provider, model, section, **fields):
+        with self._lock:
+            self.calls.append(CallRecord(provider, model, section or 'Other', **fields))
+
+    def record_skip(self, section, count=1):
+        with self._lock:
+            self.skipped[section or 'Other'] += count
+
+    def record_routing(self, event, provider, model):
+        with self._lock:
+            self.routing[(event, provider, model)] += 1
+
+    def routing_events(self):
+        with self._lock:
+            return [{'event': event, 'provider': provider, 'model': model, 'count': count}
+                    for (event, provider, model), count in self.routing.items()]
+
+    def record_stage(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+
+    def summary(self):
+        '''
+        One row per (provider, model, section) with call counts, latency
+        statistics and token totals.
+        '''
+        with self._lock:
+            calls = list(self.calls)
+
+        groups = defaultdict(list)
+        for call in calls:
+            groups[(call.provider, call.model, call.section)].append(call)
+
+        rows = []
+        for (provider, model, section), records in groups.items():
+            live = [record for record in records if not record.cache_hit]
+            latencies = [record.latency for record in live]
+            rows.append({
+                'provider': provider,
+                'model': model,
+                'section': section,
+                'calls': len(records),
+                'cache_hits': len(records) - len(live),
+                'errors': sum(record.error is not None for record in records),
+                'retries': sum(record.retries for record in records),
+                'total_latency': sum(latencies),
+                'mean_latency': sum(latencies) / len(latencies) if latencies else 0.0,
+                'p95_latency': _percentile(latencies, 0.95),
+                'total_queue_wait': sum(record.queue_wait for record in live),
+                'input_tokens': sum(record.input_tokens for record in live),
+                'output_tokens': sum(record.output_tokens for record in live),
+                'cache_read_tokens': sum(record.cache_read_tokens for record in live),
+            })
+        return sorted(rows, key=lambda row: row['total_latency'], reverse=True)
+
+    def to_json(self):
+        with self._lock:
+            calls = [call.to_dict() for call in self.calls]
+            stages = dict(self.stages)
+            skipped = dict(self.skipped)
+        return json.dumps({'stages': stages, 'skipped': skipped, 'routing': self.routing_events(), 'summary': self.summary(),
+                           'calls': calls}, indent=2)
+
+    def to_prometheus(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{str(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        rows = self.summary()
+        labels = [{'provider': row['provider'], 'model': row['model'], 'section': row['section']} for row in rows]
+        metric("explainer_llm_calls_total", "counter", "LLM calls, including cache hits",
+               [(label, row['calls']) for label, row in zip(labels, rows)])
+        metric("explainer_llm_cache_hits_total", "counter", "LLM calls served from the response cache",
+               [(label, row['cache_hits']) for label, row in zip(labels, rows)])
+        metric("explainer_llm_errors_total", "counter", "LLM calls that failed after retries",
+               [(label, row['errors']) for label, row in zip(labels, rows)])
+        metric("explainer_llm_retries_total", "counter", "LLM call retries",
+               [(label, row['retries']) for label, row in zip(labels, rows)])
+        metric("explainer_llm_latency_seconds_total", "counter", "Time spent waiting for LLM responses",
+               [(label, row['total_latency']) for label, row in zip(labels, rows)])
+        metric("explainer_llm_queue_wait_seconds_total", "counter", "Time spent waiting for the rate limiter",
+               [(label, row['total_queue_wait']) for label, row in zip(labels, rows)])
+        metric("explainer_llm_tokens_total", "counter", "Tokens sent and received",
+               [(dict(label, direction='input'), row['input_tokens']) for label, row in zip(labels, rows)] +
+               [(dict(label, direction='output'), row['output_tokens']) for label, row in zip(labels, rows)])
+        metric("explainer_llm_cache_read_tokens_total", "counter", "Prompt tokens served from the provider's prefix cache",
+               [(label, row['cache_read_tokens']) for label, row in zip(labels, rows)])
+        with self._lock:
+            stages = dict(self.stages)
+            skipped = dict(self.skipped)
+        metric("explainer_llm_skipped_calls_total", "counter", "Requests not sent because the chunk did not need them",
+               [({'section': section}, count) for section, count in skipped.items()])
+        metric("explainer_llm_routing_events_total", "counter", "Failovers away from and hedged requests sent to a model",
+               [({'event': row['event'], 'provider': row['provider'], 'model': row['model']}, row['count'])
+                for row in self.routing_events()])
+        metric("explainer_stage_seconds_total", "counter", "Time spent in pipeline stages",
+               [({'stage': stage}, seconds) for stage, seconds in stages.items()])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,28 @@
+import os
+import random
+import sys
+
+import pytest
+
+# The modules in src/ import each other by bare name, as when the app is run from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+WORDS = ["model", "paper", "result", "method", "data", "loss", "layer", "token", "proof", "bound"]
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Caches, checkpoints and the library default to EXPLAINER_CACHE_DIR
+    monkeypatch.setenv('EXPLAINER_CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+
+@pytest.fixture
+def paper_text():
+    # Two chunks for the default budget, each with an equation so no math request is skipped
+    rng = random.Random(0)
+    paragraphs = []
+    for _ in range(12):
+        paragraphs.append(" ".join(rng.choice(WORDS) for _ in range(250)))
+        paragraphs.append("L(x) = \\sum_i x_i^2 + \\lambda \\|w\\|_2")
+    return "\n\n".join(paragraphs)
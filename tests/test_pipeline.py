@@ -0,0 +1,177 @@
+import asyncio
+from typing import Any
+
+import pytest
+from langchain_core.pydantic_v1 import PrivateAttr
+
+from asyncExplainer import FUSED_SECTIONS, AsyncExplanationGenerator, parse_fused_response
+from checkpoint import CheckpointStore
+from fakeLLM import FakeChatModel
+from llmCache import LLMCache
+from pipeline import ExplanationPipeline
+from retry import RetryPolicy
+
+ALL_SECTIONS = {'difficulty': 'Graduate', 'include_examples': True, 'explain_prereq': True, 'explain_math': True}
+
+
+class FlakyChatModel(FakeChatModel):
+    '''
+    Fails the first `failures` attempts of every request whose prompt contains `marker`.
+    '''
+    marker: str = ""
+    failures: int = 1
+
+    _failed: Any = PrivateAttr(default_factory=dict)
+
+    def _plan(self, messages):
+        prompt, rng, delay, fail = super()._plan(messages)
+        if self.marker and self.marker in prompt:
+            with self._lock:
+                fail = self._failed.get(prompt, 0) < self.failures
+                if fail:
+                    self._failed[prompt] = self._failed.get(prompt, 0) + 1
+        return prompt, rng, delay, fail
+
+
+def make_pipeline(llm, cache=None, prefix_prompts=False, checkpoints=None, **options):
+    # No backoff: a failed request fails its sections right away
+    generator = AsyncExplanationGenerator(llm, cache=cache, api_provider='fake', model_name='fake',
+                                          retry_policy=RetryPolicy(max_retries=0), prefix_prompts=prefix_prompts)
+    return ExplanationPipeline(generator, dict(ALL_SECTIONS, **options), 'stuff', checkpoints=checkpoints)
+
+
+def section_texts(result):
+    return [{section: chunk.get(section) for section in FUSED_SECTIONS} for chunk in result.chunks]
+
+
+def test_parse_fused_response():
+    text = "<explanation> The idea. </explanation>\n<examples>An example</examples><math>cut off"
+    assert parse_fused_response(text, ['Main Explanation', 'Examples', 'Mathematical Concepts', 'Prerequisites']) == {
+        'Main Explanation': "The idea.",
+        'Examples': "An example",
+    }
+
+
+@pytest.mark.parametrize('prefix_prompts', [False, True])
+def test_fused_run_fills_every_section(paper_text, prefix_prompts):
+    llm = FakeChatModel(latency=0, output_tokens=20)
+    pipeline = make_pipeline(llm, prefix_prompts=prefix_prompts, fused=True)
+    result = asyncio.run(pipeline.run_async(paper_text))
+
+    assert len(result.chunks) == 2
+    # One summary request, then one request per chunk for all four sections
+    assert llm.stats()['calls'] == 1 + len(result.chunks)
+    assert result.failed_sections() == []
+    for texts in section_texts(result):
+        for section, text in texts.items():
+            assert text and "<" not in text, section
+
+
+def test_prefix_prompts_share_the_summary_prefix(paper_text):
+    llm = FakeChatModel(latency=0, output_tokens=20, prefix_caching=True, min_cache_tokens=0)
+    pipeline = make_pipeline(llm, prefix_prompts=True)
+    result = pipeline.run_sync(paper_text)
+
+    assert result.failed_sections() == []
+    calls = [call for call in pipeline.generator.telemetry.calls if call.section != 'Summary (stuff)']
+    assert len(calls) == 8
+    # Every request after the first reuses the system message holding the instructions and summary
+    assert sum(call.cache_read_tokens > 0 for call in calls) == len(calls) - 1
+
+
+@pytest.mark.parametrize('failures', [1, 2])
+def test_failed_sections_are_retried(paper_text, failures):
+    llm = FlakyChatModel(latency=0, output_tokens=20, marker="Provide concrete examples", failures=failures)
+    pipeline = make_pipeline(llm)
+    result = asyncio.run(pipeline.run_async(paper_text))
+
+    if failures == 1:
+        # The run retries failed sections once by itself
+        assert result.failed_sections() == []
+    else:
+        assert result.failed_sections() == [(0, 'Examples'), (1, 'Examples')]
+        assert all(chunk.get('Examples') is None for chunk in result.chunks)
+        assert all(chunk.errors['Examples'].startswith('FakeRateLimitError') for chunk in result.chunks)
+        calls = llm.stats()['calls']
+        updates = []
+        asyncio.run(pipeline.retry_failed_async(result, on_result=lambda index, results: updates.append((index, results))))
+        # Only the failed sections are requested again
+        assert llm.stats()['calls'] == calls + 2
+        assert sorted(index for index, _ in updates) == [0, 1]
+        assert result.failed_sections() == []
+    assert all(chunk.errors == {} for chunk in result.chunks)
+    assert all(text for texts in section_texts(result) for text in texts.values())
+
+
+@pytest.mark.parametrize('mode', ['async', 'sync'])
+def test_cached_responses_are_not_requested_again(paper_text, cache_dir, mode):
+    llm = FakeChatModel(latency=0, output_tokens=20)
+    cache = LLMCache()
+    runs = []
+    for _ in range(2):
+        pipeline = make_pipeline(llm, cache=cache)
+        runs.append(asyncio.run(pipeline.run_async(paper_text)) if mode == 'async' else pipeline.run_sync(paper_text))
+        if len(runs) == 1:
+            calls = llm.stats()['calls']
+
+    assert calls == 1 + 8
+    assert llm.stats()['calls'] == calls
+    assert cache.hits == calls
+    assert runs[1].summary == runs[0].summary
+    assert section_texts(runs[1]) == section_texts(runs[0])
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_interrupted_run_resumes_from_checkpoints(paper_text):
+    checkpoints = CheckpointStore()
+    llm = FakeChatModel(latency=0, output_tokens=20)
+    stored = []
+
+    def interrupt(index, results):
+        stored.append(index)
+        if len(stored) == 3:
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        asyncio.run(make_pipeline(llm, checkpoints=checkpoints).run_async(paper_text, on_result=interrupt))
+
+    # The summary and the three stored sections are restored; only the other five are requested
+    llm.reset_stats()
+    result = asyncio.run(make_pipeline(llm, checkpoints=checkpoints).run_async(paper_text))
+    assert result.metadata['resumed_calls'] == 3
+    assert llm.stats()['calls'] == 8 - 3
+    assert result.failed_sections() == []
+    assert all(text for texts in section_texts(result) for text in texts.values())
+
+    # A finished run leaves nothing to resume, so the next one requests everything again
+    llm.reset_stats()
+    result = asyncio.run(make_pipeline(llm, checkpoints=checkpoints).run_async(paper_text))
+    assert result.metadata['resumed_calls'] == 0
+    assert llm.stats()['calls'] == 1 + 8
+
+
+def test_checkpoints_are_kept_while_sections_failed(paper_text):
+    checkpoints = CheckpointStore()
+    llm = FlakyChatModel(latency=0, output_tokens=20, marker="Provide concrete examples", failures=2)
+    pipeline = make_pipeline(llm, checkpoints=checkpoints)
+    result = asyncio.run(pipeline.run_async(paper_text))
+    run_key = result.metadata['run_key']
+    assert len(checkpoints.get_results(run_key)) == 6
+
+    asyncio.run(pipeline.retry_failed_async(result))
+    assert result.failed_sections() == []
+    assert checkpoints.get_results(run_key) == {} and checkpoints.get_summary(run_key) is None
+
+
+@pytest.mark.parametrize('method', ['refine', 'map_reduce'])
+def test_paper_without_text_is_rejected(method, cache_dir):
+    llm = FakeChatModel(latency=0, output_tokens=20)
+    generator = AsyncExplanationGenerator(llm, cache=LLMCache(), api_provider='fake', model_name='fake')
+    with pytest.raises(ValueError, match="no extractable text"):
+        asyncio.run(generator.summarize_paper_async("", method))
+    with pytest.raises(ValueError, match="no extractable text"):
+        generator.summarize_paper("", method)
+    assert llm.stats()['calls'] == 0
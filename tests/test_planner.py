@@ -0,0 +1,21 @@
+from planner import SUMMARIZATION_METHODS, RunPlanner
+
+OPTIONS = {'difficulty': 'Graduate', 'include_examples': True, 'explain_prereq': True, 'explain_math': True,
+           'find_similar_papers': True, 'include_paper_summary': True}
+
+
+def test_plans_for_a_paper():
+    plans = RunPlanner('groq', 'llama3-8b-8192', OPTIONS).plans(" ".join(["word"] * 20000))
+    assert {(plan['execution_mode'], plan['summarization_method']) for plan in plans} == {
+        (mode, method) for mode in ("Async", "Non-Async") for method in SUMMARIZATION_METHODS}
+    for plan in plans:
+        assert plan['chunks'] > 1
+        assert plan['summary_requests'] > 0 and plan['explanation_requests'] > 0
+        assert plan['input_tokens'] > 0 and plan['wall_time'] > 0
+
+
+def test_paper_without_text_plans_no_requests():
+    # e.g. a scanned PDF
+    for plan in RunPlanner('groq', 'llama3-8b-8192', OPTIONS).plans(""):
+        assert (plan['chunks'], plan['requests'], plan['input_tokens'], plan['output_tokens']) == (0, 0, 0, 0)
+        assert plan['wall_time'] == 0 and plan['cost'] == 0
@@ -0,0 +1,69 @@
+import asyncio
+
+import anthropic
+import openai
+import pytest
+
+from LLMSelect import LLMSelector
+from asyncExplainer import AsyncExplanationGenerator
+from fakeBatchServer import FakeBatchServer
+from fakeLLM import FakeChatModel
+from pipeline import ExplanationPipeline
+from providerBatch import AnthropicBatchClient, OpenAIBatchClient, ProviderBatchRunner
+from retry import RetryPolicy
+
+SECTIONS = {'difficulty': 'Graduate', 'include_examples': True, 'explain_prereq': True, 'explain_math': True}
+SECTION_IDS = ['main-explanation', 'examples', 'prerequisites', 'mathematical-concepts']
+
+PROVIDERS = {
+    'openai': ('gpt-4o-mini', lambda url: OpenAIBatchClient(
+        'gpt-4o-mini', LLMSelector.get_budget('gpt-4o-mini')['max_output'], openai.OpenAI(base_url=f"{url}/v1", api_key='test'))),
+    'anthropic': ('claude-3-haiku-20240307', lambda url: AnthropicBatchClient(
+        'claude-3-haiku-20240307', LLMSelector.get_budget('claude-3-haiku-20240307')['max_output'],
+        anthropic.Anthropic(base_url=url, api_key='test'))),
+}
+
+
+@pytest.fixture
+def server():
+    # About half of the batched requests error, by custom_id; the counts of finished requests rise for half a second
+    server = FakeBatchServer(delay=0.5, error_rate=0.5, model=FakeChatModel(latency=0, output_tokens=20)).start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize('api_provider', sorted(PROVIDERS))
+def test_batch_round_trip(server, paper_text, api_provider):
+    model_name, make_client = PROVIDERS[api_provider]
+    llm = FakeChatModel(latency=0, output_tokens=20)
+    generator = AsyncExplanationGenerator(llm, api_provider=api_provider, model_name=model_name,
+                                          retry_policy=RetryPolicy(max_retries=0))
+    pipeline = ExplanationPipeline(generator, SECTIONS, 'stuff')
+    events = []
+    runner = ProviderBatchRunner(poll_interval=0.05, clients={(api_provider, model_name): make_client(server.url)},
+                                 on_start=lambda number, result: events.append(('start', number)),
+                                 on_result=lambda number, index, results: events.append(('result', index, tuple(results))),
+                                 on_progress=lambda number, answered: events.append(('progress', answered)))
+
+    [result] = asyncio.run(runner.run_async([(pipeline, paper_text)]))
+
+    requests = [f"paper0-chunk{chunk.index}-{section}" for chunk in result.chunks for section in SECTION_IDS]
+    errored = [custom_id for custom_id in requests if server._fails(custom_id)]
+    assert 0 < len(errored) < len(requests)
+    assert result.failed_sections() == []
+    assert all(chunk.get(section) for chunk in result.chunks for section in pipeline.sections)
+    # Only the summary and the errored requests were sent live
+    assert llm.stats()['calls'] == 1 + len(errored)
+    batch_errors = [call for call in generator.telemetry.calls if call.error is not None]
+    assert len(batch_errors) == len(errored)
+    assert all(call.error.startswith('BatchError') for call in batch_errors)
+
+    # Every request is reported once it is stored; the answered count rises while the job runs and drops once it is stored
+    assert events[0] == ('start', 0)
+    assert sum(event[0] == 'result' for event in events) == len(requests)
+    progress = [event[1] for event in events if event[0] == 'progress']
+    assert progress[0] < len(requests) and progress[-2:] == [len(requests), 0]
+    assert progress[:-1] == sorted(progress[:-1])
+    first_live = len(events) - len(errored)
+    assert events[first_live - 1] == ('progress', 0)
+    assert all(event[0] == 'result' and len(event[2]) == 1 for event in events[first_live:])
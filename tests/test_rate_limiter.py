@@ -0,0 +1,84 @@
+import asyncio
+
+from langchain_core.prompt_values import StringPromptValue
+
+from fakeLLM import FakeChatModel
+from rateLimiter import RateLimiter
+from router import Route
+
+
+def test_requests_per_minute():
+    limiter = RateLimiter(rpm=2, window=0.5)
+    for _ in range(2):
+        with limiter.limit_sync():
+            pass
+    wait, reservation = limiter._try_acquire(0)
+    assert reservation is None
+    assert 0.4 < wait <= 0.5
+
+    asyncio.run(asyncio.sleep(wait))
+    assert limiter._try_acquire(0)[0] == 0
+
+
+def test_tokens_per_minute_counts_the_tokens_used():
+    limiter = RateLimiter(tpm=100)
+    # A response longer than expected takes up more of the window than was reserved
+    with limiter.limit_sync(60) as reservation:
+        reservation.used = 90
+    assert limiter.usage.tokens_in_window == 90
+    assert limiter._try_acquire(20)[0] > 0
+
+    # A shorter one gives back the rest of its reservation
+    limiter = RateLimiter(tpm=100)
+    with limiter.limit_sync(80) as reservation:
+        assert limiter._try_acquire(30)[0] > 0
+        reservation.used = 30
+    assert limiter.usage.tokens_in_window == 30
+    assert limiter._try_acquire(60)[0] == 0
+
+
+def test_tokens_of_failed_requests_stay_reserved():
+    limiter = RateLimiter(tpm=100)
+    try:
+        with limiter.limit_sync(70):
+            raise RuntimeError("provider error")
+    except RuntimeError:
+        pass
+    assert limiter.usage.tokens_in_window == 70
+    assert limiter.usage.active == 0
+
+
+def test_max_concurrency():
+    limiter = RateLimiter(max_concurrency=2, poll_interval=0.01)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with limiter.limit():
+            peak = max(peak, limiter.usage.active)
+            await asyncio.sleep(0.02)
+
+    async def run():
+        await asyncio.gather(*[call() for _ in range(6)])
+
+    asyncio.run(run())
+    assert peak == 2
+    assert limiter.usage.active == 0
+
+
+def test_limiters_of_a_model_share_the_quota():
+    strict = RateLimiter.for_model('fake', 'shared-quota-test', rpm=1, tpm=0, max_concurrency=0)
+    lenient = RateLimiter.for_model('fake', 'shared-quota-test', rpm=2, tpm=0, max_concurrency=0)
+    with lenient.limit_sync():
+        pass
+    # The other run's request counts towards this run's limit, but not the other way round
+    assert strict._try_acquire(0)[0] > 0
+    assert lenient._try_acquire(0)[0] == 0
+
+
+def test_route_charges_the_reported_usage():
+    llm = FakeChatModel(latency=0, output_tokens=50)
+    route = Route('fake', 'fake', llm, RateLimiter(tpm=100000))
+    message, _, _ = asyncio.run(route.ainvoke(StringPromptValue(text="Explain this part of the paper."), 1000))
+    usage = message.usage_metadata
+    assert route.rate_limiter.usage.tokens_in_window == usage['input_tokens'] + usage['output_tokens']
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+from langchain_core.prompt_values import StringPromptValue
+
+from budget import TokenBudget
+from fakeLLM import FakeChatModel, FakeRateLimitError
+from rateLimiter import RateLimiter
+from router import LLMRouter, Route
+from telemetry import Telemetry
+
+PROMPT = StringPromptValue(text="Explain this part of the paper.")
+TOKENS = 500
+
+
+def make_route(name, latency=0.0, error_rate=0.0, rate_limiter=None):
+    return Route('fake', name, FakeChatModel(model_name=name, latency=latency, error_rate=error_rate, output_tokens=20),
+                 rate_limiter or RateLimiter())
+
+
+def make_router(routes, **kwargs):
+    return LLMRouter(routes, telemetry=Telemetry(), **kwargs)
+
+
+def warm_up(route, latency=0.01, samples=20):
+    # Enough recent latencies for the router to tell when a call is slow
+    route.latencies.extend([latency] * samples)
+
+
+def test_failover_to_the_next_route():
+    primary, backup = make_route('primary', error_rate=1.0), make_route('backup')
+    router = make_router([primary, backup])
+
+    route, message, _, _ = asyncio.run(router.ainvoke(PROMPT, TOKENS))
+    assert route is backup and message.content
+    assert router.telemetry.routing_events() == [{'event': 'failover', 'provider': 'fake', 'model': 'primary', 'count': 1}]
+
+    route, message, _, _ = router.invoke(PROMPT, TOKENS)
+    assert route is backup and message.content
+
+
+def test_every_route_failing_raises_after_one_call_each():
+    routes = [make_route('primary', error_rate=1.0), make_route('backup', error_rate=1.0)]
+    router = make_router(routes, hedge_budget=1.0)
+    with pytest.raises(FakeRateLimitError):
+        asyncio.run(router.ainvoke(PROMPT, TOKENS))
+    assert [route.llm.stats()['calls'] for route in routes] == [1, 1]
+
+
+def test_slow_primary_is_hedged_and_the_loser_charged():
+    primary, backup = make_route('primary', latency=0.5), make_route('backup')
+    warm_up(primary)
+    budget = TokenBudget(10000)
+    router = make_router([primary, backup], hedge_budget=1.0, token_budget=budget)
+
+    route, message, _, _ = asyncio.run(router.ainvoke(PROMPT, TOKENS, section='Main Explanation'))
+    assert route is backup and message.content
+    assert router.hedges == 1
+    # The cancelled primary request is recorded and charged its expected tokens in place of the hedge's reservation
+    [loser] = router.telemetry.calls
+    assert (loser.model, loser.section, loser.error) == ('primary', 'Main Explanation', None)
+    assert loser.input_tokens + loser.output_tokens == TOKENS
+    assert (budget.used, budget.reserved) == (TOKENS, 0)
+
+
+def test_queue_wait_is_not_hedged():
+    # A steady primary that can only take one request at a time
+    primary = make_route('primary', latency=0.05, rate_limiter=RateLimiter(max_concurrency=1, poll_interval=0.005))
+    backup = make_route('backup')
+    router = make_router([primary, backup], hedge_budget=0.5)
+
+    async def run():
+        # The first 20 calls, with too few latencies to hedge yet, warm up the primary under the same load
+        await asyncio.gather(*[router.ainvoke(PROMPT, TOKENS) for _ in range(20)])
+        return await asyncio.gather(*[router.ainvoke(PROMPT, TOKENS) for _ in range(20)])
+
+    results = asyncio.run(run())
+    # Only the odd call slower than the primary's own 95th percentile, not every call that had to queue
+    assert router.hedges <= 5
+    assert sum(route is backup for route, *_ in results) <= router.hedges
+
+
+def test_hedges_need_room_in_the_token_budget():
+    primary, backup = make_route('primary', latency=0.1), make_route('backup')
+    warm_up(primary)
+    budget = TokenBudget(TOKENS - 1)
+    router = make_router([primary, backup], hedge_budget=1.0, token_budget=budget)
+
+    route, _, _, _ = asyncio.run(router.ainvoke(PROMPT, TOKENS))
+    assert route is primary
+    assert router.hedges == 0 and backup.llm.stats()['calls'] == 0
+    assert (budget.used, budget.reserved) == (0, 0)
+
+
+def test_cancelling_the_caller_cancels_both_requests():
+    primary, backup = make_route('primary', latency=1.0), make_route('backup', latency=1.0)
+    warm_up(primary)
+    budget = TokenBudget(10000)
+    router = make_router([primary, backup], hedge_budget=1.0, token_budget=budget)
+
+    async def run():
+        task = asyncio.ensure_future(router.ainvoke(PROMPT, TOKENS))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Let the cancelled requests unwind
+        await asyncio.sleep(0.05)
+        return [other for other in asyncio.all_tasks() if other is not asyncio.current_task() and not other.done()]
+
+    assert asyncio.run(run()) == []
+    assert router.hedges == 1
+    assert primary.rate_limiter.usage.active == backup.rate_limiter.usage.active == 0
+    # The caller settles the primary; the hedge was in flight, so it is charged
+    assert (budget.used, budget.reserved) == (TOKENS, 0)
@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+from asyncExplainer import AsyncExplanationGenerator
+from fakeLLM import FakeChatModel
+from retry import RetryPolicy
+from streaming import ResultStreamWriter, StreamingPipeline, load_result_stream
+
+SECTIONS = {'difficulty': 'Graduate', 'include_examples': True, 'explain_prereq': True, 'explain_math': True}
+
+
+def test_page_extraction_does_not_block_the_event_loop(paper_text, tmp_path):
+    generator = AsyncExplanationGenerator(FakeChatModel(latency=0, output_tokens=20), api_provider='fake', model_name='fake',
+                                          retry_policy=RetryPolicy(max_retries=0))
+    pipeline = StreamingPipeline(generator, SECTIONS)
+    paragraphs = paper_text.split("\n\n")
+
+    def pages():
+        # A slow PDF: each page takes a while to extract
+        for paragraph in paragraphs:
+            time.sleep(0.02)
+            yield paragraph + "\n\n"
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        await pipeline.run_async(pages(), ResultStreamWriter(str(tmp_path / 'paper.jsonl')))
+        ticker.cancel()
+        return ticks
+
+    # The other tasks on the loop, like other papers' requests, keep running while pages are extracted
+    assert asyncio.run(run()) >= len(paragraphs) * 2
+    result = load_result_stream(str(tmp_path / 'paper.jsonl'))
+    assert result.summary and len(result.chunks) == 2
+    assert result.failed_sections() == []